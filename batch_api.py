@@ -0,0 +1,323 @@
+import json
+import logging
+import os
+import time
+from preprocess import preprocess_email
+from ratelimit import get_limiter
+from summarize import summarize_request, summary_cache_key
+
+BATCH_STATE_FILE = 'batch_state.json'
+BATCH_EMAILS_FILE = 'batch_emails.jsonl'
+BATCH_REQUESTS_FILE = 'batch_requests.jsonl'
+
+# Replies received so far, kept across resubmissions of the requests a batch did not complete.
+BATCH_OUTPUTS_FILE = 'batch_outputs.jsonl'
+
+# Ids of the emails already acted on, one per line, so an interrupted apply never repeats a reply.
+BATCH_APPLIED_FILE = 'batch_applied.txt'
+BATCH_ENDPOINT = '/v1/chat/completions'
+COMPLETION_WINDOW = '24h'
+
+# The Batch API accepts at most this many requests per input file.
+MAX_BATCH_REQUESTS = 50000
+
+TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+# Requests a batch did not complete are resubmitted until this many batches have been tried.
+MAX_BATCH_ATTEMPTS = 3
+
+class BatchRunner:
+    """Runs summarization and categorization through the OpenAI Batch API.
+
+    Emails are fetched once and written to a local JSONL file alongside the
+    batch request file, the requests are submitted as a single batch, and
+    once it finishes every email goes through the processor's usual
+    respond/flag/spam stage. Progress is kept in a state file so a restarted
+    run resumes the same batch instead of submitting a new one, and each
+    email acted on is appended to the applied file so a restarted apply
+    skips it. Requests a failed, expired or cancelled batch did not
+    complete are resubmitted in a new batch; emails still without a
+    category after MAX_BATCH_ATTEMPTS are left for the next run.
+    """
+    def __init__(self, processor, state_file=BATCH_STATE_FILE, emails_file=BATCH_EMAILS_FILE,
+                 requests_file=BATCH_REQUESTS_FILE, applied_file=BATCH_APPLIED_FILE,
+                 outputs_file=BATCH_OUTPUTS_FILE, poll_interval=60):
+        self.processor = processor
+        self.client = processor.openai_client
+        self.state_file = state_file
+        self.emails_file = emails_file
+        self.requests_file = requests_file
+        self.applied_file = applied_file
+        self.outputs_file = outputs_file
+        self.poll_interval = poll_interval
+
+    def load_state(self):
+        if not os.path.exists(self.state_file):
+            return None
+        with open(self.state_file) as state_file:
+            return json.load(state_file)
+
+    def save_state(self, state):
+        # Write then rename so a crash never leaves a truncated state file
+        temp_file = self.state_file + '.tmp'
+        with open(temp_file, 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(temp_file, self.state_file)
+
+    def clear_state(self):
+        for path in (self.state_file, self.emails_file, self.requests_file, self.applied_file, self.outputs_file):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def load_applied(self):
+        """Ids of the emails an earlier, interrupted apply already acted on."""
+        if not os.path.exists(self.applied_file):
+            return set()
+        with open(self.applied_file) as applied_file:
+            return {line.strip() for line in applied_file if line.strip()}
+
+    def load_outputs(self):
+        """Replies received from earlier batches of this run, by custom_id."""
+        if not os.path.exists(self.outputs_file):
+            return {}
+        with open(self.outputs_file) as outputs_file:
+            return dict(json.loads(line) for line in outputs_file if line.strip())
+
+    def save_outputs(self, outputs):
+        with open(self.outputs_file, 'a') as outputs_file:
+            outputs_file.writelines(json.dumps([custom_id, reply]) + '\n' for custom_id, reply in outputs.items())
+
+    def pending_requests(self, outputs):
+        """Lines of the request file that have no reply yet."""
+        with open(self.requests_file) as requests_file:
+            return [line for line in requests_file if line.strip() and json.loads(line)['custom_id'] not in outputs]
+
+    def write_requests(self, lines):
+        # Write then rename, like the state file, so a resumed run never sees half a request file
+        temp_file = self.requests_file + '.tmp'
+        with open(temp_file, 'w') as requests_file:
+            requests_file.writelines(lines)
+        os.replace(temp_file, self.requests_file)
+
+    def batch_request(self, custom_id, body):
+        return {'custom_id': custom_id, 'method': 'POST', 'url': BATCH_ENDPOINT, 'body': body}
+
+    def collect(self):
+        """Fetch emails and write them and their batch requests to JSONL files.
+
+        Emails already categorized by a header rule need no requests. Whole
+        chunks are collected so the incremental sync checkpoint only covers
+        emails that made it into the batch. Returns the number of emails and
+        requests written.
+        """
+        processor = self.processor
+        emails = requests = 0
+        with open(self.emails_file, 'w') as emails_file, open(self.requests_file, 'w') as requests_file:
+            for chunk in processor.list_chunks():
+                if requests + 2 * len(chunk) > MAX_BATCH_REQUESTS:
+                    logging.warning(f"Batch request limit reached; stopping after {emails} emails")
+                    break
+                for email in processor.fetch_chunk(chunk):
+                    requests += self.collect_email(email, emails_file, requests_file)
+                    emails += 1
+                processor.note_listed(chunk)
+        return emails, requests
+
+    def collect_email(self, email, emails_file, requests_file):
+        """Write one fetched email and its batch requests; returns the number of requests written."""
+        msg_id, email_content, category_info, _ = email
+        summary = None
+        requests = 0
+        if category_info is None:
+            # An earlier, interrupted run may already have analyzed it
+            summary, category_info = self.processor.resume_analysis(msg_id)
+        if category_info is None:
+            summarize_body = summarize_request(preprocess_email(email_content, 'summarize'))
+            categorize_body = self.processor.categorizer.categorize_request(
+                preprocess_email(email_content, 'categorize'))
+            requests_file.write(json.dumps(self.batch_request(f'{msg_id}:summarize', summarize_body)) + '\n')
+            requests_file.write(json.dumps(self.batch_request(f'{msg_id}:categorize', categorize_body)) + '\n')
+            requests = 2
+        emails_file.write(json.dumps({
+            'id': msg_id,
+            'content': email_content,
+            'category_info': category_info,
+            'summary': summary
+        }) + '\n')
+        return requests
+
+    def sync_state(self):
+        """The processor's incremental sync progress after collecting, saved with the batch state."""
+        processor = self.processor
+        if processor.retry_ids is None:
+            return None
+        return {
+            'checkpoint': processor.sync_checkpoint,
+            'retry': [msg_id for msg_id in processor.retry_ids if msg_id not in processor.listed_ids]
+        }
+
+    def restore_sync_state(self, sync):
+        """Let the processor save the collected sync progress once the batch is applied."""
+        processor = self.processor
+        processor.sync_checkpoint = sync['checkpoint']
+        processor.retry_ids = sync['retry']
+        processor.listed_ids = set()
+        processor.failed_ids = []
+
+    def submit(self):
+        """Upload the request file and create the batch."""
+        limiter = get_limiter()
+        with open(self.requests_file, 'rb') as requests_file:
+            upload = limiter.call_openai(self.client.files.create, 0, file=requests_file, purpose='batch',
+                                         stage='batch_api', idempotent=False)
+        batch = limiter.call_openai(
+            self.client.batches.create, 0,
+            input_file_id=upload.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=COMPLETION_WINDOW,
+            stage='batch_api',
+            idempotent=False
+        )
+        logging.info(f"Submitted batch {batch.id}")
+        return upload.id, batch.id
+
+    def wait(self, batch_id):
+        """Poll a batch until it reaches a terminal status."""
+        while True:
+            batch = get_limiter().call_openai(self.client.batches.retrieve, 0, batch_id=batch_id, stage='batch_api')
+            if batch.status in TERMINAL_STATUSES:
+                return batch
+            counts = batch.request_counts
+            if counts:
+                logging.info(f"Batch {batch_id} {batch.status}: "
+                             f"{counts.completed + counts.failed}/{counts.total} requests done")
+            else:
+                logging.info(f"Batch {batch_id} {batch.status}")
+            time.sleep(self.poll_interval)
+
+    def download(self, file_id):
+        """Return custom_id -> reply text for the successful requests in a result file."""
+        outputs = {}
+        if not file_id:
+            return outputs
+        content = get_limiter().call_openai(self.client.files.content, 0, file_id=file_id, stage='batch_api').text
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get('response') or {}
+            if response.get('status_code') == 200:
+                outputs[record['custom_id']] = response['body']['choices'][0]['message']['content']
+            else:
+                error = record.get('error') or response.get('body', {}).get('error')
+                logging.error(f"Batch request {record['custom_id']} failed: {error}")
+        return outputs
+
+    def analysis(self, email_content, summary, reply):
+        """Category info from a categorize reply, recording both replies as the online calls would."""
+        processor = self.processor
+        category_info = processor.categorizer.parse_category(reply, email_content)
+        processor.categorizer.record_category(
+            preprocess_email(email_content, 'categorize'), email_content, category_info)
+        if processor.cache and summary is not None:
+            text = preprocess_email(email_content, 'summarize')
+            processor.cache.set('summarize', summary_cache_key(processor.cache, text), summary)
+        return category_info
+
+    def apply(self, outputs):
+        """Run every collected email through the processor's action stage and return the category counts.
+
+        Each email is recorded in the applied file once its reply is sent or
+        its queued label changes are flushed; emails recorded by an earlier
+        run are skipped. Emails the batch never categorized are left
+        unfinished, for the next run to fetch and analyze again.
+        """
+        processor = self.processor
+        applied = self.load_applied()
+        if applied:
+            logging.info(f"Skipping {len(applied)} emails already acted on by an interrupted run")
+        # Emails whose label changes are queued but not yet applied
+        unflushed = []
+
+        with open(self.emails_file) as emails_file, open(self.applied_file, 'a') as applied_file:
+            def record(msg_ids):
+                applied_file.writelines(f'{msg_id}\n' for msg_id in msg_ids)
+                applied_file.flush()
+
+            for line in emails_file:
+                email = json.loads(line)
+                msg_id, email_content, category_info = email['id'], email['content'], email['category_info']
+                if msg_id in applied:
+                    continue
+                summary = email.get('summary')
+                if category_info is None:
+                    reply = outputs.get(f'{msg_id}:categorize')
+                    if reply is None:
+                        logging.error(f"Batch never categorized email {msg_id}; leaving it for the next run")
+                        processor.failed_ids.append(msg_id)
+                        continue
+                    summary = outputs.get(f'{msg_id}:summarize')
+                    category_info = self.analysis(email_content, summary, reply)
+                    processor.record_analysis(msg_id, summary, category_info)
+                try:
+                    result = processor.process_message(msg_id, email_content, category_info, summary=summary)
+                except Exception as error:
+                    logging.error(f"Error processing email {msg_id}: {error}")
+                    continue
+                processor.report(result)
+                if processor.batch_labels and result['category'] != 'AUTO_REPLY':
+                    unflushed.append(msg_id)
+                else:
+                    record([msg_id])
+                if processor.labels_due():
+                    processor.flush_labels()
+                    record(unflushed)
+                    unflushed = []
+
+            category_counts = processor.finish_run()
+            record(unflushed)
+        return category_counts
+
+    def run(self):
+        """Collect, submit, wait for and apply a batch, resuming from the state file if present."""
+        state = self.load_state()
+        if state is None:
+            emails, requests = self.collect()
+            state = {'status': 'collected', 'emails': emails, 'requests': requests, 'attempts': 0,
+                     'sync': self.sync_state()}
+            self.save_state(state)
+            logging.info(f"Collected {emails} emails needing {requests} batch requests")
+        else:
+            logging.info(f"Resuming batch run from {self.state_file} ({state['status']})")
+
+        outputs = self.load_outputs()
+        while state['requests']:
+            if state['status'] == 'collected':
+                state['input_file_id'], state['batch_id'] = self.submit()
+                state['status'] = 'submitted'
+                state['attempts'] += 1
+                self.save_state(state)
+
+            batch = self.wait(state['batch_id'])
+            if batch.status == 'failed':
+                logging.error(f"Batch {batch.id} failed: {batch.errors}")
+            received = self.download(batch.output_file_id)
+            self.download(batch.error_file_id)
+            self.save_outputs(received)
+            outputs.update(received)
+            pending = self.pending_requests(outputs)
+            logging.info(f"Batch {batch.id} {batch.status}: "
+                         f"{state['requests'] - len(pending)}/{state['requests']} requests succeeded")
+            if not pending or state['attempts'] >= MAX_BATCH_ATTEMPTS:
+                break
+            # Keep what came back and try the rest in a new batch
+            logging.warning(f"Resubmitting {len(pending)} requests batch {batch.id} did not complete")
+            self.write_requests(pending)
+            state['status'] = 'collected'
+            self.save_state(state)
+
+        if state.get('sync'):
+            self.restore_sync_state(state['sync'])
+        category_counts = self.apply(outputs)
+        self.clear_state()
+        return category_counts
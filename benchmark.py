@@ -0,0 +1,316 @@
+"""Offline throughput benchmark for EmailProcessor.
+
+Runs the full pipeline against a seeded synthetic mailbox, a fake Gmail
+service and a fake OpenAI client with configurable latency and error
+profiles, so changes can be compared without touching live services:
+
+    python benchmark.py --sizes 100 1000 10000 --save-baseline
+    python benchmark.py --compare
+"""
+import base64
+import contextlib
+import io
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+
+from dedupe import NearDuplicateIndex
+from metrics import metrics
+from ratelimit import RateLimiter, set_limiter
+from tests.fakes import FakeGmail, FakeOpenAI
+
+BASELINE_FILE = 'benchmark_baseline.json'
+BENCHMARK_SIZES = (100, 1000, 10000)
+
+# A run is reported as a regression when its throughput falls this far below the baseline.
+REGRESSION_TOLERANCE = 0.2
+
+# Latency and failure profiles; latencies are (mean, jitter) in seconds.
+PROFILES = {
+    'ideal': {
+        'gmail_latency': (0.0, 0.0), 'openai_latency': (0.0, 0.0),
+        'gmail_error_rate': 0.0, 'gmail_throttle_rate': 0.0,
+        'openai_error_rate': 0.0, 'openai_throttle_rate': 0.0
+    },
+    'typical': {
+        'gmail_latency': (0.005, 0.002), 'openai_latency': (0.02, 0.01),
+        'gmail_error_rate': 0.0, 'gmail_throttle_rate': 0.0,
+        'openai_error_rate': 0.0, 'openai_throttle_rate': 0.0
+    },
+    'flaky': {
+        'gmail_latency': (0.005, 0.002), 'openai_latency': (0.02, 0.01),
+        'gmail_error_rate': 0.01, 'gmail_throttle_rate': 0.02,
+        'openai_error_rate': 0.01, 'openai_throttle_rate': 0.05
+    }
+}
+
+SENDERS = ['alice@example.com', 'bob@example.org', 'carol@example.net', 'dave@partner.example']
+NEWSLETTER_SENDERS = ['news@shop.example', 'noreply@updates.example', 'digest@community.example']
+PERSONAL_BODIES = [
+    "Could you review the attached proposal before Friday? I have concerns about the budget section.",
+    "Can you confirm that my order has shipped? The tracking page has not updated since Monday.",
+    "Please send me the status of ticket {n}. Our customer is asking for an update.",
+    "I would like to schedule a call next week to discuss the contract renewal and pricing.",
+    "Thanks for the quick fix yesterday, everything works again. Just confirming receipt."
+]
+# Opening of every newsletter; it survives preprocessing, unlike the unsubscribe footer.
+NEWSLETTER_LEAD = "This week's highlights"
+NEWSLETTER_BODY = (NEWSLETTER_LEAD + ": new arrivals, seasonal discounts and community events. "
+                   "Read more at https://shop.example/newsletter/{n}?utm_source=email&utm_medium=digest\n\n"
+                   "You are receiving this because you subscribed. Unsubscribe: https://shop.example/unsubscribe")
+
+def _encode(text):
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+class SyntheticMailbox:
+    """Seeded generator of Gmail message resources.
+
+    Produces a mix of plain personal mail, multipart/alternative mail,
+    newsletters with List-Unsubscribe headers, and long reply threads with
+    quoted history, newest message first like the Gmail inbox listing.
+    """
+    def __init__(self, size, seed=0, thread_fraction=0.15, newsletter_fraction=0.25,
+                 multipart_fraction=0.2, max_thread_length=20):
+        self.random = random.Random(seed)
+        self.messages = {}
+        self.inbox_count = 0
+        kinds = ['thread', 'newsletter', 'multipart', 'plain']
+        weights = [thread_fraction, newsletter_fraction, multipart_fraction,
+                   1 - thread_fraction - newsletter_fraction - multipart_fraction]
+        while self.inbox_count < size:
+            kind = self.random.choices(kinds, weights)[0]
+            if kind == 'thread':
+                # Every other message in a thread is our own reply
+                length = min(2 * (size - self.inbox_count) - 1, self.random.randint(3, max_thread_length))
+                self._add_thread(length)
+            else:
+                self._add_message(kind)
+        # Gmail lists the newest messages first
+        self.messages = dict(sorted(self.messages.items(), key=lambda item: -int(item[1]['internalDate'])))
+
+    def _next_id(self):
+        return f'{len(self.messages):016x}'
+
+    def _message(self, msg_id, thread_id, sender, subject, body, labels, extra_headers=(), multipart=False):
+        headers = [
+            {'name': 'From', 'value': sender},
+            {'name': 'To', 'value': 'me@example.com'},
+            {'name': 'Subject', 'value': subject},
+            {'name': 'Message-ID', 'value': f'<{msg_id}@mail.example>'}
+        ] + list(extra_headers)
+        if multipart:
+            payload = {
+                'mimeType': 'multipart/alternative',
+                'headers': headers,
+                'parts': [
+                    {'mimeType': 'text/plain', 'body': {'data': _encode(body)}},
+                    {'mimeType': 'text/html', 'body': {'data': _encode(f'<html><body><p>{body}</p></body></html>')}}
+                ]
+            }
+        else:
+            payload = {'mimeType': 'text/plain', 'headers': headers, 'body': {'data': _encode(body)}}
+        message = {
+            'id': msg_id,
+            'threadId': thread_id,
+            'labelIds': labels,
+            'snippet': body[:100],
+            'internalDate': str(1700000000000 + len(self.messages) * 60000),
+            'payload': payload
+        }
+        self.messages[msg_id] = message
+        self.inbox_count += 'INBOX' in labels
+        return message
+
+    def _add_message(self, kind):
+        msg_id = self._next_id()
+        n = self.random.randint(1000, 9999)
+        if kind == 'newsletter':
+            self._message(
+                msg_id, msg_id, self.random.choice(NEWSLETTER_SENDERS), f'Weekly digest #{n}',
+                NEWSLETTER_BODY.format(n=n), ['INBOX', 'CATEGORY_PROMOTIONS'],
+                extra_headers=[{'name': 'List-Unsubscribe', 'value': '<https://shop.example/unsubscribe>'}])
+        else:
+            body = self.random.choice(PERSONAL_BODIES).format(n=n) + '\n\nBest regards,\nA. Sender'
+            self._message(msg_id, msg_id, self.random.choice(SENDERS), f'Request {n}', body, ['INBOX'],
+                          multipart=kind == 'multipart')
+
+    def _add_thread(self, length):
+        thread_id = self._next_id()
+        subject = f'Project update {self.random.randint(100, 999)}'
+        history = ''
+        for index in range(length):
+            sender = 'me@example.com' if index % 2 else self.random.choice(SENDERS)
+            body = self.random.choice(PERSONAL_BODIES).format(n=index)
+            text = body + ('\n\nOn an earlier date someone wrote:\n' +
+                           '\n'.join(f'> {line}' for line in history.splitlines()) if history else '')
+            labels = ['SENT'] if sender == 'me@example.com' else ['INBOX']
+            self._message(self._next_id(), thread_id, sender,
+                          subject if index == 0 else f'Re: {subject}', text, labels)
+            history = text
+
+class SyntheticReplies:
+    """Replies for FakeOpenAI that follow the prompt of each pipeline stage.
+
+    Categories are decided from keywords in the email so runs are
+    deterministic: newsletters are NO_RESPONSE, confirmation and status
+    requests AUTO_REPLY, and everything else HUMAN_NEEDED.
+    """
+    def __init__(self):
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, messages, **kwargs):
+        system, user = messages[0]['content'], messages[-1]['content']
+        # Only look at the email itself, not the category guidelines in the prompt
+        lowered = user.split('Email content:')[-1].lower()
+        if NEWSLETTER_LEAD.lower() in lowered:
+            category = 'NO_RESPONSE'
+        elif 'confirm' in lowered or 'status' in lowered:
+            category = 'AUTO_REPLY'
+        else:
+            category = 'HUMAN_NEEDED'
+
+        if kwargs.get('response_format'):
+            stage = 'analyze'
+            content = json.dumps({'summary': 'A short summary of the email.', 'category': category,
+                                  'explanation': 'Synthetic categorization.'})
+        elif 'categorizes' in system:
+            stage = 'categorize'
+            content = f'{category}\nSynthetic categorization.'
+        elif 'summarizes' in system:
+            stage = 'summarize'
+            content = 'A short summary of the email.'
+        else:
+            stage = 'respond'
+            content = 'Thanks for your email. This is a synthetic reply.'
+        with self._lock:
+            self.calls[stage] += 1
+        return content
+
+def run_benchmark(size, profile='typical', seed=0, **processor_options):
+    """Process a synthetic mailbox of the given size and return throughput, latency and call counts."""
+    from main import EmailProcessor
+
+    settings = PROFILES[profile]
+    mailbox = SyntheticMailbox(size, seed=seed)
+    gmail = FakeGmail(mailbox.messages.values(), settings['gmail_latency'], settings['gmail_error_rate'],
+                      settings['gmail_throttle_rate'], seed=seed)
+    replies = SyntheticReplies()
+    client = FakeOpenAI(replies, settings['openai_latency'], settings['openai_error_rate'],
+                        settings['openai_throttle_rate'], seed=seed)
+    # Measure the pipeline itself rather than the real API quotas
+    set_limiter(RateLimiter(gmail_units_per_second=10 ** 9, openai_rpm=10 ** 9, openai_tpm=10 ** 12,
+                            base_delay=0.01, max_delay=0.1))
+    metrics.reset()
+    options = dict(processor_options)
+    if options.pop('dedupe', False):
+        options['dedupe'] = NearDuplicateIndex(':memory:')
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        # The fake mailbox's label id must not be saved over the real one
+        processor = EmailProcessor(gmail_service=gmail, openai_client=client, max_emails=size, label_file=None,
+                                   **options)
+        processor.print_result = lambda result: None
+        started = time.monotonic()
+        category_counts = processor.process_emails()
+        duration = time.monotonic() - started
+
+    emails = sum(category_counts.values())
+    return {
+        'size': size,
+        'profile': profile,
+        'options': processor_options,
+        'emails': emails,
+        'duration_seconds': duration,
+        'emails_per_second': emails / duration if duration else 0.0,
+        'categories': dict(category_counts),
+        'stages': {stage: {key: stage_stats[key] for key in (
+                       'calls', 'retries', 'errors', 'latency_p50_seconds', 'latency_p99_seconds')}
+                   for stage, stage_stats in metrics.get_report().items()},
+        'gmail_calls': dict(gmail.calls),
+        'openai_calls': dict(replies.calls, **{str(status): count for status, count in client.errors.items()})
+    }
+
+def run_key(run):
+    return run['size'], run['profile'], json.dumps(run['options'], sort_keys=True)
+
+def save_baseline(results, path=BASELINE_FILE):
+    """Store results in the baseline, replacing earlier runs of the same size, profile and options."""
+    runs = {}
+    if os.path.exists(path):
+        with open(path) as baseline_file:
+            runs = {run_key(run): run for run in json.load(baseline_file)['runs']}
+    runs.update((run_key(run), run) for run in results)
+    with open(path, 'w') as baseline_file:
+        json.dump({'runs': list(runs.values())}, baseline_file, indent=2)
+
+def compare(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """Return a description of every run whose throughput regressed against the baseline."""
+    previous = {run_key(run): run for run in baseline['runs']}
+    regressions = []
+    for run in results:
+        before = previous.get(run_key(run))
+        if before and run['emails_per_second'] < before['emails_per_second'] * (1 - tolerance):
+            regressions.append(f"{run['size']} emails ({run['profile']}): {run['emails_per_second']:.1f} "
+                               f"emails/s vs {before['emails_per_second']:.1f} in the baseline")
+    return regressions
+
+def print_run(run):
+    print(f"\n{run['size']} emails ({run['profile']} profile): {run['emails_per_second']:.1f} emails/s "
+          f"in {run['duration_seconds']:.2f}s")
+    for stage, stage_stats in run['stages'].items():
+        print(f"  {stage}: {stage_stats['calls']} calls, p50 {stage_stats['latency_p50_seconds'] * 1000:.1f}ms, "
+              f"p99 {stage_stats['latency_p99_seconds'] * 1000:.1f}ms, {stage_stats['retries']} retries")
+    print(f"  Gmail calls: {run['gmail_calls']}")
+    print(f"  OpenAI calls: {run['openai_calls']}")
+
+def main():
+    """Run the benchmark and optionally save or compare against a baseline."""
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Benchmark EmailProcessor against fake Gmail and OpenAI backends.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(BENCHMARK_SIZES),
+                        help='Mailbox sizes to run')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='typical',
+                        help='Latency and failure profile of the fake backends')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic mailbox and fakes')
+    parser.add_argument('--concurrent', action='store_true', help='Benchmark the --concurrent pipeline')
+    parser.add_argument('--fused', action='store_true', help='Benchmark --fused analysis')
+    parser.add_argument('--batch-labels', action='store_true', help='Benchmark --batch-labels')
+    parser.add_argument('--header-rules', action='store_true', help='Benchmark --header-rules')
+    parser.add_argument('--threads', action='store_true', help='Benchmark --threads')
+    parser.add_argument('--dedupe', action='store_true', help='Benchmark --dedupe with a fresh in-memory index')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='Baseline file to save or compare against')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Save these results in the baseline, replacing runs with the same settings')
+    parser.add_argument('--compare', action='store_true',
+                        help='Exit with status 1 if throughput regressed against the baseline')
+    args = parser.parse_args()
+
+    options = {name: True for name in ('concurrent', 'fused', 'batch_labels', 'header_rules', 'threads', 'dedupe')
+               if getattr(args, name)}
+    results = []
+    for size in args.sizes:
+        run = run_benchmark(size, profile=args.profile, seed=args.seed, **options)
+        print_run(run)
+        results.append(run)
+
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+        print(f"\nBaseline saved to {args.baseline}")
+
+    if args.compare:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file))
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print("\nNo regressions against the baseline")
+
+if __name__ == '__main__':
+    main()
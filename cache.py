@@ -0,0 +1,113 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+# Default location of the on-disk LLM output cache.
+CACHE_FILE = 'llm_cache.db'
+
+# Seconds to wait for another process (e.g. a --mailboxes worker) to release the database.
+BUSY_TIMEOUT = 30
+
+class LLMCache:
+    """Persistent, content-addressed cache for LLM outputs.
+
+    Entries are keyed by a hash of the normalized email text, model, prompt
+    template and temperature, so editing a prompt automatically stops its old
+    entries from being used. The least recently used entries are evicted once
+    max_entries is exceeded, and entries older than ttl seconds are ignored.
+    Several processes may share one cache file; a database error is logged
+    and treated as a miss.
+    """
+    def __init__(self, path=CACHE_FILE, max_entries=10000, ttl=None, timeout=BUSY_TIMEOUT):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = Counter()
+        self.misses = Counter()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        with self._lock, self._conn:
+            # Readers do not wait for writers in other processes
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    stage TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed_at)")
+        self.purge_expired()
+
+    @staticmethod
+    def make_key(content, model, prompt, temperature=None):
+        """Build the cache key for an LLM call."""
+        normalized = ' '.join(content.split())
+        key_data = json.dumps([normalized, model, prompt, temperature])
+        return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+    def get(self, stage, key):
+        """Return the cached value for key, or None on a miss."""
+        now = time.time()
+        try:
+            with self._lock, self._conn:
+                row = self._conn.execute(
+                    "SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+                if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+                    self.misses[stage] += 1
+                    return None
+                self._conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+                self.hits[stage] += 1
+        except sqlite3.Error as error:
+            logging.error(f"Error reading from LLM cache: {error}")
+            with self._lock:
+                self.misses[stage] += 1
+            return None
+        return json.loads(row[0])
+
+    def set(self, stage, key, value):
+        """Store a value and evict the least recently used entries if needed."""
+        now = time.time()
+        try:
+            with self._lock, self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, stage, value, created_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, stage, json.dumps(value), now, now))
+                self._conn.execute(
+                    "DELETE FROM llm_cache WHERE key IN ("
+                    "SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,))
+        except sqlite3.Error as error:
+            logging.error(f"Error writing to LLM cache: {error}")
+
+    def purge_expired(self):
+        """Delete entries older than the TTL."""
+        if self.ttl is None:
+            return
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM llm_cache WHERE created_at < ?", (time.time() - self.ttl,))
+
+    def get_stats(self):
+        """Return hit, miss and hit rate counts per stage."""
+        stats = {}
+        for stage in sorted(set(self.hits) | set(self.misses)):
+            hits, misses = self.hits[stage], self.misses[stage]
+            stats[stage] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses else 0.0
+            }
+        return stats
+
+    def close(self):
+        """Close the underlying database connection."""
+        with self._lock:
+            self._conn.close()
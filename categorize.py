@@ -1,19 +1,18 @@
-from openai import OpenAI
+import json
 import logging
+import threading
+from collections import Counter
+from local_model import CONFIDENCE_THRESHOLD
+from preprocess import preprocess_email
+from ratelimit import estimate_tokens, get_limiter
 
-class EmailCategorizer:
-    def __init__(self, openai_client):
-        self.client = openai_client
-        
-    def categorize_email(self, email_content):
-        """
-        Categorize email into one of three categories:
-        1. Requires human response
-        2. Can be auto-responded
-        3. No response needed
-        """
-        try:
-            prompt = """Analyze this email and categorize it into one of these categories:
+CATEGORIES = ('HUMAN_NEEDED', 'AUTO_REPLY', 'NO_RESPONSE')
+
+MODEL = "gpt-3.5-turbo"
+TEMPERATURE = 0.3  # Lower temperature for more consistent categorization
+
+CATEGORIZE_SYSTEM_PROMPT = "You are an expert email analyst who categorizes emails accurately."
+CATEGORIZE_PROMPT = """Analyze this email and categorize it into one of these categories:
             1. HUMAN_NEEDED: Requires personal attention and human response
             2. AUTO_REPLY: Can be handled with an automated response
             3. NO_RESPONSE: No response required
@@ -31,37 +30,226 @@ class EmailCategorizer:
             Email content:
             {email_content}
             """
+ANALYZE_SYSTEM_PROMPT = "You are an expert email analyst who summarizes and categorizes emails accurately. You always answer in JSON."
+ANALYZE_PROMPT = """Analyze this email, summarize it and categorize it into one of these categories:
+            1. HUMAN_NEEDED: Requires personal attention and human response
+            2. AUTO_REPLY: Can be handled with an automated response
+            3. NO_RESPONSE: No response required
+            
+            Consider these guidelines:
+            - HUMAN_NEEDED: Complex inquiries, important business matters, personal matters, 
+              negotiations, complaints, or anything requiring human judgment
+            - AUTO_REPLY: Simple inquiries, confirmations, routine requests, status updates, 
+              or anything with standard/predictable responses
+            - NO_RESPONSE: FYI emails, newsletters, marketing, notifications, or spam
+            
+            Respond with a JSON object with these keys:
+            - "summary": a 2-3 sentence summary of the email
+            - "category": HUMAN_NEEDED, AUTO_REPLY, or NO_RESPONSE
+            - "explanation": a brief explanation of the category
             
-            response = self.client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are an expert email analyst who categorizes emails accurately."},
-                    {"role": "user", "content": prompt.format(email_content=email_content)}
-                ],
-                temperature=0.3  # Lower temperature for more consistent categorization
+            Email content:
+            {email_content}
+            """
+
+class EmailCategorizer:
+    def __init__(self, openai_client, cache=None, local_model=None,
+                 confidence_threshold=CONFIDENCE_THRESHOLD, label_log=None, dedupe=None):
+        self.client = openai_client
+        self.cache = cache
+        # Optional local classifier consulted before the LLM
+        self.local_model = local_model
+        unseen = [category for category in CATEGORIES if local_model and category not in local_model.classes]
+        if unseen:
+            logging.error(f"Local model was never trained on {', '.join(unseen)}; asking OpenAI instead")
+            self.local_model = None
+        self.confidence_threshold = confidence_threshold
+        # Optional log of LLM-assigned categories for training the local model
+        self.label_log = label_log
+        # Optional near-duplicate index whose clusters share one categorization
+        self.dedupe = dedupe
+        self.local_decisions = 0
+        self.llm_decisions = 0
+        self._stats_lock = threading.Lock()
+        
+    def categorize_email(self, email_content):
+        """
+        Categorize email into one of three categories:
+        1. Requires human response
+        2. Can be auto-responded
+        3. No response needed
+        """
+        text = preprocess_email(email_content, 'categorize')
+        
+        if self.local_model:
+            category, confidence = self.local_model.predict(text)
+            if confidence >= self.confidence_threshold:
+                with self._stats_lock:
+                    self.local_decisions += 1
+                return {
+                    'category': category,
+                    'explanation': f"Local model ({confidence:.0%} confidence)",
+                    'original_content': email_content[:200] + '...' if len(email_content) > 200 else email_content
+                }
+        
+        if self.cache:
+            cached = self.cache.get('categorize', self.categorize_cache_key(text))
+            if cached is not None:
+                return cached
+        
+        if self.dedupe:
+            clustered = self.dedupe.lookup_category(email_content, stage='categorize')
+            if clustered is not None:
+                clustered.pop('summary', None)
+                return self._with_original(clustered, email_content)
+        
+        try:
+            request = self.categorize_request(text)
+            response = get_limiter().call_openai(
+                self.client.chat.completions.create,
+                estimate_tokens(request['messages']),
+                **request,
+                stage='categorize'
             )
             
-            # Extract category and explanation
-            result = response.choices[0].message.content.strip()
-            category = result.split('\n')[0].strip()  # First line contains the category
-            explanation = '\n'.join(result.split('\n')[1:]).strip()  # Remaining lines are explanation
+            category_info = self.parse_category(response.choices[0].message.content, email_content)
+            self.record_category(text, email_content, category_info)
+            return category_info
             
+        except Exception as error:
+            logging.error(f"Error in categorization: {error}")
             return {
+                'category': 'ERROR',
+                'explanation': f"Error during categorization: {str(error)}",
+                'original_content': email_content[:200]
+            }
+
+    def categorize_cache_key(self, text):
+        """LLM cache key for categorizing already preprocessed text."""
+        return self.cache.make_key(text, MODEL, CATEGORIZE_SYSTEM_PROMPT + CATEGORIZE_PROMPT, TEMPERATURE)
+
+    def record_category(self, text, email_content, category_info):
+        """Cache an LLM categorization, share it with the email's near-duplicate cluster and count it.
+        
+        text is the preprocessed email. Batch API replies go through here too,
+        so they are reused exactly like online ones. A reply whose category
+        could not be parsed is only counted, so the next run asks again.
+        """
+        if category_info['category'] in CATEGORIES:
+            if self.cache:
+                self.cache.set('categorize', self.categorize_cache_key(text), category_info)
+            if self.dedupe:
+                self.dedupe.remember_category(email_content, category_info)
+        self.record_llm_decision(text, category_info['category'])
+
+    def categorize_request(self, text):
+        """Chat completion parameters for categorizing already preprocessed text."""
+        return {
+            'model': MODEL,
+            'messages': [
+                {"role": "system", "content": CATEGORIZE_SYSTEM_PROMPT},
+                {"role": "user", "content": CATEGORIZE_PROMPT.format(email_content=text)}
+            ],
+            'temperature': TEMPERATURE
+        }
+
+    def parse_category(self, response_text, email_content):
+        """Turn a categorization reply into the category info dict."""
+        # Extract category and explanation
+        result = response_text.strip()
+        category = result.split('\n')[0].strip()  # First line contains the category
+        explanation = '\n'.join(result.split('\n')[1:]).strip()  # Remaining lines are explanation
+        
+        return {
+            'category': category,
+            'explanation': explanation,
+            'original_content': email_content[:200] + '...' if len(email_content) > 200 else email_content
+        }
+
+    def analyze_email(self, email_content):
+        """
+        Summarize and categorize an email with a single API call.
+        Returns the categorize_email fields plus a 'summary' key.
+        """
+        text = preprocess_email(email_content, 'analyze')
+        
+        if self.cache:
+            cache_key = self.cache.make_key(
+                text, MODEL, ANALYZE_SYSTEM_PROMPT + ANALYZE_PROMPT, TEMPERATURE)
+            cached = self.cache.get('analyze', cache_key)
+            if cached is not None:
+                return cached
+        
+        if self.dedupe:
+            clustered = self.dedupe.lookup_category(email_content, stage='analyze', need_summary=True)
+            if clustered is not None:
+                return self._with_original(clustered, email_content)
+        
+        try:
+            messages = [
+                {"role": "system", "content": ANALYZE_SYSTEM_PROMPT},
+                {"role": "user", "content": ANALYZE_PROMPT.format(email_content=text)}
+            ]
+            response = get_limiter().call_openai(
+                self.client.chat.completions.create,
+                estimate_tokens(messages),
+                model=MODEL,
+                messages=messages,
+                response_format={"type": "json_object"},
+                temperature=TEMPERATURE,
+                stage='analyze'
+            )
+            
+            result = json.loads(response.choices[0].message.content)
+            category = str(result.get('category', '')).strip().upper()
+            if category not in CATEGORIES:
+                raise ValueError(f"Unexpected category in response: {category!r}")
+            
+            analysis = {
+                'summary': result.get('summary'),
                 'category': category,
-                'explanation': explanation,
+                'explanation': str(result.get('explanation', '')).strip(),
                 'original_content': email_content[:200] + '...' if len(email_content) > 200 else email_content
             }
+            if self.cache:
+                self.cache.set('analyze', cache_key, analysis)
+            if self.dedupe:
+                self.dedupe.remember_category(email_content, analysis)
+            self.record_llm_decision(text, category)
+            return analysis
             
         except Exception as error:
-            logging.error(f"Error in categorization: {error}")
+            logging.error(f"Error in fused analysis: {error}")
             return {
+                'summary': None,
                 'category': 'ERROR',
-                'explanation': f"Error during categorization: {str(error)}",
+                'explanation': f"Error during analysis: {str(error)}",
                 'original_content': email_content[:200]
             }
 
-    def get_category_stats(self, categorized_emails):
-        """Generate statistics about email categories."""
+    def _with_original(self, category_info, email_content):
+        category_info['original_content'] = email_content[:200] + '...' if len(email_content) > 200 else email_content
+        return category_info
+
+    def record_llm_decision(self, text, category):
+        """Count an LLM categorization and log it as local model training data."""
+        with self._stats_lock:
+            self.llm_decisions += 1
+        if self.label_log and category in CATEGORIES:
+            self.label_log.append(text, category)
+
+    def get_offload_stats(self):
+        """Return how many categorizations the local model handled instead of the LLM."""
+        with self._stats_lock:
+            total = self.local_decisions + self.llm_decisions
+            return {
+                'local': self.local_decisions,
+                'llm': self.llm_decisions,
+                'offload_rate': self.local_decisions / total if total else 0.0
+            }
+
+    def get_category_stats(self, category_counts):
+        """Generate statistics about email categories from a category -> count mapping."""
         stats = {
             'HUMAN_NEEDED': 0,
             'AUTO_REPLY': 0,
@@ -69,8 +257,8 @@ class EmailCategorizer:
             'ERROR': 0
         }
         
-        for email in categorized_emails:
-            stats[email['category']] = stats.get(email['category'], 0) + 1
+        for category, count in category_counts.items():
+            stats[category] = stats.get(category, 0) + count
             
         return stats
 
@@ -78,6 +266,7 @@ def main():
     """Test function to demonstrate categorization."""
     import os
     from dotenv import load_dotenv
+    from openai import OpenAI
     
     # Load environment variables
     load_dotenv()
@@ -113,7 +302,7 @@ def main():
         
     # Print statistics
     print("\nCategory Statistics:")
-    stats = categorizer.get_category_stats(results)
+    stats = categorizer.get_category_stats(Counter(result['category'] for result in results))
     for category, count in stats.items():
         if count > 0:
             print(f"{category}: {count}")
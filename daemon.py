@@ -0,0 +1,235 @@
+import base64
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from imap_backend import IDLE_TIMEOUT
+from metrics import metrics
+from ratelimit import get_limiter
+
+# Watches expire after 7 days; Gmail recommends renewing them daily.
+WATCH_RENEW_SECONDS = 24 * 60 * 60
+
+# Adaptive polling bounds, in seconds.
+MIN_POLL_INTERVAL = 10
+MAX_POLL_INTERVAL = 300
+
+# Notifications arriving within this many seconds of each other are processed together,
+# but a burst is never held back for longer than MAX_DEBOUNCE seconds.
+DEBOUNCE_SECONDS = 2.0
+MAX_DEBOUNCE_SECONDS = 20.0
+
+class PushHandler(BaseHTTPRequestHandler):
+    """Receives Pub/Sub push deliveries of Gmail notifications and serves /metrics."""
+    def do_POST(self):
+        daemon = self.server.watch_daemon
+        if daemon.push_token and parse_qs(urlparse(self.path).query).get('token') != [daemon.push_token]:
+            self.send_response(403)
+            self.end_headers()
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            envelope = json.loads(self.rfile.read(length))
+            notification = json.loads(base64.b64decode(envelope['message']['data']))
+            daemon.notify(notification.get('historyId'))
+        except (KeyError, TypeError, ValueError) as error:
+            logging.warning(f"Ignoring malformed push notification: {error}")
+        # Acknowledge every delivery so Pub/Sub does not redeliver it
+        self.send_response(204)
+        self.end_headers()
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/metrics':
+            body = metrics.to_prometheus().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4'
+        else:
+            body = b'ok\n'
+            content_type = 'text/plain'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"Push endpoint: {format % args}")
+
+class WatchDaemon:
+    """Keeps an EmailProcessor warm and runs incremental passes as mail arrives.
+
+    With a Pub/Sub topic, Gmail push notifications delivered to the local
+    HTTP endpoint trigger passes, with a slow poll as a safety net for lost
+    notifications. Without one (or if watch() fails) the mailbox historyId
+    is polled, backing off while nothing arrives and speeding back up when
+    it does. Bursts of notifications are debounced into a single pass.
+    When the processor reads over IMAP, an idle_mailbox (a second
+    connection to the same folder) takes the place of push notifications.
+    """
+    def __init__(self, processor, topic=None, host='127.0.0.1', port=8080, push_token=None,
+                 min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL,
+                 debounce=DEBOUNCE_SECONDS, max_debounce=MAX_DEBOUNCE_SECONDS, idle_mailbox=None):
+        self.processor = processor
+        self.topic = topic
+        self.host = host
+        self.port = port
+        self.push_token = push_token
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.debounce = debounce
+        self.max_debounce = max_debounce
+        self.idle_mailbox = idle_mailbox
+        self.push_enabled = False
+        self.watch_renewed_at = None
+        self.last_history_id = None
+        self.server = None
+        self.passes = 0
+        # Whether the last pass left emails to retry, which calls for a pass even without new mail
+        self.retry_pending = False
+        self._trigger = threading.Event()
+        self._stopped = threading.Event()
+
+    @property
+    def gmail_service(self):
+        return self.processor.gmail_service
+
+    def notify(self, history_id=None):
+        """Signal that new mail may have arrived."""
+        self._trigger.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._trigger.set()
+
+    def start_server(self):
+        self.server = ThreadingHTTPServer((self.host, self.port), PushHandler)
+        self.server.watch_daemon = self
+        threading.Thread(target=self.server.serve_forever, name='push-endpoint', daemon=True).start()
+        logging.info(f"Serving push notifications and /metrics on http://{self.host}:{self.server.server_port}/")
+
+    def start_watch(self):
+        """Ask Gmail to publish inbox changes to the topic; returns whether it worked."""
+        try:
+            response = get_limiter().execute(self.gmail_service.users().watch(userId='me', body={
+                'topicName': self.topic,
+                'labelIds': ['INBOX'],
+                'labelFilterBehavior': 'include'
+            }), stage='gmail_watch')
+        except Exception as error:
+            logging.error(f"Push notifications unavailable, falling back to polling: {error}")
+            return False
+        self.watch_renewed_at = time.monotonic()
+        logging.info(f"Watching inbox via {self.topic} (historyId {response.get('historyId')})")
+        return True
+
+    def stop_watch(self):
+        try:
+            get_limiter().execute(self.gmail_service.users().stop(userId='me'), stage='gmail_watch')
+        except Exception as error:
+            logging.error(f"Error stopping watch: {error}")
+
+    def renew_watch_if_due(self):
+        if self.push_enabled and not self.idle_mailbox and time.monotonic() - self.watch_renewed_at >= WATCH_RENEW_SECONDS:
+            self.push_enabled = self.start_watch()
+
+    def start_idle(self):
+        """Watch the IMAP folder with IDLE on a background thread."""
+        threading.Thread(target=self.idle_loop, name='imap-idle', daemon=True).start()
+        logging.info(f"Watching IMAP folder {self.idle_mailbox.folder} with IDLE")
+        return True
+
+    def idle_loop(self):
+        try:
+            self.idle_mailbox.select()
+            while not self._stopped.is_set():
+                if self.idle_mailbox.idle(timeout=min(self.max_interval, IDLE_TIMEOUT)):
+                    self.notify()
+        except Exception as error:
+            logging.error(f"IMAP IDLE failed, falling back to polling: {error}")
+            self.push_enabled = False
+
+    def history_changed(self):
+        """Cheaply check whether the mailbox changed since the last check."""
+        if self.processor.imap:
+            try:
+                return self.processor.imap.has_new_mail()
+            except Exception as error:
+                logging.error(f"Error checking IMAP folder: {error}")
+                return False
+        try:
+            profile = get_limiter().execute(self.gmail_service.users().getProfile(userId='me'), stage='gmail_watch')
+        except Exception as error:
+            logging.error(f"Error checking mailbox history: {error}")
+            return False
+        changed = profile['historyId'] != self.last_history_id
+        self.last_history_id = profile['historyId']
+        return changed
+
+    def wait_for_burst(self):
+        """Keep waiting while notifications keep arriving, up to max_debounce seconds."""
+        deadline = time.monotonic() + self.max_debounce
+        while not self._stopped.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self._trigger.clear()
+            if not self._trigger.wait(min(self.debounce, remaining)):
+                return
+
+    def run_pass(self):
+        """Process newly arrived mail; returns the number of emails handled without an ERROR."""
+        self.passes += 1
+        try:
+            category_counts = self.processor.process_emails()
+        except Exception as error:
+            # Keep the daemon alive; the history checkpoint means nothing is lost
+            logging.error(f"Error in processing pass: {error}")
+            self.retry_pending = True
+            return 0
+        # Failed emails are kept for the next pass, which the poll timer runs even if no mail arrives
+        self.retry_pending = bool(self.processor.failed_ids) and not self.processor.imap
+        return sum(count for category, count in category_counts.items() if category != 'ERROR')
+
+    def run(self):
+        """Run until stop() is called (or the process is interrupted)."""
+        self.start_server()
+        if self.idle_mailbox:
+            self.push_enabled = self.start_idle()
+        elif self.topic:
+            self.push_enabled = self.start_watch()
+
+        interval = self.min_interval
+        try:
+            # Catch up on anything that arrived while the daemon was down
+            self.history_changed()
+            self.run_pass()
+
+            while not self._stopped.is_set():
+                # In push mode polling is only a safety net for lost notifications
+                triggered = self._trigger.wait(self.max_interval if self.push_enabled else interval)
+                if self._stopped.is_set():
+                    break
+                self._trigger.clear()
+                self.renew_watch_if_due()
+
+                if triggered:
+                    self.wait_for_burst()
+                    self.history_changed()
+                elif not self.history_changed() and not self.retry_pending:
+                    interval = min(self.max_interval, interval * 2)
+                    continue
+
+                processed = self.run_pass()
+                interval = self.min_interval if processed else min(self.max_interval, interval * 2)
+                if processed >= self.processor.max_emails:
+                    # The pass stopped at its limit, so go straight on to the rest of the backlog
+                    self._trigger.set()
+        except KeyboardInterrupt:
+            logging.info("Stopping watch daemon")
+        finally:
+            if self.push_enabled and not self.idle_mailbox:
+                self.stop_watch()
+            if self.server:
+                self.server.shutdown()
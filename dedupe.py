@@ -0,0 +1,274 @@
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from preprocess import strip_quoted_history
+
+# Default location of the persisted near-duplicate index.
+DEDUPE_FILE = 'clusters.db'
+
+# Minimum SimHash similarity (1 - differing bits / 64) for an email to join a cluster
+# and reuse its category, and the stricter minimum for reusing its reply.
+CLUSTER_THRESHOLD = 0.9
+REPLY_THRESHOLD = 0.95
+
+# The 64-bit SimHash is split into bands of 8 bits; clusters sharing any band
+# with an email are compared in full, which finds every match differing in up
+# to 7 bits (a similarity of 0.89).
+SIMHASH_BITS = 64
+BAND_BITS = 8
+
+# Emails with fewer words are too short to cluster reliably.
+MIN_TOKENS = 8
+
+# Characters of the masked source email kept per cluster to vet reply reuse.
+MAX_SOURCE_CHARS = 4000
+
+# Per-recipient values: email addresses, URLs and anything containing a digit
+# (order numbers, dates, amounts, codes). They are masked before hashing and
+# filled back into reused replies.
+FIELD_PATTERN = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+|https?://\S+|[\w#$€£/.:-]*\d[\w#$€£/.:,-]*")
+WORD_PATTERN = re.compile(r"[\w'<>]+")
+
+def _field_token(value):
+    if '@' in value:
+        return '<email>'
+    if value.startswith('http'):
+        return '<url>'
+    return '<num>'
+
+def mask_fields(text):
+    """Lowercase text with per-recipient fields masked, plus the fields in order."""
+    fields = []
+
+    def replace(match):
+        value = match.group(0).rstrip('.,:')
+        fields.append(value)
+        return f' {_field_token(value)} '
+
+    masked = FIELD_PATTERN.sub(replace, text)
+    return ' '.join(WORD_PATTERN.findall(masked.lower())), fields
+
+def simhash(tokens):
+    """64-bit SimHash of a token list's word trigrams."""
+    shingles = [' '.join(tokens[i:i + 3]) for i in range(max(1, len(tokens) - 2))]
+    # One bit string per shingle, most significant bit first; columns are tallied in bulk
+    rows = [format(int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big'),
+                   f'0{SIMHASH_BITS}b') for shingle in shingles]
+    half = len(rows) / 2
+    bits = ''.join('1' if ''.join(column).count('1') > half else '0' for column in zip(*rows))
+    return int(bits, 2)
+
+def _signed(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def _bands(value):
+    mask = (1 << BAND_BITS) - 1
+    return [(band, value >> (band * BAND_BITS) & mask) for band in range(SIMHASH_BITS // BAND_BITS)]
+
+def similarity(a, b):
+    return 1 - bin(a ^ b).count('1') / SIMHASH_BITS
+
+class NearDuplicateIndex:
+    """Persistent SimHash index clustering near-identical emails.
+
+    Machine-generated mail (order confirmations, appointment requests,
+    alerts) differs mostly in per-recipient fields, so those are masked and
+    the rest is hashed. The first email of a cluster is analyzed by the LLM;
+    later emails within `threshold` similarity reuse its category, and those
+    within `reply_threshold` reuse its reply with their own fields filled in.
+    """
+    def __init__(self, path=DEDUPE_FILE, threshold=CLUSTER_THRESHOLD, reply_threshold=REPLY_THRESHOLD):
+        self.threshold = threshold
+        self.reply_threshold = reply_threshold
+        self.saved = Counter()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS clusters (
+                    id INTEGER PRIMARY KEY,
+                    simhash INTEGER NOT NULL,
+                    source TEXT NOT NULL,
+                    category_info TEXT,
+                    reply TEXT,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS cluster_bands (
+                    band INTEGER NOT NULL,
+                    value INTEGER NOT NULL,
+                    cluster_id INTEGER NOT NULL,
+                    PRIMARY KEY (band, value, cluster_id)
+                ) WITHOUT ROWID
+            """)
+
+    def fingerprint(self, email_content):
+        """Masked text, fields and SimHash of an email's new content, or None if it is too short to cluster."""
+        masked, fields = mask_fields(strip_quoted_history(email_content))
+        tokens = masked.split()
+        if len(tokens) < MIN_TOKENS:
+            return None
+        return masked, fields, simhash(tokens)
+
+    def _nearest(self, value, threshold, require=None):
+        """Closest cluster row within threshold, with its similarity, or (None, 0.0).
+
+        With require set to 'category_info' or 'reply', only clusters that
+        already have one are considered.
+        """
+        bands = _bands(value)
+        query = ' OR '.join(['(band = ? AND value = ?)'] * len(bands))
+        rows = self._conn.execute(
+            f"SELECT id, simhash, source, category_info, reply FROM clusters WHERE id IN "
+            f"(SELECT cluster_id FROM cluster_bands WHERE {query})"
+            + (f" AND {require} IS NOT NULL" if require else ''),
+            [part for band in bands for part in band]).fetchall()
+        best, best_similarity = None, 0.0
+        for row in rows:
+            row_similarity = similarity(value, row[1] % (1 << 64))
+            if row_similarity >= threshold and row_similarity > best_similarity:
+                best, best_similarity = row, row_similarity
+        return best, best_similarity
+
+    def _add_cluster(self, masked, value, category_info=None, reply=None):
+        now = time.time()
+        cursor = self._conn.execute(
+            "INSERT INTO clusters (simhash, source, category_info, reply, size, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, 1, ?, ?)",
+            (_signed(value), masked[:MAX_SOURCE_CHARS],
+             json.dumps(category_info) if category_info else None, reply, now, now))
+        self._conn.executemany(
+            "INSERT INTO cluster_bands (band, value, cluster_id) VALUES (?, ?, ?)",
+            [(band, band_value, cursor.lastrowid) for band, band_value in _bands(value)])
+
+    def _touch(self, cluster_id):
+        self._conn.execute(
+            "UPDATE clusters SET size = size + 1, updated_at = ? WHERE id = ?", (time.time(), cluster_id))
+
+    def lookup_category(self, email_content, stage='categorize', need_summary=False):
+        """Category info of the email's cluster, or None if it has none yet.
+
+        With need_summary, only clusters first analyzed in fused mode (which
+        stored a summary) count.
+        """
+        fingerprint = self.fingerprint(email_content)
+        if fingerprint is None:
+            return None
+        try:
+            with self._lock, self._conn:
+                row, row_similarity = self._nearest(fingerprint[2], self.threshold, require='category_info')
+                if row is None or (need_summary and 'summary' not in json.loads(row[3])):
+                    return None
+                self._touch(row[0])
+                self.saved[stage] += 1
+        except sqlite3.Error as error:
+            logging.error(f"Error reading near-duplicate index: {error}")
+            return None
+        category_info = json.loads(row[3])
+        category_info['explanation'] = (f"Near-duplicate of cluster {row[0]} ({row_similarity:.0%} similar): "
+                                        f"{category_info['explanation']}")
+        return category_info
+
+    def remember_category(self, email_content, category_info):
+        """Store an LLM categorization on the email's cluster, starting one if needed."""
+        fingerprint = self.fingerprint(email_content)
+        if fingerprint is None:
+            return
+        masked, _, value = fingerprint
+        stored = {key: category_info[key] for key in ('category', 'explanation', 'summary') if key in category_info}
+        try:
+            with self._lock, self._conn:
+                row, _ = self._nearest(value, self.threshold)
+                if row is None:
+                    self._add_cluster(masked, value, category_info=stored)
+                elif row[3] is None:
+                    self._conn.execute(
+                        "UPDATE clusters SET category_info = ?, updated_at = ? WHERE id = ?",
+                        (json.dumps(stored), time.time(), row[0]))
+        except sqlite3.Error as error:
+            logging.error(f"Error writing to near-duplicate index: {error}")
+
+    def lookup_reply(self, email_content):
+        """The cluster's reply with this email's fields filled in, or None.
+
+        A reply is only reused when every field it mentions can be filled
+        and it contains none of the words that differ between this email
+        and the one the reply was written for.
+        """
+        fingerprint = self.fingerprint(email_content)
+        if fingerprint is None:
+            return None
+        masked, fields, value = fingerprint
+        try:
+            with self._lock, self._conn:
+                row, _ = self._nearest(value, self.reply_threshold, require='reply')
+                if row is None:
+                    return None
+                template = json.loads(row[4])
+                reply = self._fill(template, row[2], masked, fields)
+                if reply is None:
+                    return None
+                self._touch(row[0])
+                self.saved['respond'] += 1
+        except sqlite3.Error as error:
+            logging.error(f"Error reading near-duplicate index: {error}")
+            return None
+        return reply
+
+    def _fill(self, template, source, masked, fields):
+        if template['field_count'] != len(fields):
+            return None
+        differing = set(source.split()) ^ set(masked[:MAX_SOURCE_CHARS].split())
+        if differing & set(WORD_PATTERN.findall(template['text'].lower())):
+            return None
+        return re.sub(r'\{\{field_(\d+)\}\}', lambda match: fields[int(match.group(1))], template['text'])
+
+    def remember_reply(self, email_content, reply):
+        """Store a generated reply as its cluster's template, with the email's fields as placeholders."""
+        fingerprint = self.fingerprint(email_content)
+        if fingerprint is None:
+            return
+        masked, fields, value = fingerprint
+        text = reply
+        # Longest first, so a field is never replaced inside a longer one
+        for index, field in sorted(enumerate(fields), key=lambda item: -len(item[1])):
+            text = re.sub(rf'(?<![\w{{]){re.escape(field)}(?!\w)', f'{{{{field_{index}}}}}', text)
+        template = json.dumps({'text': text, 'field_count': len(fields)})
+        try:
+            with self._lock, self._conn:
+                row, _ = self._nearest(value, self.reply_threshold)
+                if row is not None and row[4] is None:
+                    self._conn.execute(
+                        "UPDATE clusters SET reply = ?, updated_at = ? WHERE id = ?",
+                        (template, time.time(), row[0]))
+                elif row is None:
+                    # A new reply cluster keeps the category of the looser cluster around it
+                    category_row, _ = self._nearest(value, self.threshold, require='category_info')
+                    category_info = json.loads(category_row[3]) if category_row else None
+                    self._add_cluster(masked, value, category_info=category_info, reply=template)
+        except sqlite3.Error as error:
+            logging.error(f"Error writing to near-duplicate index: {error}")
+
+    def get_stats(self):
+        """Return the number of clusters and the LLM calls saved per stage."""
+        with self._lock:
+            clusters = self._conn.execute("SELECT COUNT(*) FROM clusters").fetchone()[0]
+            return {
+                'clusters': clusters,
+                'saved_calls': dict(self.saved),
+                'total_saved': sum(self.saved.values())
+            }
+
+    def close(self):
+        """Close the underlying database connection."""
+        with self._lock:
+            self._conn.close()
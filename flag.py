@@ -1,64 +1,131 @@
+import json
 import logging
+import os
+import threading
 from googleapiclient.errors import HttpError
+from ratelimit import get_limiter
+
+# Gmail accepts at most 1000 message ids per batchModify call.
+BATCH_MODIFY_LIMIT = 1000
+
+# Label added to emails that need a human response.
+IMPORTANT_LABEL = 'NEEDS_HUMAN_RESPONSE'
+
+# Stores the label's id, so runs don't have to look it up with labels.list.
+LABEL_FILE = 'labels.json'
 
 class EmailFlagger:
-    def __init__(self, gmail_service):
+    def __init__(self, gmail_service, label_file=LABEL_FILE):
         self.gmail_service = gmail_service
-        self.important_label_id = self._get_or_create_label()
+        self.label_file = label_file
+        # Resolved on first use, from label_file or the API
+        self._label_id = None
+        self._label_lock = threading.Lock()
+        # message id -> pending label delta and the results waiting on it
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+
+    @property
+    def important_label_id(self):
+        """Id of the NEEDS_HUMAN_RESPONSE label, from label_file or looked up (and saved) on first use."""
+        with self._label_lock:
+            if self._label_id is None:
+                self._label_id = self._load_label_id()
+                if self._label_id is None:
+                    self._label_id = self._get_or_create_label()
+                    if self._label_id is not None:
+                        self._save_label_id(self._label_id)
+            return self._label_id
+
+    def _load_label_id(self):
+        if not self.label_file or not os.path.exists(self.label_file):
+            return None
+        try:
+            with open(self.label_file) as label_file:
+                return json.load(label_file).get(IMPORTANT_LABEL)
+        except (OSError, ValueError) as error:
+            logging.error(f"Error reading label file: {error}")
+            return None
+
+    def _save_label_id(self, label_id):
+        if not self.label_file:
+            return
+        try:
+            with open(self.label_file, 'w') as label_file:
+                json.dump({IMPORTANT_LABEL: label_id}, label_file)
+        except OSError as error:
+            logging.error(f"Error saving label file: {error}")
+
+    def forget_label_id(self):
+        """Drop a stored label id Gmail rejected (e.g. the label was deleted) so it is looked up again."""
+        with self._label_lock:
+            self._label_id = None
+            if self.label_file and os.path.exists(self.label_file):
+                os.remove(self.label_file)
 
     def _get_or_create_label(self):
         """Get or create a custom label for important emails."""
         try:
             # Try to find existing label
-            results = self.gmail_service.users().labels().list(userId='me').execute()
+            results = get_limiter().execute(self.gmail_service.users().labels().list(userId='me'), stage='flag')
             labels = results.get('labels', [])
             
             for label in labels:
-                if label['name'] == 'NEEDS_HUMAN_RESPONSE':
+                if label['name'] == IMPORTANT_LABEL:
                     return label['id']
             
             # Create new label if it doesn't exist
             label_object = {
-                'name': 'NEEDS_HUMAN_RESPONSE',
+                'name': IMPORTANT_LABEL,
                 'labelListVisibility': 'labelShow',
                 'messageListVisibility': 'show',
                 'backgroundColor': '#fb4c2f',  # Red background
                 'textColor': '#ffffff'         # White text
             }
             
-            created_label = self.gmail_service.users().labels().create(
+            created_label = get_limiter().execute(self.gmail_service.users().labels().create(
                 userId='me',
                 body=label_object
-            ).execute()
+            ), stage='flag', idempotent=False)
             
-            logging.info("Created new label: NEEDS_HUMAN_RESPONSE")
+            logging.info(f"Created new label: {IMPORTANT_LABEL}")
             return created_label['id']
             
         except Exception as error:
             logging.error(f"Error managing labels: {error}")
             return None
 
-    def flag_important_email(self, message_id):
+    def _missing_label(self, message_id):
+        logging.error(f"Error flagging email {message_id}: could not get or create the {IMPORTANT_LABEL} label")
+        return {
+            'success': False,
+            'error': f'Could not get or create the {IMPORTANT_LABEL} label'
+        }
+
+    def flag_important_email(self, message_id, retry=True):
         """Flag an email as important and needing human response."""
+        label_id = self.important_label_id
+        if label_id is None:
+            return self._missing_label(message_id)
         try:
             # Mark as important
-            self.gmail_service.users().messages().modify(
+            get_limiter().execute(self.gmail_service.users().messages().modify(
                 userId='me',
                 id=message_id,
                 body={
-                    'addLabelIds': ['IMPORTANT', self.important_label_id],
+                    'addLabelIds': ['IMPORTANT', label_id],
                     'removeLabelIds': ['UNIMPORTANT']
                 }
-            ).execute()
+            ), stage='flag')
             
             # Star the message
-            self.gmail_service.users().messages().modify(
+            get_limiter().execute(self.gmail_service.users().messages().modify(
                 userId='me',
                 id=message_id,
                 body={
                     'addLabelIds': ['STARRED']
                 }
-            ).execute()
+            ), stage='flag')
             
             return {
                 'success': True,
@@ -66,6 +133,9 @@ class EmailFlagger:
             }
             
         except HttpError as error:
+            if retry and is_invalid_label(error):
+                self.forget_label_id()
+                return self.flag_important_email(message_id, retry=False)
             logging.error(f"Error flagging email {message_id}: {error}")
             return {
                 'success': False,
@@ -76,14 +146,14 @@ class EmailFlagger:
         """Move an email to spam folder."""
         try:
             # Move to spam
-            self.gmail_service.users().messages().modify(
+            get_limiter().execute(self.gmail_service.users().messages().modify(
                 userId='me',
                 id=message_id,
                 body={
                     'addLabelIds': ['SPAM'],
                     'removeLabelIds': ['INBOX', 'UNSPAM']
                 }
-            ).execute()
+            ), stage='flag')
             
             return {
                 'success': True,
@@ -97,6 +167,97 @@ class EmailFlagger:
                 'error': str(error)
             }
 
+    def queue_label_change(self, message_id, add_labels=(), remove_labels=(), result=None):
+        """Queue a label change, merging it with any already pending for the message."""
+        with self._pending_lock:
+            pending = self._pending.setdefault(
+                message_id, {'add': set(), 'remove': set(), 'results': []})
+            # Later changes win over earlier ones for the same label
+            pending['add'] = (pending['add'] - set(remove_labels)) | set(add_labels)
+            pending['remove'] = (pending['remove'] - set(add_labels)) | set(remove_labels)
+            if result is not None:
+                pending['results'].append(result)
+        return result
+
+    def queue_flag_important(self, message_id):
+        """Queue flagging an email as important and needing human response.
+        
+        Returns a result dict that is updated in place when the queue is flushed.
+        Nothing is queued if the label could not be looked up or created.
+        """
+        label_id = self.important_label_id
+        if label_id is None:
+            return self._missing_label(message_id)
+        return self.queue_label_change(
+            message_id,
+            add_labels=['IMPORTANT', label_id, 'STARRED'],
+            remove_labels=['UNIMPORTANT'],
+            result={
+                'success': True,
+                'message': f'Email {message_id} flagged as important and requiring human response'
+            }
+        )
+
+    def queue_spam(self, message_id):
+        """Queue moving an email to the spam folder.
+        
+        Returns a result dict that is updated in place when the queue is flushed.
+        """
+        return self.queue_label_change(
+            message_id,
+            add_labels=['SPAM'],
+            remove_labels=['INBOX', 'UNSPAM'],
+            result={
+                'success': True,
+                'message': f'Email {message_id} marked as spam'
+            }
+        )
+
+    def pending_count(self):
+        """Number of messages with queued label changes."""
+        with self._pending_lock:
+            return len(self._pending)
+
+    def flush(self):
+        """Apply all queued label changes with as few batchModify calls as possible.
+        
+        Messages with identical label deltas are grouped into one call of up
+        to BATCH_MODIFY_LIMIT ids. Returns the number of API calls made.
+        """
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        
+        groups = {}
+        for message_id, change in pending.items():
+            delta = (frozenset(change['add']), frozenset(change['remove']))
+            groups.setdefault(delta, []).append(message_id)
+        
+        calls = 0
+        for (add_labels, remove_labels), message_ids in groups.items():
+            for start in range(0, len(message_ids), BATCH_MODIFY_LIMIT):
+                chunk = message_ids[start:start + BATCH_MODIFY_LIMIT]
+                calls += 1
+                try:
+                    get_limiter().execute(self.gmail_service.users().messages().batchModify(
+                        userId='me',
+                        body={
+                            'ids': chunk,
+                            'addLabelIds': sorted(add_labels),
+                            'removeLabelIds': sorted(remove_labels)
+                        }
+                    ), stage='flag')
+                except Exception as error:
+                    # One failed group must not lose the changes of the others
+                    logging.error(f"Error modifying labels for {len(chunk)} emails: {error}")
+                    if is_invalid_label(error):
+                        self.forget_label_id()
+                    for message_id in chunk:
+                        for result in pending[message_id]['results']:
+                            result.pop('message', None)
+                            result.update({'success': False, 'error': str(error)})
+        
+        return calls
+
     def process_emails(self, categorized_emails):
         """Process all emails based on their category."""
         results = []
@@ -109,34 +270,40 @@ class EmailFlagger:
             
             if email['category'] == 'HUMAN_NEEDED':
                 logging.info(f"Flagging email {email['id']} as needing human response")
-                flag_result = self.flag_important_email(email['id'])
                 result.update({
                     'action': 'flag_important',
-                    'success': flag_result['success'],
-                    'details': flag_result
+                    'details': self.queue_flag_important(email['id'])
                 })
                 
             elif email['category'] == 'NO_RESPONSE':
                 logging.info(f"Moving email {email['id']} to spam")
-                spam_result = self.mark_as_spam(email['id'])
                 result.update({
                     'action': 'mark_spam',
-                    'success': spam_result['success'],
-                    'details': spam_result
+                    'details': self.queue_spam(email['id'])
                 })
             
             results.append(result)
-            
+        
+        # Apply all label changes together
+        self.flush()
+        
+        for result in results:
+            if 'details' not in result:
+                continue
+            result['success'] = result['details']['success']
             if result['success']:
-                logging.info(f"Successfully processed email {email['id']}")
+                logging.info(f"Successfully processed email {result['email_id']}")
             else:
-                logging.error(f"Failed to process email {email['id']}")
+                logging.error(f"Failed to process email {result['email_id']}")
         
         return results
 
+def is_invalid_label(error):
+    """Whether Gmail rejected a label change because a label id no longer exists."""
+    return getattr(getattr(error, 'resp', None), 'status', None) in (400, 404) and 'label' in str(error).lower()
+
 def main():
     """Test function to demonstrate email flagging and spam marking."""
-    import os
     from dotenv import load_dotenv
     from read_gmail import authenticate_gmail
     
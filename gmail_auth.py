@@ -0,0 +1,65 @@
+import json
+import logging
+import os.path
+import threading
+from google.oauth2.credentials import Credentials
+
+class SharedCredentials(Credentials):
+    """OAuth credentials shared by many transports and threads.
+
+    Refreshes happen one at a time under a lock. A thread that finds the
+    token was replaced while it waited, or since it sent its request,
+    reuses the new token instead of refreshing again. Refreshed tokens are written back
+    to token_file, if set.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.token_file = None
+        self._refresh_lock = threading.Lock()
+        self._local = threading.local()
+
+    def before_request(self, request, method, url, headers):
+        if not self.valid:
+            self.refresh(request)
+        # Remember the token this thread sends, to tell a stale 401 from a new one
+        self._local.token = self.token
+        self.apply(headers, token=self._local.token)
+
+    def refresh(self, request):
+        # The token this thread last sent, else the one current before waiting for the lock
+        used = getattr(self._local, 'token', None) or self.token
+        with self._refresh_lock:
+            if self.valid and used != self.token:
+                return
+            super().refresh(request)
+            if self.token_file:
+                try:
+                    with open(self.token_file, 'w') as token:
+                        token.write(self.to_json())
+                except OSError as error:
+                    logging.error(f"Error saving refreshed token: {error}")
+
+def load_credentials(token_file, credentials_file, scopes):
+    """Load a mailbox's saved credentials, refreshing them or running the browser consent flow if needed."""
+    creds = None
+    # The token file stores the user's access and refresh tokens, and is
+    # created automatically when the authorization flow completes for the first
+    # time.
+    if os.path.exists(token_file):
+        creds = SharedCredentials.from_authorized_user_file(token_file, scopes)
+    # If there are no (valid) credentials available, let the user log in.
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            from google.auth.transport.requests import Request
+            creds.refresh(Request())
+        else:
+            from google_auth_oauthlib.flow import InstalledAppFlow
+            flow = InstalledAppFlow.from_client_secrets_file(
+                credentials_file, scopes)
+            creds = SharedCredentials.from_authorized_user_info(
+                json.loads(flow.run_local_server(port=0).to_json()), scopes)
+        # Save the credentials for the next run
+        with open(token_file, 'w') as token:
+            token.write(creds.to_json())
+    creds.token_file = token_file
+    return creds
@@ -0,0 +1,414 @@
+import email
+import imaplib
+import json
+import logging
+import os
+import queue
+import re
+import select
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.header import decode_header, make_header
+from mime import NO_TEXT_CONTENT, html_to_text
+
+IMAP_HOST = 'imap.gmail.com'
+IMAP_PORT = 993
+
+# Stores the UIDVALIDITY and last seen UID per folder for incremental syncs.
+IMAP_STATE_FILE = 'imap_state.json'
+
+# UIDs requested per FETCH command.
+FETCH_BATCH_SIZE = 200
+
+# Bytes of the message text fetched; enough for the first text part of most mail.
+TEXT_PREVIEW_BYTES = 16 * 1024
+
+# Headers fetched for each message: what the header rules and replies need.
+HEADER_FIELDS = (
+    'FROM', 'TO', 'SUBJECT', 'DATE', 'MESSAGE-ID', 'IN-REPLY-TO', 'REFERENCES',
+    'CONTENT-TYPE', 'CONTENT-TRANSFER-ENCODING', 'LIST-UNSUBSCRIBE', 'LIST-ID',
+    'PRECEDENCE', 'AUTO-SUBMITTED', 'X-AUTOREPLY', 'X-AUTORESPOND'
+)
+
+# Gmail allows at most 15 simultaneous IMAP connections per account.
+MAX_IMAP_CONNECTIONS = 15
+
+# Times a batch is retried, on a fresh connection if the old one dropped.
+MAX_FETCH_RETRIES = 3
+
+# Servers may drop an IDLE after 30 minutes, so it is re-issued before that (RFC 2177).
+IDLE_TIMEOUT = 29 * 60
+
+FETCH_START = re.compile(rb'^\d+ \(')
+EXISTS_RESPONSE = re.compile(rb'^\* \d+ EXISTS')
+
+def connect_imap(user, password, host=IMAP_HOST, port=IMAP_PORT, use_ssl=True):
+    """Open and log in to an IMAP connection; use_ssl=False allows a local stand-in server."""
+    imap = imaplib.IMAP4_SSL(host, port) if use_ssl else imaplib.IMAP4(host, port)
+    imap.login(user, password)
+    return imap
+
+def connect_from_env():
+    """Connect using IMAP_HOST, IMAP_PORT, IMAP_SSL, IMAP_USER and IMAP_PASSWORD."""
+    user, password = os.getenv('IMAP_USER'), os.getenv('IMAP_PASSWORD')
+    if not user or not password:
+        raise ValueError("Please set the IMAP_USER and IMAP_PASSWORD environment variables")
+    return connect_imap(
+        user, password,
+        host=os.getenv('IMAP_HOST', IMAP_HOST),
+        port=int(os.getenv('IMAP_PORT', IMAP_PORT)),
+        use_ssl=os.getenv('IMAP_SSL', '1').lower() not in ('0', 'false', 'no')
+    )
+
+def message_set(uids):
+    """Compress UIDs into an IMAP message set such as '1:5,8,10:12'."""
+    ranges = []
+    for uid in sorted(set(uids)):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(start) if start == end else f'{start}:{end}' for start, end in ranges)
+
+def _decode_header_value(value):
+    try:
+        return str(make_header(decode_header(value)))
+    except (UnicodeDecodeError, LookupError):
+        return value
+
+def _part_text(part):
+    payload = part.get_payload(decode=True) or b''
+    charset = part.get_content_charset() or 'utf-8'
+    try:
+        return payload.decode(charset, errors='replace')
+    except LookupError:
+        return payload.decode('utf-8', errors='replace')
+
+def extract_body(message):
+    """First text/plain part of a (possibly truncated) message, else its HTML as text."""
+    html = None
+    for part in message.walk():
+        if part.is_multipart() or part.get_filename():
+            continue
+        content_type = part.get_content_type()
+        if content_type == 'text/plain':
+            return _part_text(part)
+        if content_type == 'text/html' and html is None:
+            html = html_to_text(_part_text(part))
+    return html if html is not None else NO_TEXT_CONTENT
+
+def parse_fetch_response(data):
+    """Group a UID FETCH response into {uid: {'meta', 'header', 'text'}} by message."""
+    messages = []
+    for item in data:
+        meta, literal = item if isinstance(item, tuple) else (item, None)
+        if not meta:
+            continue
+        if FETCH_START.match(meta) or not messages:
+            messages.append({'meta': b'', 'header': b'', 'text': b''})
+        current = messages[-1]
+        current['meta'] += meta
+        if literal is not None:
+            section = meta.rsplit(b'BODY[', 1)[-1]
+            if section.startswith(b'HEADER'):
+                current['header'] = literal
+            elif section.startswith(b'TEXT'):
+                current['text'] = literal
+
+    parsed = {}
+    for message in messages:
+        uid = re.search(rb'UID (\d+)', message['meta'])
+        if uid:
+            parsed[int(uid.group(1))] = message
+    return parsed
+
+class ImapMailbox:
+    """Reads an IMAP folder with batched, read-only fetches and UID-based incremental sync.
+
+    Messages are fetched with BODY.PEEK, so they are never marked as read,
+    and only the headers the pipeline uses plus the first text_bytes of the
+    body are transferred. Messages come back as Gmail-style resources so the
+    rest of the pipeline can treat them like Gmail API messages; on Gmail's
+    IMAP server the ids are the Gmail API message and thread ids.
+    """
+    def __init__(self, imap, folder='INBOX', state_file=IMAP_STATE_FILE,
+                 text_bytes=TEXT_PREVIEW_BYTES, batch_size=FETCH_BATCH_SIZE):
+        self.imap = imap
+        self.folder = folder
+        self.state_file = state_file
+        self.text_bytes = text_bytes
+        self.batch_size = batch_size
+        self.uidvalidity = None
+        self.gmail_extensions = 'X-GM-EXT-1' in getattr(imap, 'capabilities', ())
+        self._lock = threading.RLock()
+
+    @property
+    def chunk_size(self):
+        """UIDs worth listing at a time: one FETCH."""
+        return self.batch_size
+
+    def close(self):
+        try:
+            self.imap.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+
+    def _check(self, response, command):
+        typ, data = response
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f"{command} failed: {data}")
+        return data
+
+    def select(self):
+        """(Re)open the folder read-only and return its UIDVALIDITY."""
+        folder = f'"{self.folder}"' if ' ' in self.folder else self.folder
+        with self._lock:
+            self._check(self.imap.select(folder, readonly=True), 'SELECT')
+            _, values = self.imap.response('UIDVALIDITY')
+        self.uidvalidity = int(values[0]) if values and values[0] else None
+        return self.uidvalidity
+
+    def search_uids(self, min_uid=1):
+        """UIDs of the folder's messages from min_uid upwards, in ascending order."""
+        with self._lock:
+            data = self._check(self.imap.uid('SEARCH', None, f'UID {min_uid}:*'), 'SEARCH')
+        # "n:*" always matches the last message, even when its UID is below n
+        return sorted(uid for uid in map(int, data[0].split()) if uid >= min_uid)
+
+    def fetch_items(self):
+        items = 'UID RFC822.SIZE'
+        if self.gmail_extensions:
+            items += ' X-GM-MSGID X-GM-THRID'
+        return (f'({items} BODY.PEEK[HEADER.FIELDS ({" ".join(HEADER_FIELDS)})] '
+                f'BODY.PEEK[TEXT]<0.{self.text_bytes}>)')
+
+    def fetch(self, uids):
+        """Fetch many messages with one FETCH per batch of UID ranges.
+
+        Returns a dict mapping each UID to a (message, body) pair, where
+        message is a Gmail-style resource with the fetched headers.
+        """
+        uids = list(uids)
+        fetched = {}
+        for start in range(0, len(uids), self.batch_size):
+            batch = uids[start:start + self.batch_size]
+            with self._lock:
+                data = self._check(self.imap.uid('FETCH', message_set(batch), self.fetch_items()), 'FETCH')
+            for uid, response in parse_fetch_response(data).items():
+                try:
+                    fetched[uid] = self.build_message(uid, response)
+                except Exception as error:
+                    logging.error(f"Error decoding IMAP message {uid}: {error}")
+        return fetched
+
+    def build_message(self, uid, response):
+        parsed = email.message_from_bytes(response['header'] + response['text'])
+        headers = [{'name': name, 'value': _decode_header_value(value)}
+                   for name, value in email.message_from_bytes(response['header']).items()]
+        body = extract_body(parsed)
+
+        msg_id = thread_id = f'imap-{self.uidvalidity}-{uid}'
+        gm_msgid = re.search(rb'X-GM-MSGID (\d+)', response['meta'])
+        gm_thrid = re.search(rb'X-GM-THRID (\d+)', response['meta'])
+        if gm_msgid:
+            # Gmail API ids are the hex form of Gmail's IMAP message and thread ids
+            msg_id = format(int(gm_msgid.group(1)), 'x')
+            thread_id = format(int(gm_thrid.group(1)), 'x') if gm_thrid else msg_id
+        size = re.search(rb'RFC822\.SIZE (\d+)', response['meta'])
+
+        message = {
+            'id': msg_id,
+            'threadId': thread_id,
+            'uid': uid,
+            'labelIds': ['INBOX'] if self.folder.upper() == 'INBOX' else [],
+            'snippet': ' '.join(body.split())[:200],
+            'sizeEstimate': int(size.group(1)) if size else None,
+            'payload': {'headers': headers}
+        }
+        return message, body
+
+    def load_state(self):
+        if not self.state_file or not os.path.exists(self.state_file):
+            return None
+        try:
+            with open(self.state_file) as state_file:
+                return json.load(state_file).get(self.folder)
+        except (OSError, ValueError) as error:
+            logging.warning(f"Ignoring unreadable IMAP checkpoint: {error}")
+            return None
+
+    def save_state(self, last_uid):
+        if not self.state_file:
+            return
+        state = {}
+        if os.path.exists(self.state_file):
+            with open(self.state_file) as state_file:
+                state = json.load(state_file)
+        state[self.folder] = {'uidvalidity': self.uidvalidity, 'last_uid': last_uid}
+        with open(self.state_file, 'w') as state_file:
+            json.dump(state, state_file)
+
+    def latest_uids(self, max_results=None):
+        """UIDs of the newest max_results messages in the folder, newest first."""
+        self.select()
+        uids = self.search_uids()
+        return list(reversed(uids[-max_results:] if max_results else uids))
+
+    def sync_uids(self, max_results=None):
+        """Yield the UIDs to process: those added since the last sync, oldest first.
+
+        Without a checkpoint, or when the folder's UIDVALIDITY changed, the
+        newest max_results messages are yielded (newest first) and tracking
+        starts from the current state, like the Gmail history sync. The
+        checkpoint advances as UIDs are consumed.
+        """
+        self.select()
+        state = self.load_state()
+        if state is None or state.get('uidvalidity') != self.uidvalidity:
+            uids = self.search_uids()
+            self.save_state(uids[-1] if uids else 0)
+            yield from reversed(uids[-max_results:] if max_results else uids)
+            return
+
+        uids = self.search_uids(state['last_uid'] + 1)
+        for uid in uids[:max_results] if max_results else uids:
+            self.save_state(uid)
+            yield uid
+
+    def has_new_mail(self):
+        """Cheaply check for messages newer than the checkpoint."""
+        self.select()
+        state = self.load_state()
+        if state is None or state.get('uidvalidity') != self.uidvalidity:
+            return True
+        return bool(self.search_uids(state['last_uid'] + 1))
+
+    def idle(self, timeout=IDLE_TIMEOUT):
+        """Wait in IDLE until the server reports a new message; returns False on timeout.
+
+        The folder must be selected. Use a dedicated connection, since the
+        connection cannot run other commands while idling.
+        """
+        with self._lock:
+            tag = self.imap._new_tag()
+            self.imap.send(tag + b' IDLE\r\n')
+            if not self.imap.readline().startswith(b'+'):
+                raise imaplib.IMAP4.error("Server does not support IDLE")
+            arrived = False
+            deadline = time.monotonic() + timeout
+            sock = self.imap.sock
+            try:
+                while not arrived:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    pending = getattr(sock, 'pending', lambda: 0)()
+                    if not pending and not select.select([sock], [], [], min(remaining, 1.0))[0]:
+                        continue
+                    line = self.imap.readline()
+                    if not line:
+                        raise imaplib.IMAP4.abort("Connection closed during IDLE")
+                    arrived = bool(EXISTS_RESPONSE.match(line))
+            finally:
+                self.imap.send(b'DONE\r\n')
+                while not self.imap.readline().startswith(tag):
+                    pass
+            return arrived
+
+class ImapPool:
+    """Fetches over several IMAP connections in parallel, for large backfills.
+
+    Listing, checkpoints and IDLE checks go through the first connection,
+    exactly like a single ImapMailbox. fetch() splits the UIDs into
+    contiguous ranges of batch_size and spreads them over up to
+    `connections` connections, each opened on demand with connect(). A
+    dropped connection is reopened and its batch retried; each connection
+    waits min_interval seconds between its FETCH commands, and doubles that
+    wait whenever the server reports it is being throttled.
+    """
+    def __init__(self, connect, connections=4, folder='INBOX', state_file=IMAP_STATE_FILE,
+                 text_bytes=TEXT_PREVIEW_BYTES, batch_size=FETCH_BATCH_SIZE, min_interval=0.0):
+        self.connect = connect
+        self.connections = max(1, min(connections, MAX_IMAP_CONNECTIONS))
+        self.folder = folder
+        self.text_bytes = text_bytes
+        self.batch_size = batch_size
+        self.min_interval = min_interval
+        self.primary = ImapMailbox(connect(), folder, state_file, text_bytes, batch_size)
+        self.executor = ThreadPoolExecutor(max_workers=self.connections, thread_name_prefix='imap')
+        # Worker connections that are open and not in use
+        self._available = queue.Queue()
+        self._open = []
+
+    def __getattr__(self, name):
+        return getattr(self.primary, name)
+
+    @property
+    def chunk_size(self):
+        """UIDs worth listing at a time: one FETCH per connection."""
+        return self.batch_size * self.connections
+
+    def open_mailbox(self):
+        mailbox = ImapMailbox(self.connect(), self.folder, None, self.text_bytes, self.batch_size)
+        mailbox.select()
+        if mailbox.uidvalidity != self.primary.uidvalidity:
+            mailbox.close()
+            raise imaplib.IMAP4.error(f"UIDVALIDITY of {self.folder} changed during the backfill")
+        mailbox.interval = self.min_interval
+        mailbox.last_fetch = 0.0
+        self._open.append(mailbox)
+        return mailbox
+
+    def discard(self, mailbox):
+        self._open.remove(mailbox)
+        mailbox.close()
+
+    def fetch_batch(self, uids):
+        try:
+            mailbox = self._available.get_nowait()
+        except queue.Empty:
+            mailbox = self.open_mailbox()
+
+        for attempt in range(MAX_FETCH_RETRIES + 1):
+            time.sleep(max(0.0, mailbox.last_fetch + mailbox.interval - time.monotonic()))
+            try:
+                fetched = mailbox.fetch(uids)
+                mailbox.last_fetch = time.monotonic()
+                self._available.put(mailbox)
+                return fetched
+            except (imaplib.IMAP4.abort, OSError) as error:
+                if attempt == MAX_FETCH_RETRIES:
+                    self.discard(mailbox)
+                    raise
+                logging.warning(f"IMAP connection dropped ({error}); reconnecting")
+                self.discard(mailbox)
+                time.sleep(2 ** attempt)
+                mailbox = self.open_mailbox()
+            except imaplib.IMAP4.error as error:
+                if 'THROTTLED' not in str(error).upper() or attempt == MAX_FETCH_RETRIES:
+                    self._available.put(mailbox)
+                    raise
+                mailbox.interval = max(1.0, mailbox.interval * 2)
+                logging.warning(f"IMAP connection throttled; waiting {mailbox.interval:.0f}s between fetches")
+                mailbox.last_fetch = time.monotonic()
+
+    def fetch(self, uids):
+        """Fetch many messages, with the UID ranges spread over the pool's connections.
+
+        Returns the same {uid: (message, body)} dict as ImapMailbox.fetch.
+        """
+        uids = sorted(uids)
+        batches = [uids[start:start + self.batch_size] for start in range(0, len(uids), self.batch_size)]
+        if len(batches) <= 1:
+            return self.primary.fetch(uids)
+        fetched = {}
+        for result in self.executor.map(self.fetch_batch, batches):
+            fetched.update(result)
+        return fetched
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for mailbox in self._open + [self.primary]:
+            mailbox.close()
+        self._open = []
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+# Default location of the per-message job journal.
+JOURNAL_FILE = 'journal.db'
+
+# Stages recorded per message, in pipeline order; `done` means every action succeeded.
+STAGES = ('fetched', 'analyzed', 'responded', 'labeled', 'done')
+
+def reply_message_id(msg_id):
+    """Deterministic Message-ID for the auto-reply to a message, used as its idempotency key."""
+    digest = hashlib.sha256(msg_id.encode('utf-8')).hexdigest()[:32]
+    return f'<{digest}.autoreply@email-processor>'
+
+def result_done(result):
+    """Whether every action for a finished result succeeded: its reply was sent or its label applied."""
+    category = result['category']
+    if category == 'AUTO_REPLY':
+        return result.get('auto_response', {}).get('send_success', False)
+    if category in ('HUMAN_NEEDED', 'NO_RESPONSE'):
+        status = result.get('flag_status') or result.get('spam_status') or {}
+        return status.get('success', False)
+    return False
+
+class JobJournal:
+    """Crash-safe SQLite record of how far each message got through the pipeline.
+
+    A restarted run skips messages that are done, reuses stored summaries,
+    categories and reply texts instead of calling the LLM again, and never
+    repeats a send or label change that already went through. Sends are
+    recorded as started before the API call; if a run dies before the send
+    is confirmed, the next run looks for the reply's deterministic
+    Message-ID in the mailbox before sending again.
+    """
+    def __init__(self, path=JOURNAL_FILE):
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            # WAL keeps every committed stage on disk without blocking readers
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    msg_id TEXT PRIMARY KEY,
+                    summary TEXT,
+                    category_info TEXT,
+                    response_text TEXT,
+                    send_key TEXT,
+                    sent_id TEXT,
+                    fetched_at REAL,
+                    analyzed_at REAL,
+                    responded_at REAL,
+                    labeled_at REAL,
+                    done_at REAL
+                )
+            """)
+
+    def _update(self, msg_id, **columns):
+        assignments = ', '.join(f'{column} = ?' for column in columns)
+        try:
+            with self._lock, self._conn:
+                self._conn.execute("INSERT OR IGNORE INTO jobs (msg_id) VALUES (?)", (msg_id,))
+                self._conn.execute(f"UPDATE jobs SET {assignments} WHERE msg_id = ?", (*columns.values(), msg_id))
+        except sqlite3.Error as error:
+            logging.error(f"Error writing to job journal: {error}")
+
+    def get(self, msg_id):
+        """The journal entry for a message as a dict, or an empty dict if it has none."""
+        with self._lock:
+            cursor = self._conn.execute("SELECT * FROM jobs WHERE msg_id = ?", (msg_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return {}
+            job = dict(zip((column[0] for column in cursor.description), row))
+        job['category_info'] = json.loads(job['category_info']) if job['category_info'] else None
+        return job
+
+    def done_ids(self, msg_ids):
+        """The subset of msg_ids whose every stage is done."""
+        msg_ids = list(msg_ids)
+        if not msg_ids:
+            return set()
+        with self._lock:
+            done = {row[0] for row in self._conn.execute(
+                f"SELECT msg_id FROM jobs WHERE done_at IS NOT NULL AND msg_id IN ({','.join('?' * len(msg_ids))})",
+                msg_ids)}
+            self.stats['skipped'] += len(done)
+        return done
+
+    def record_fetched(self, msg_ids):
+        now = time.time()
+        try:
+            with self._lock, self._conn:
+                self._conn.executemany(
+                    "INSERT INTO jobs (msg_id, fetched_at) VALUES (?, ?) "
+                    "ON CONFLICT (msg_id) DO UPDATE SET fetched_at = COALESCE(fetched_at, excluded.fetched_at)",
+                    [(msg_id, now) for msg_id in msg_ids])
+        except sqlite3.Error as error:
+            logging.error(f"Error writing to job journal: {error}")
+
+    def record_analysis(self, msg_id, summary, category_info):
+        stored = {key: category_info[key] for key in ('category', 'explanation') if key in category_info}
+        self._update(msg_id, summary=summary, category_info=json.dumps(stored), analyzed_at=time.time())
+
+    def resume_analysis(self, msg_id):
+        """The stored (summary, category_info) of an analyzed message, or (None, None)."""
+        job = self.get(msg_id)
+        if not job.get('analyzed_at'):
+            return None, None
+        with self._lock:
+            self.stats['resumed'] += 1
+        return job['summary'], job['category_info']
+
+    def record_response(self, msg_id, response_text):
+        self._update(msg_id, response_text=response_text)
+
+    def begin_send(self, msg_id):
+        """Record that a reply is about to be sent; returns (send_key, whether an earlier attempt was started)."""
+        job = self.get(msg_id)
+        send_key = reply_message_id(msg_id)
+        if not job.get('send_key'):
+            self._update(msg_id, send_key=send_key)
+        return send_key, bool(job.get('send_key'))
+
+    def record_sent(self, msg_id, sent_id):
+        self._update(msg_id, sent_id=sent_id, responded_at=time.time())
+
+    def record_labeled(self, msg_id):
+        self._update(msg_id, labeled_at=time.time())
+
+    def record_result(self, result):
+        """Mark a finished result's stages; it is done once its action succeeded."""
+        if not result_done(result):
+            return
+        if result['category'] != 'AUTO_REPLY':
+            self.record_labeled(result['id'])
+        self._update(result['id'], done_at=time.time())
+
+    def unfinished_ids(self):
+        """Ids of fetched messages that failed or never finished, oldest first."""
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                "SELECT msg_id FROM jobs WHERE done_at IS NULL AND fetched_at IS NOT NULL ORDER BY fetched_at")]
+
+    def get_stats(self):
+        """Messages skipped as already done and analyses resumed from the journal."""
+        with self._lock:
+            return {'skipped': self.stats['skipped'], 'resumed': self.stats['resumed']}
+
+    def close(self):
+        """Close the underlying database connection."""
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,209 @@
+import json
+import math
+import random
+import re
+import struct
+import threading
+import zlib
+from array import array
+from collections import Counter
+
+# Default locations of the LLM categorization log and the trained model.
+LABEL_LOG_FILE = 'categorizations.jsonl'
+MODEL_FILE = 'category_model.bin'
+
+# Number of hashed feature buckets.
+N_FEATURES = 2 ** 16
+
+# Minimum confidence for the local model's answer to be used instead of the LLM.
+CONFIDENCE_THRESHOLD = 0.9
+
+# Labelled emails needed in every category before a model is trained.
+MIN_EXAMPLES_PER_CATEGORY = 20
+
+MODEL_MAGIC = b'SRTNB1'
+TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+
+def hash_features(text, n_features=N_FEATURES):
+    """Map text to hashed unigram and bigram bucket counts."""
+    tokens = TOKEN_PATTERN.findall(text.lower())
+    counts = {}
+    for token in tokens + [f'{a} {b}' for a, b in zip(tokens, tokens[1:])]:
+        bucket = zlib.crc32(token.encode('utf-8')) % n_features
+        counts[bucket] = counts.get(bucket, 0) + 1
+    return counts
+
+class NaiveBayesModel:
+    """Multinomial naive Bayes over hashed features, stored as float32 arrays."""
+    def __init__(self, classes, n_features=N_FEATURES, log_priors=None, feature_log_probs=None,
+                 class_counts=None):
+        self.classes = list(classes)
+        self.n_features = n_features
+        self.log_priors = log_priors or [0.0] * len(self.classes)
+        self.feature_log_probs = feature_log_probs or [
+            array('f', [0.0]) * n_features for _ in self.classes]
+        # Training examples per class; None for models saved before counts were recorded
+        self.class_counts = class_counts
+
+    @classmethod
+    def fit(cls, examples, classes=(), n_features=N_FEATURES, alpha=1.0):
+        """Train on (text, category) pairs with Laplace smoothing.
+
+        Categories listed in classes are part of the model even without
+        examples, so predictions can tell they were never seen.
+        """
+        classes = sorted(set(classes) | {category for _, category in examples})
+        class_counts = [0] * len(classes)
+        feature_counts = [array('d', [0.0]) * n_features for _ in classes]
+        for text, category in examples:
+            index = classes.index(category)
+            class_counts[index] += 1
+            for bucket, count in hash_features(text, n_features).items():
+                feature_counts[index][bucket] += count
+
+        log_priors = [math.log((count + alpha) / (len(examples) + alpha * len(classes))) for count in class_counts]
+        feature_log_probs = []
+        for counts in feature_counts:
+            log_total = math.log(sum(counts) + alpha * n_features)
+            feature_log_probs.append(array('f', (math.log(count + alpha) - log_total for count in counts)))
+        return cls(classes, n_features, log_priors, feature_log_probs, class_counts)
+
+    def predict_proba(self, text):
+        """Return a dict of category -> probability."""
+        features = hash_features(text, self.n_features)
+        scores = []
+        for log_prior, log_probs in zip(self.log_priors, self.feature_log_probs):
+            scores.append(log_prior + sum(log_probs[bucket] * count for bucket, count in features.items()))
+        top = max(scores)
+        weights = [math.exp(score - top) for score in scores]
+        total = sum(weights)
+        return {category: weight / total for category, weight in zip(self.classes, weights)}
+
+    def predict(self, text):
+        """Return the most likely category and its probability.
+
+        A model that was trained without examples of some category cannot
+        rule that category out, so its confidence is reported as 0.0.
+        """
+        probabilities = self.predict_proba(text)
+        category = max(probabilities, key=probabilities.get)
+        if self.class_counts is not None and not all(self.class_counts):
+            return category, 0.0
+        return category, probabilities[category]
+
+    def save(self, path=MODEL_FILE):
+        """Write the model as a small JSON header followed by the raw float32 arrays."""
+        header = json.dumps({
+            'classes': self.classes,
+            'n_features': self.n_features,
+            'log_priors': self.log_priors,
+            'class_counts': self.class_counts
+        }).encode('utf-8')
+        with open(path, 'wb') as model_file:
+            model_file.write(MODEL_MAGIC)
+            model_file.write(struct.pack('<I', len(header)))
+            model_file.write(header)
+            for log_probs in self.feature_log_probs:
+                log_probs.tofile(model_file)
+
+    @classmethod
+    def load(cls, path=MODEL_FILE):
+        """Read a model written by save()."""
+        with open(path, 'rb') as model_file:
+            if model_file.read(len(MODEL_MAGIC)) != MODEL_MAGIC:
+                raise ValueError(f"{path} is not a category model file")
+            header_length, = struct.unpack('<I', model_file.read(4))
+            header = json.loads(model_file.read(header_length))
+            feature_log_probs = []
+            for _ in header['classes']:
+                log_probs = array('f')
+                log_probs.fromfile(model_file, header['n_features'])
+                feature_log_probs.append(log_probs)
+        return cls(header['classes'], header['n_features'], header['log_priors'], feature_log_probs,
+                   header.get('class_counts'))
+
+class LabelLog:
+    """Append-only JSONL log of categories assigned by the LLM, used as training data."""
+    def __init__(self, path=LABEL_LOG_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def append(self, text, category):
+        with self._lock, open(self.path, 'a') as log_file:
+            log_file.write(json.dumps({'text': text, 'category': category}) + '\n')
+
+def load_examples(path=LABEL_LOG_FILE):
+    """Read (text, category) pairs from a label log, keeping the latest label per text."""
+    examples = {}
+    with open(path) as log_file:
+        for line in log_file:
+            if line.strip():
+                record = json.loads(line)
+                examples[record['text']] = record['category']
+    return list(examples.items())
+
+def evaluate(model, examples, threshold=CONFIDENCE_THRESHOLD):
+    """Measure agreement with the LLM and how many calls the model would offload."""
+    offloaded = agreed = offloaded_agreed = 0
+    for text, category in examples:
+        predicted, confidence = model.predict(text)
+        agreed += predicted == category
+        if confidence >= threshold:
+            offloaded += 1
+            offloaded_agreed += predicted == category
+    total = len(examples)
+    return {
+        'examples': total,
+        'agreement': agreed / total if total else 0.0,
+        'offload_rate': offloaded / total if total else 0.0,
+        'offloaded_agreement': offloaded_agreed / offloaded if offloaded else 0.0
+    }
+
+def train(log_path=LABEL_LOG_FILE, model_path=MODEL_FILE, holdout=0.2,
+          threshold=CONFIDENCE_THRESHOLD, seed=0, min_per_category=MIN_EXAMPLES_PER_CATEGORY):
+    """Train a model from the label log, report held-out metrics and save it.
+
+    Refuses to train until every category has min_per_category examples.
+    """
+    # categorize imports this module
+    from categorize import CATEGORIES
+
+    examples = load_examples(log_path)
+    counts = Counter(category for _, category in examples)
+    short = [f'{category} ({counts[category]})' for category in CATEGORIES if counts[category] < min_per_category]
+    if short:
+        raise ValueError(f"Need at least {min_per_category} labelled emails per category in {log_path}, "
+                         f"found too few for: {', '.join(short)}")
+    random.Random(seed).shuffle(examples)
+    split = max(1, int(len(examples) * holdout))
+    held_out, training = examples[:split], examples[split:]
+
+    report = evaluate(NaiveBayesModel.fit(training, classes=CATEGORIES), held_out, threshold)
+    # Ship a model trained on everything once it has been evaluated
+    NaiveBayesModel.fit(examples, classes=CATEGORIES).save(model_path)
+    report['trained_on'] = len(examples)
+    return report
+
+def main():
+    """Train the local category model from past LLM categorizations."""
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Train the local email category model.')
+    parser.add_argument('--log', default=LABEL_LOG_FILE, help='Categorization log to train from')
+    parser.add_argument('--model', default=MODEL_FILE, help='Where to write the trained model')
+    parser.add_argument('--holdout', type=float, default=0.2, help='Fraction of examples held out for evaluation')
+    parser.add_argument('--threshold', type=float, default=CONFIDENCE_THRESHOLD,
+                        help='Confidence needed to skip the LLM')
+    parser.add_argument('--min-per-category', type=int, default=MIN_EXAMPLES_PER_CATEGORY,
+                        help='Labelled emails needed in every category before training')
+    args = parser.parse_args()
+
+    report = train(args.log, args.model, args.holdout, args.threshold, min_per_category=args.min_per_category)
+    print(f"Trained on {report['trained_on']} emails, evaluated on {report['examples']} held out")
+    print(f"Agreement with LLM: {report['agreement']:.1%}")
+    print(f"LLM offload rate at {args.threshold:.0%} confidence: {report['offload_rate']:.1%} "
+          f"({report['offloaded_agreement']:.1%} agreement on offloaded emails)")
+    print(f"Model saved to {args.model}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+import json
+import logging
+import multiprocessing
+import os
+import time
+from collections import Counter
+from functools import partial
+from cache import LLMCache
+from categorize import CATEGORIES
+from dedupe import NearDuplicateIndex
+from flag import LABEL_FILE
+from journal import JobJournal
+from local_model import LabelLog, NaiveBayesModel
+from metrics import metrics
+from ratelimit import RateLimiter, TokenBucket, get_limiter, set_limiter
+from read_gmail import HISTORY_FILE, SCOPES, authenticate_gmail
+from sinks import open_sink
+
+# Default manifest listing the mailboxes to process in multi-mailbox mode.
+MAILBOX_MANIFEST = 'mailboxes.json'
+
+# OAuth client used for mailboxes whose manifest entry names none.
+CREDENTIALS_FILE = 'credentials.json'
+
+# Per-stage metrics that are summed across mailboxes in the combined report.
+SUMMED_METRICS = ('calls', 'errors', 'retries', 'gmail_quota_units', 'prompt_tokens', 'completion_tokens')
+
+# OpenAI buckets shared by every worker, set by init_worker.
+_openai_buckets = None
+
+def load_manifest(path=MAILBOX_MANIFEST):
+    """Read the mailbox manifest: a JSON list of per-mailbox settings.
+
+    Each entry needs a unique "name" and a "token" file, and may set
+    "credentials", "max_emails", "gmail_quota_per_second" and "history".
+    """
+    with open(path) as manifest_file:
+        mailboxes = json.load(manifest_file)
+    names = Counter(mailbox.get('name') for mailbox in mailboxes)
+    for mailbox in mailboxes:
+        if not mailbox.get('name') or not mailbox.get('token'):
+            raise ValueError(f"Manifest entry needs a name and a token file: {mailbox}")
+        if names[mailbox['name']] > 1:
+            raise ValueError(f"Duplicate mailbox name in manifest: {mailbox['name']}")
+    return mailboxes
+
+def mailbox_path(path, name):
+    """Per-mailbox variant of a state file path, e.g. journal.db -> journal_support.db."""
+    root, extension = os.path.splitext(path)
+    return f'{root}_{name}{extension}'
+
+def authorize_mailboxes(mailboxes):
+    """Run the OAuth consent flow for mailboxes without a token yet.
+
+    Workers cannot open a browser, so this happens up front, one mailbox
+    at a time.
+    """
+    for mailbox in mailboxes:
+        if not os.path.exists(mailbox['token']):
+            from gmail_auth import load_credentials
+            print(f"Authorize mailbox {mailbox['name']}:")
+            load_credentials(mailbox['token'], mailbox.get('credentials', CREDENTIALS_FILE), SCOPES)
+
+def init_worker(openai_buckets):
+    """Pool initializer: remember the OpenAI buckets shared with the parent."""
+    global _openai_buckets
+    _openai_buckets = openai_buckets
+    logging.basicConfig(level=logging.INFO)
+
+def process_mailbox(mailbox, options):
+    """Process one mailbox in a worker process and return its result summary.
+
+    The mailbox gets a fresh rate limiter, so its Gmail quota is tracked on
+    its own, while OpenAI calls draw from the budget shared by all workers.
+    The LLM cache and local model are shared; the journal, results, label
+    log, dedupe index and metrics report get per-mailbox paths.
+    """
+    # main imports this module
+    from main import EmailProcessor
+
+    name = mailbox['name']
+    limiter = RateLimiter.from_env()
+    if 'gmail_quota_per_second' in mailbox:
+        limiter.buckets['gmail'] = TokenBucket('gmail', float(mailbox['gmail_quota_per_second']))
+    if _openai_buckets:
+        limiter.use_openai_buckets(_openai_buckets)
+    set_limiter(limiter)
+
+    cache = journal = sink = dedupe = None
+    started = time.monotonic()
+    try:
+        if options.get('cache'):
+            cache = LLMCache(options['cache'], max_entries=options['cache_max_entries'], ttl=options['cache_ttl'])
+        if options.get('journal'):
+            journal = JobJournal(mailbox_path(options['journal'], name))
+        if options.get('results'):
+            sink = open_sink(mailbox_path(options['results'], name))
+        if options.get('dedupe'):
+            dedupe = NearDuplicateIndex(mailbox_path(options['dedupe'], name),
+                                        options['dedupe_threshold'], options['reply_threshold'])
+        processor = EmailProcessor(
+            gmail_service=authenticate_gmail(mailbox['token'], mailbox.get('credentials', CREDENTIALS_FILE)),
+            max_emails=mailbox.get('max_emails', options.get('max_emails')),
+            history_file=mailbox.get('history', mailbox_path(HISTORY_FILE, name)),
+            label_file=mailbox_path(LABEL_FILE, name),
+            cache=cache,
+            journal=journal,
+            sink=sink,
+            local_model=NaiveBayesModel.load(options['local_model']) if options.get('local_model') else None,
+            label_log=LabelLog(mailbox_path(options['label_log'], name)) if options.get('label_log') else None,
+            dedupe=dedupe,
+            metrics_report=mailbox_path(options['metrics_report'], name) if options.get('metrics_report') else None,
+            **options.get('processor', {})
+        )
+        category_counts = processor.process_emails()
+    except Exception as error:
+        logging.error(f"Error processing mailbox {name}: {error}")
+        return {
+            'mailbox': name,
+            'success': False,
+            'error': str(error),
+            'categories': {},
+            'emails': 0,
+            'duration_seconds': time.monotonic() - started,
+            'stages': {}
+        }
+    finally:
+        if cache:
+            cache.close()
+        if sink:
+            sink.close()
+        if journal:
+            journal.close()
+        if dedupe:
+            dedupe.close()
+    return {
+        'mailbox': name,
+        'success': True,
+        'categories': dict(category_counts),
+        'emails': sum(category_counts.values()),
+        'duration_seconds': time.monotonic() - started,
+        'stages': metrics.get_report(since=processor.run_metrics)
+    }
+
+def run_mailboxes(mailboxes, workers=4, options=None):
+    """Process mailboxes across a pool of worker processes and print combined statistics.
+
+    Mailboxes are handed out one at a time as workers become free; all
+    workers share one OpenAI request and token budget.
+    """
+    options = options or {}
+    authorize_mailboxes(mailboxes)
+    context = multiprocessing.get_context()
+    limiter = get_limiter()
+    openai_buckets = limiter.share_openai(context)
+    workers = max(1, min(workers, len(mailboxes)))
+    logging.info(f"Processing {len(mailboxes)} mailboxes with {workers} worker processes")
+
+    results = []
+    started = time.monotonic()
+    with context.Pool(workers, initializer=init_worker, initargs=(openai_buckets,)) as pool:
+        for result in pool.imap_unordered(partial(process_mailbox, options=options), mailboxes):
+            if result['success']:
+                logging.info(f"Mailbox {result['mailbox']}: {result['emails']} emails "
+                             f"in {result['duration_seconds']:.1f}s")
+            results.append(result)
+    print_combined_stats(results, time.monotonic() - started, limiter)
+    return results
+
+def print_combined_stats(results, duration, limiter):
+    """Print per-mailbox results, combined category counts and throughput."""
+    categories = Counter()
+    stages = {}
+    for result in results:
+        categories.update(result['categories'])
+        for stage, stage_stats in result['stages'].items():
+            combined = stages.setdefault(stage, Counter())
+            combined.update({key: stage_stats[key] for key in SUMMED_METRICS})
+
+    print("\nMailboxes:")
+    for result in sorted(results, key=lambda result: result['mailbox']):
+        if result['success']:
+            print(f"{result['mailbox']}: {result['emails']} emails in {result['duration_seconds']:.1f}s")
+        else:
+            print(f"{result['mailbox']}: failed ({result['error']})")
+
+    stats = {category: 0 for category in CATEGORIES + ('ERROR',)}
+    stats.update(categories)
+    print("\nCombined Category Statistics:")
+    for category, count in stats.items():
+        if count > 0:
+            print(f"{category}: {count}")
+
+    if stages:
+        print("\nCombined Stage Totals:")
+        for stage, stage_stats in sorted(stages.items()):
+            print(f"{stage}: {stage_stats['calls']} calls, {stage_stats['retries']} retries, "
+                  f"{stage_stats['errors']} errors, {stage_stats['gmail_quota_units']} quota units, "
+                  f"{stage_stats['prompt_tokens']}+{stage_stats['completion_tokens']} tokens")
+
+    emails = sum(categories.values())
+    busy = sum(result['duration_seconds'] for result in results)
+    print(f"\nThroughput: {emails} emails in {duration:.1f}s ({emails / duration if duration else 0.0:.1f}/s), "
+          f"{busy:.1f} mailbox-seconds of work")
+    for name in ('openai_requests', 'openai_tokens'):
+        bucket = limiter.buckets[name].get_state()
+        print(f"Shared {name}: throttled {bucket['throttled']} times, waited {bucket['waited_seconds']:.1f}s")
@@ -1,126 +1,870 @@
-def check_packages():
-    """Check and install required packages."""
-    import subprocess
-    import sys
-    
-    def install_package(package):
-        subprocess.check_call([sys.executable, "-m", "pip", "install", package])
-    
-    required_packages = {
-        'python-dotenv': 'dotenv',
-        'openai': 'openai',
-        'google-auth-oauthlib': 'google_auth_oauthlib',
-        'google-auth-httplib2': 'google_auth_httplib2',
-        'google-api-python-client': 'googleapiclient'
-    }
-    
-    for package, import_name in required_packages.items():
-        try:
-            __import__(import_name)
-        except ImportError:
-            print(f"Installing {package}...")
-            install_package(package)
-            print(f"Successfully installed {package}")
+import time
 
-# Run package check before imports
-check_packages()
+# When this module started loading, to report import time and first-result latency.
+LOAD_STARTED = time.monotonic()
 
 import os
 from dotenv import load_dotenv
-from openai import OpenAI
-from read_gmail import authenticate_gmail, get_messages, read_message
+from read_gmail import (BATCH_SIZE, HISTORY_FILE, ThreadLocalService, authenticate_gmail, get_messages,
+                        load_history_id, load_retry_ids, newest_unhandled_message, read_messages, read_metadata,
+                        read_threads, save_history_id, sync_messages, thread_context)
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import itertools
+import json
 import logging
+import threading
+from collections import Counter
+from summarize import summarize_text
+from categorize import CATEGORIES, EmailCategorizer
 from respond import EmailResponder
-from flag import EmailFlagger
+from flag import BATCH_MODIFY_LIMIT, LABEL_FILE, EmailFlagger
+from rules import METADATA_HEADERS, HeaderRules
+from local_model import CONFIDENCE_THRESHOLD, LABEL_LOG_FILE, LabelLog, NaiveBayesModel
+from cache import CACHE_FILE, LLMCache
+from dedupe import CLUSTER_THRESHOLD, DEDUPE_FILE, REPLY_THRESHOLD, NearDuplicateIndex
+from ratelimit import get_limiter
+from journal import JOURNAL_FILE, JobJournal, result_done
+from metrics import METRICS_REPORT_FILE, metrics
+from batch_api import BatchRunner
+from sinks import RESULTS_FILE, open_sink
+from imap_backend import ImapMailbox, ImapPool, connect_from_env
+from mailboxes import MAILBOX_MANIFEST, load_manifest, run_mailboxes
+from daemon import MAX_POLL_INTERVAL, MIN_POLL_INTERVAL, WatchDaemon
+import preprocess
+
+# Seconds spent importing main.py and its dependencies.
+IMPORT_SECONDS = time.monotonic() - LOAD_STARTED
+
+def create_openai_client():
+    """Create the OpenAI client; retries are handled by the shared rate limiter."""
+    from openai import OpenAI
+    
+    return OpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0)
 
-# Rest of your existing code... 
+class LazyClient:
+    """Proxy that creates its client on first attribute access.
+    
+    With prewarm, the client is created in a background thread right away,
+    so slow imports overlap with other startup work instead of delaying it.
+    """
+    def __init__(self, create, prewarm=False):
+        self._create = create
+        self._client = None
+        self._error = None
+        self._lock = threading.Lock()
+        self._thread = None
+        if prewarm:
+            self._thread = threading.Thread(target=self._build, name='client-prewarm', daemon=True)
+            self._thread.start()
+
+    def _build(self):
+        with self._lock:
+            if self._client is None and self._error is None:
+                try:
+                    self._client = self._create()
+                except Exception as error:
+                    self._error = error
+
+    def __getattr__(self, name):
+        if self._client is None:
+            self._build()
+            if self._error is not None:
+                raise self._error
+        return getattr(self._client, name)
 
 class EmailProcessor:
-    def __init__(self):
+    def __init__(self, gmail_service=None, openai_client=None, max_emails=None, incremental=False,
+                 concurrent=False, gmail_workers=4, llm_workers=8, fused=False, cache=None,
+                 batch_labels=False, header_rules=False, local_model=None,
+                 confidence_threshold=CONFIDENCE_THRESHOLD, label_log=None, threads=False, sink=None,
+                 metrics_report=None, imap=None, dedupe=None, journal=None, history_file=HISTORY_FILE,
+                 label_file=LABEL_FILE):
         load_dotenv()
+        self.gmail_service = gmail_service
+        self.openai_client = openai_client
+        self.max_emails = max_emails or int(os.getenv('MAX_EMAILS', 5))
+        self.incremental = incremental
+        # Checkpoint of the last seen historyId for incremental runs, one per mailbox
+        self.history_file = history_file
+        self.concurrent = concurrent
+        self.gmail_workers = gmail_workers
+        self.llm_workers = llm_workers
+        self.fused = fused
+        self.cache = cache
+        self.batch_labels = batch_labels
+        self.header_rules = HeaderRules() if header_rules else None
+        self.threads = threads
+        # Results waiting for their queued label changes before being printed
+        self.unreported = []
+        # Finished results are streamed here; only per-category counts are kept in memory
+        self.sink = sink
+        # Where to write the JSON metrics report at the end of each run
+        self.metrics_report = metrics_report
+        # Read mail over IMAP (an ImapMailbox or ImapPool) instead of the Gmail API
+        self.imap = imap
+        # Durable per-message record of finished stages, so re-runs skip completed work
+        self.journal = journal
+        self.start_run()
         self.setup_clients()
-        self.categorizer = EmailCategorizer(self.openai_client)
-        self.responder = EmailResponder(self.openai_client, self.gmail_service)
-        self.flagger = EmailFlagger(self.gmail_service)
+        self.categorizer = EmailCategorizer(
+            self.openai_client,
+            cache=self.cache,
+            local_model=local_model,
+            confidence_threshold=confidence_threshold,
+            label_log=label_log,
+            dedupe=dedupe
+        )
+        self.responder = EmailResponder(self.openai_client, self.gmail_service, cache=self.cache, dedupe=dedupe)
+        self.flagger = EmailFlagger(self.gmail_service, label_file=label_file)
+
+    def setup_clients(self):
+        """Create the Gmail and OpenAI clients unless they were provided."""
+        if self.gmail_service is None:
+            self.gmail_service = authenticate_gmail()
+        if self.openai_client is None:
+            # Importing openai is slow, so it happens in the background while Gmail is read
+            self.openai_client = LazyClient(create_openai_client, prewarm=True)
+        if self.concurrent and not isinstance(self.gmail_service, ThreadLocalService):
+            # Worker threads must not share the service's httplib2 transport
+            self.gmail_service = ThreadLocalService(self.gmail_service)
+
+    def summarize_email(self, email_content):
+        """Summarize a single email body."""
+        return summarize_text(email_content, self.openai_client, cache=self.cache)
+
+    def analyze_email(self, email_content):
+        """Return the summary and category info for an email.
+        
+        In fused mode both come from a single LLM call, otherwise from
+        separate summarization and categorization calls.
+        """
+        if self.fused:
+            analysis = self.categorizer.analyze_email(email_content)
+            return analysis['summary'], analysis
+        summary = self.summarize_email(email_content)
+        category_info = self.categorizer.categorize_email(email_content)
+        return summary, category_info
+
+    def list_messages(self):
+        """Lazily yield the inbox messages to process in this run."""
+        if self.imap:
+            if self.incremental:
+                return self.imap.sync_uids(max_results=self.max_emails)
+            return self.imap.latest_uids(max_results=self.max_emails)
+        if self.incremental:
+            # Messages an earlier run left unfinished go ahead of new mail
+            messages = itertools.chain(self.retry_messages(),
+                                       sync_messages(self.gmail_service, checkpoint_file=self.history_file))
+            return itertools.islice(messages, self.max_emails)
+        return get_messages(self.gmail_service, max_results=self.max_emails)
+
+    def retry_messages(self):
+        """List the messages that failed in an earlier incremental run, or that the journal has unfinished."""
+        retry_ids = load_retry_ids(self.history_file)
+        if self.journal:
+            retry_ids += self.journal.unfinished_ids()
+        self.retry_ids = list(dict.fromkeys(retry_ids))
+        if not self.retry_ids:
+            return []
+        logging.info(f"Retrying {len(self.retry_ids)} emails left unfinished by an earlier run")
+        if not self.threads:
+            return [{'id': msg_id} for msg_id in self.retry_ids]
+        # Thread mode lists threads, so look up each message's thread
+        metadata = read_metadata(self.gmail_service, self.retry_ids)
+        self.retry_ids = [msg_id for msg_id in self.retry_ids if metadata.get(msg_id)]
+        return [{'id': msg_id, 'threadId': metadata[msg_id].get('threadId', msg_id)} for msg_id in self.retry_ids]
+
+    def note_listed(self, chunk):
+        """Remember how far the incremental sync got once every message of a listed chunk was handled."""
+        if self.imap or not chunk:
+            return
+        self.listed_ids.update(message['id'] for message in chunk)
+        self.sync_checkpoint = chunk[-1].get('checkpoint', self.sync_checkpoint)
+
+    def save_checkpoint(self):
+        """Save the incremental sync checkpoint and the ids to retry next run.
+        
+        Results held back until their queued label changes are flushed are
+        not reported yet, so nothing is saved while there are any.
+        """
+        if not self.incremental or self.imap or self.retry_ids is None or self.unreported:
+            return
+        history_id = self.sync_checkpoint or load_history_id(self.history_file)
+        if history_id is None:
+            return
+        retry_ids = self.failed_ids + [msg_id for msg_id in self.retry_ids if msg_id not in self.listed_ids]
+        save_history_id(history_id, self.history_file, dict.fromkeys(retry_ids))
+
+    def list_chunks(self):
+        """Yield the messages to process in batch-sized chunks."""
+        messages = iter(self.list_messages())
+        size = self.imap.chunk_size if self.imap else BATCH_SIZE
+        while True:
+            chunk = list(itertools.islice(messages, size))
+            if not chunk:
+                return
+            yield chunk
+
+    def fetch_chunk(self, chunk):
+        """Fetch a chunk of messages as (id, content, category_info, message) tuples in inbox order.
+        
+        message is the already-fetched message resource when there is one,
+        else None. With a journal, messages already done in an earlier run
+        are dropped, before fetching wherever their ids are known.
+        """
+        if self.imap:
+            fetched = self.fetch_imap_chunk(chunk)
+        else:
+            # A retried message can be listed again as new mail; it is fetched once per run
+            chunk = [message for message in chunk if message['id'] not in self.fetched_ids]
+            self.fetched_ids.update(message['id'] for message in chunk)
+            if self.journal:
+                done = self.journal.done_ids(message['id'] for message in chunk)
+                chunk = [message for message in chunk if message['id'] not in done]
+            fetched = self.fetch_thread_chunk(chunk) if self.threads else self.fetch_message_chunk(chunk)
+        
+        if self.journal:
+            done = self.journal.done_ids(msg_id for msg_id, _, _, _ in fetched)
+            fetched = [item for item in fetched if item[0] not in done]
+            self.journal.record_fetched(msg_id for msg_id, _, _, _ in fetched)
+        return fetched
+
+    def fetch_message_chunk(self, chunk):
+        """Fetch the bodies of a chunk of listed messages.
+        
+        With header rules enabled, metadata is fetched first and messages a
+        rule categorizes come back with their category info and snippet, so
+        only the remaining messages need a full body download.
+        """
+        msg_ids = [message['id'] for message in chunk]
+        prefiltered = {}
+        if self.header_rules:
+            metadata = read_metadata(self.gmail_service, msg_ids, headers=METADATA_HEADERS)
+            for msg_id, message in metadata.items():
+                category_info = self.header_rules.classify(message) if message else None
+                if category_info:
+                    prefiltered[msg_id] = (message.get('snippet', ''), category_info)
+        
+        bodies = read_messages(self.gmail_service, [msg_id for msg_id in msg_ids if msg_id not in prefiltered])
+        
+        fetched = []
+        for msg_id in msg_ids:
+            if msg_id in prefiltered:
+                fetched.append((msg_id, *prefiltered[msg_id], None))
+            elif bodies.get(msg_id):
+                fetched.append((msg_id, bodies[msg_id], None, None))
+        return fetched
+
+    def fetch_imap_chunk(self, uids):
+        """Fetch a chunk of IMAP UIDs with one FETCH; header rules run on the fetched headers."""
+        messages = self.imap.fetch(uids)
+        fetched = []
+        for uid in uids:
+            if uid not in messages:
+                continue
+            message, body = messages[uid]
+            category_info = self.header_rules.classify(message) if self.header_rules else None
+            fetched.append((message['id'], body, category_info, message))
+        return fetched
+
+    def fetch_thread_chunk(self, chunk):
+        """Fetch each thread in a chunk once and return its newest unhandled message.
+        
+        The content is the newest message followed by trimmed earlier messages
+        of the thread, and the fetched message is passed along so replying
+        does not fetch it again.
+        """
+        thread_ids = []
+        for message in chunk:
+            thread_id = message.get('threadId', message['id'])
+            if thread_id not in self.seen_threads:
+                self.seen_threads.add(thread_id)
+                thread_ids.append(thread_id)
+        
+        threads = read_threads(self.gmail_service, thread_ids)
+        
+        fetched = []
+        for thread_id in thread_ids:
+            thread = threads.get(thread_id)
+            newest = newest_unhandled_message(thread) if thread else None
+            if newest is None:
+                continue
+            category_info = self.header_rules.classify(newest) if self.header_rules else None
+            fetched.append((newest['id'], thread_context(thread, newest), category_info, newest))
+        return fetched
+
+    def build_result(self, msg_id, email_content, summary, category_info):
+        """Build the result record for an analyzed email."""
+        return {
+            'id': msg_id,
+            'content': email_content,
+            'summary': summary,
+            'category': category_info['category'],
+            'category_explanation': category_info['explanation'],
+            'processed_at': datetime.now().isoformat()
+        }
+
+    def send_auto_response(self, result, response_text, message=None):
+        """Send a generated reply and record the outcome on the result.
+        
+        With a journal, a reply that was already sent is never sent again:
+        each send carries a deterministic Message-ID, and if an earlier run
+        started sending without confirming it, the mailbox is checked for
+        that Message-ID first.
+        """
+        message_id_header = None
+        send_result = None
+        if self.journal:
+            job = self.journal.get(result['id'])
+            message_id_header, attempted = self.journal.begin_send(result['id'])
+            try:
+                sent_id = job.get('sent_id') or (self.responder.find_sent(message_id_header) if attempted else None)
+            except Exception as error:
+                send_result = {'success': False, 'error': f"Could not check for an earlier send: {error}"}
+            else:
+                if sent_id:
+                    send_result = {'success': True, 'message_id': sent_id,
+                                   'thread_id': message.get('threadId') if message else None, 'already_sent': True}
+        if send_result is None:
+            send_result = self.responder.send_response(
+                result['id'], response_text, original_message=message, message_id_header=message_id_header)
+        if self.journal and send_result['success']:
+            self.journal.record_sent(result['id'], send_result['message_id'])
+        result['auto_response'] = {
+            'response_text': response_text,
+            'send_success': send_result['success'],
+            'send_details': send_result
+        }
+
+    def apply_labels(self, result):
+        """Flag or move an email to spam depending on its category."""
+        # Flag important emails needing human response
+        if result['category'] == 'HUMAN_NEEDED':
+            if self.batch_labels:
+                result['flag_status'] = self.flagger.queue_flag_important(result['id'])
+            else:
+                result['flag_status'] = self.flagger.flag_important_email(result['id'])
+        
+        # Move no-response emails to spam
+        elif result['category'] == 'NO_RESPONSE':
+            if self.batch_labels:
+                result['spam_status'] = self.flagger.queue_spam(result['id'])
+            else:
+                result['spam_status'] = self.flagger.mark_as_spam(result['id'])
+
+    def resume_analysis(self, msg_id):
+        """Summary and category info stored by an earlier run, or (None, None)."""
+        if not self.journal:
+            return None, None
+        return self.journal.resume_analysis(msg_id)
+
+    def record_analysis(self, msg_id, summary, category_info):
+        if self.journal and category_info['category'] in CATEGORIES:
+            self.journal.record_analysis(msg_id, summary, category_info)
+
+    def resume_response(self, msg_id):
+        """Reply text generated by an earlier run, or None."""
+        if not self.journal:
+            return None
+        return self.journal.get(msg_id).get('response_text')
+
+    def record_response(self, msg_id, response_text):
+        if self.journal and response_text:
+            self.journal.record_response(msg_id, response_text)
+
+    def process_message(self, msg_id, email_content, category_info=None, message=None, summary=None):
+        """Summarize, categorize and act on a single email.
+        
+        Analysis is skipped when category_info was already decided, by a
+        header rule or by a finished batch (which also supplies the summary).
+        """
+        if category_info is None:
+            summary, category_info = self.resume_analysis(msg_id)
+        if category_info is None:
+            summary, category_info = self.analyze_email(email_content)
+            self.record_analysis(msg_id, summary, category_info)
+        result = self.build_result(msg_id, email_content, summary, category_info)
+        
+        # Handle auto-responses
+        if result['category'] == 'AUTO_REPLY':
+            response_text = self.resume_response(msg_id)
+            if response_text is None:
+                response_text = self.responder.generate_response(email_content, summary)
+                self.record_response(msg_id, response_text)
+            if response_text:
+                self.send_auto_response(result, response_text, message)
+        else:
+            self.apply_labels(result)
+        
+        return result
+
+    async def process_message_async(self, msg_id, email_content, category_info, message, gmail_pool, llm_pool):
+        """Pipelined version of process_message running on the stage pools."""
+        loop = asyncio.get_running_loop()
+        
+        # Header rules may already have categorized the message, or an earlier run analyzed it
+        summary = None
+        if category_info is None:
+            summary, category_info = self.resume_analysis(msg_id)
+        if category_info is None:
+            if self.fused:
+                summary, category_info = await loop.run_in_executor(
+                    llm_pool, self.analyze_email, email_content)
+            else:
+                # Summarization and categorization are independent, so run them side by side
+                summary, category_info = await asyncio.gather(
+                    loop.run_in_executor(llm_pool, self.summarize_email, email_content),
+                    loop.run_in_executor(llm_pool, self.categorizer.categorize_email, email_content)
+                )
+            self.record_analysis(msg_id, summary, category_info)
+        result = self.build_result(msg_id, email_content, summary, category_info)
+        
+        if result['category'] == 'AUTO_REPLY':
+            response_text = self.resume_response(msg_id)
+            if response_text is None:
+                response_text = await loop.run_in_executor(
+                    llm_pool, self.responder.generate_response, email_content, summary)
+                self.record_response(msg_id, response_text)
+            if response_text:
+                await loop.run_in_executor(gmail_pool, self.send_auto_response, result, response_text, message)
+        else:
+            await loop.run_in_executor(gmail_pool, self.apply_labels, result)
+        
+        return result
+
+    def print_result(self, result):
+        """Print the report for a processed email."""
+        email_content = result['content']
+        print("\n" + "="*50)
+        print("Original Email:")
+        print(email_content[:200] + "..." if len(email_content) > 200 else email_content)
+        print("\nSummary:")
+        print(result['summary'] if result['summary'] else "Could not generate summary")
+        print("\nCategory:")
+        print(f"{result['category']}: {result['category_explanation']}")
+        if result.get('auto_response'):
+            print("\nAuto-Response:")
+            print(result['auto_response']['response_text'])
+        if result.get('flag_status'):
+            print("\nFlag Status:")
+            print(result['flag_status']['message'] if result['flag_status']['success'] 
+                  else f"Failed to flag: {result['flag_status'].get('error')}")
+        if result.get('spam_status'):
+            print("\nSpam Status:")
+            print(result['spam_status']['message'] if result['spam_status']['success'] 
+                  else f"Failed to mark as spam: {result['spam_status'].get('error')}")
+        print("="*50)
+
+    def report(self, result):
+        """Count a result and emit it, or hold it until its queued label changes are flushed."""
+        if self.first_result_at is None:
+            self.first_result_at = time.monotonic()
+        self.category_counts[result['category']] += 1
+        if self.batch_labels:
+            self.unreported.append(result)
+        else:
+            self.emit(result)
+
+    def emit(self, result):
+        """Print a finished result and stream it to the result sink."""
+        self.print_result(result)
+        if self.sink:
+            self.sink.write(result)
+        if self.journal:
+            self.journal.record_result(result)
+        if not result_done(result):
+            self.failed_ids.append(result['id'])
+
+    def labels_due(self):
+        """Whether enough label changes are queued to fill a batchModify call."""
+        return self.batch_labels and self.flagger.pending_count() >= BATCH_MODIFY_LIMIT
+
+    def flush_labels(self):
+        """Apply queued label changes and print the results that were waiting on them."""
+        if not self.batch_labels:
+            return
+        calls = self.flagger.flush()
+        logging.info(f"Applied label changes for {len(self.unreported)} emails in {calls} batchModify calls")
+        for result in self.unreported:
+            self.emit(result)
+        self.unreported = []
+        self.save_checkpoint()
+
+    def start_run(self):
+        """Reset the per-run state and remember where the metrics stood."""
+        self.seen_threads = set()
+        self.category_counts = Counter()
+        self.run_started_at = datetime.now()
+        self.run_started = time.monotonic()
+        self.run_metrics = metrics.snapshot()
+        self.first_result_at = None
+        # Incremental sync progress: the checkpoint of the handled chunks, and ids to retry next run
+        self.sync_checkpoint = None
+        self.retry_ids = None
+        self.listed_ids = set()
+        self.fetched_ids = set()
+        self.failed_ids = []
+
+    def finish_run(self):
+        """Flush pending label changes and results, print statistics and return the category counts."""
+        self.flush_labels()
+        self.save_checkpoint()
+        if self.sink:
+            self.sink.flush()
+        self.print_stats(self.category_counts)
+        if self.metrics_report:
+            self.write_metrics_report()
+        return self.category_counts
+
+    def write_metrics_report(self):
+        """Write this run's throughput and per-stage metrics as JSON."""
+        duration = time.monotonic() - self.run_started
+        emails = sum(self.category_counts.values())
+        report = {
+            'started_at': self.run_started_at.isoformat(),
+            'duration_seconds': duration,
+            'emails': emails,
+            'emails_per_second': emails / duration if duration else 0.0,
+            'categories': dict(self.category_counts),
+            'startup': self.get_startup_stats(),
+            'stages': metrics.get_report(since=self.run_metrics)
+        }
+        with open(self.metrics_report, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+    def get_startup_stats(self):
+        """Import time, and how long the first result took after launch and after the run started."""
+        first = self.first_result_at
+        return {
+            'import_seconds': IMPORT_SECONDS,
+            'first_result_after_launch_seconds': first - LOAD_STARTED if first else None,
+            'first_result_after_run_start_seconds': first - self.run_started if first else None
+        }
+
+    def print_stats(self, category_counts):
+        """Print category statistics for a run."""
+        stats = self.categorizer.get_category_stats(category_counts)
+        print("\nCategory Statistics:")
+        for category, count in stats.items():
+            if count > 0:
+                print(f"{category}: {count}")
+        
+        if self.header_rules:
+            rule_stats = self.header_rules.get_rule_stats()
+            print(f"\nHeader Rules: {rule_stats['hits']} hits, {rule_stats['misses']} misses")
+            for rule, count in rule_stats['by_rule'].items():
+                print(f"{rule}: {count}")
+        
+        if self.categorizer.local_model:
+            offload_stats = self.categorizer.get_offload_stats()
+            print(f"\nLocal Model: {offload_stats['local']} categorized locally, "
+                  f"{offload_stats['llm']} by the LLM ({offload_stats['offload_rate']:.0%} offloaded)")
+        
+        if self.journal:
+            journal_stats = self.journal.get_stats()
+            print(f"\nJournal: {journal_stats['skipped']} emails already done, "
+                  f"{journal_stats['resumed']} analyses resumed")
+        
+        if self.categorizer.dedupe:
+            dedupe_stats = self.categorizer.dedupe.get_stats()
+            saved = ', '.join(f"{count} {stage}" for stage, count in sorted(dedupe_stats['saved_calls'].items()))
+            print(f"\nNear-Duplicate Clusters: {dedupe_stats['clusters']} clusters, "
+                  f"{dedupe_stats['total_saved']} LLM calls saved" + (f" ({saved})" if saved else ''))
+        
+        stage_report = metrics.get_report(since=self.run_metrics)
+        if stage_report:
+            print("\nStage Latency:")
+            for stage, stage_stats in stage_report.items():
+                print(f"{stage}: {stage_stats['calls']} calls, "
+                      f"p50 {stage_stats['latency_p50_seconds']:.3f}s, p99 {stage_stats['latency_p99_seconds']:.3f}s, "
+                      f"{stage_stats['retries']} retries, {stage_stats['errors']} errors, "
+                      f"{stage_stats['gmail_quota_units']} quota units, "
+                      f"{stage_stats['prompt_tokens']}+{stage_stats['completion_tokens']} tokens")
+        
+        startup = self.get_startup_stats()
+        print(f"\nStartup: imports took {startup['import_seconds']:.2f}s", end='')
+        if startup['first_result_after_launch_seconds'] is not None:
+            print(f", first email done {startup['first_result_after_launch_seconds']:.2f}s after launch "
+                  f"({startup['first_result_after_run_start_seconds']:.2f}s after the run started)")
+        else:
+            print()
+        
+        preprocess_stats = preprocess.stats.get_stats()
+        if preprocess_stats:
+            print("\nPrompt Token Reduction:")
+            for stage, stage_stats in preprocess_stats.items():
+                original, reduced = stage_stats['original_tokens'], stage_stats['reduced_tokens']
+                saved = 1 - reduced / original if original else 0.0
+                print(f"{stage}: {original} -> {reduced} tokens ({saved:.0%} saved)")
+        
+        limiter_state = get_limiter().get_state()
+        print("\nRate Limiter:")
+        for name, bucket in limiter_state.items():
+            if name == 'retries':
+                continue
+            print(f"{name}: {bucket['rate']:.1f}/s of {bucket['configured_rate']:.1f}/s, "
+                  f"throttled {bucket['throttled']} times, waited {bucket['waited_seconds']:.1f}s")
+        print(f"retries: {limiter_state['retries']}")
+        
+        if self.cache:
+            print("\nLLM Cache Hit Rates:")
+            for stage, stage_stats in self.cache.get_stats().items():
+                print(f"{stage}: {stage_stats['hit_rate']:.0%} "
+                      f"({stage_stats['hits']} hits, {stage_stats['misses']} misses)")
 
     def process_emails(self):
-        """Main function to process emails."""
+        """Main function to process emails.
+        
+        Results are printed and streamed to the sink as they finish; the
+        per-category counts for the run are returned.
+        """
+        self.start_run()
+        if self.concurrent:
+            return asyncio.run(self.process_emails_async())
+        
         try:
-            messages = get_messages(self.gmail_service)[:self.max_emails]
-            logging.info(f"Processing {len(messages)} emails")
+            logging.info(f"Processing up to {self.max_emails} emails")
+            
+            # Stream through the inbox one batch-sized chunk at a time
+            for chunk in self.list_chunks():
+                for msg_id, email_content, category_info, message in self.fetch_chunk(chunk):
+                    try:
+                        result = self.process_message(msg_id, email_content, category_info, message)
+                    except Exception as error:
+                        # Leave the message unfinished so the next run retries it
+                        logging.error(f"Error processing email {msg_id}: {error}")
+                        self.failed_ids.append(msg_id)
+                        continue
+                    self.report(result)
+                    if self.labels_due():
+                        self.flush_labels()
+                self.note_listed(chunk)
+                self.save_checkpoint()
             
-            results = []
-            for message in messages:
-                msg_id = message['id']
-                email_content = read_message(self.gmail_service, 'me', msg_id)
+            return self.finish_run()
+            
+        except Exception as error:
+            logging.error(f"Error processing emails: {error}")
+            raise
+
+    async def process_emails_async(self):
+        """Process emails as a pipeline with bounded Gmail and LLM concurrency.
+        
+        Bodies for the next chunk are fetched while the current chunk is being
+        analyzed, and results are printed in inbox order as they complete.
+        """
+        loop = asyncio.get_running_loop()
+        gmail_pool = ThreadPoolExecutor(max_workers=self.gmail_workers, thread_name_prefix='gmail')
+        llm_pool = ThreadPoolExecutor(max_workers=self.llm_workers, thread_name_prefix='llm')
+        
+        def fetch(chunk):
+            return loop.run_in_executor(gmail_pool, self.fetch_chunk, chunk)
+        
+        try:
+            logging.info(f"Processing up to {self.max_emails} emails "
+                         f"({self.gmail_workers} Gmail workers, {self.llm_workers} LLM workers)")
+            
+            chunks = self.list_chunks()
+            chunk = await loop.run_in_executor(gmail_pool, next, chunks, None)
+            pending_fetch = fetch(chunk) if chunk else None
+            
+            while chunk:
+                fetched = await pending_fetch
+                tasks = [
+                    asyncio.ensure_future(self.process_message_async(
+                        msg_id, email_content, category_info, message, gmail_pool, llm_pool))
+                    for msg_id, email_content, category_info, message in fetched
+                ]
                 
-                if email_content:
-                    summary = self.summarize_email(email_content)
-                    category_info = self.categorizer.categorize_email(email_content)
-                    
-                    result = {
-                        'id': msg_id,
-                        'content': email_content,
-                        'summary': summary,
-                        'category': category_info['category'],
-                        'category_explanation': category_info['explanation'],
-                        'processed_at': datetime.now().isoformat()
-                    }
-                    
-                    # Handle auto-responses
-                    if category_info['category'] == 'AUTO_REPLY':
-                        response_text = self.responder.generate_response(email_content, summary)
-                        if response_text:
-                            send_result = self.responder.send_response(msg_id, response_text)
-                            result['auto_response'] = {
-                                'response_text': response_text,
-                                'send_success': send_result['success'],
-                                'send_details': send_result
-                            }
-                    
-                    # Flag important emails needing human response
-                    elif category_info['category'] == 'HUMAN_NEEDED':
-                        flag_result = self.flagger.flag_important_email(msg_id)
-                        result['flag_status'] = flag_result
-                    
-                    # Move no-response emails to spam
-                    elif category_info['category'] == 'NO_RESPONSE':
-                        spam_result = self.flagger.mark_as_spam(msg_id)
-                        result['spam_status'] = spam_result
-                    
-                    results.append(result)
-                    
-                    # Print results
-                    print("\n" + "="*50)
-                    print("Original Email:")
-                    print(email_content[:200] + "..." if len(email_content) > 200 else email_content)
-                    print("\nSummary:")
-                    print(summary if summary else "Could not generate summary")
-                    print("\nCategory:")
-                    print(f"{category_info['category']}: {category_info['explanation']}")
-                    if result.get('auto_response'):
-                        print("\nAuto-Response:")
-                        print(result['auto_response']['response_text'])
-                    if result.get('flag_status'):
-                        print("\nFlag Status:")
-                        print(result['flag_status']['message'] if result['flag_status']['success'] 
-                              else f"Failed to flag: {result['flag_status'].get('error')}")
-                    if result.get('spam_status'):
-                        print("\nSpam Status:")
-                        print(result['spam_status']['message'] if result['spam_status']['success'] 
-                              else f"Failed to mark as spam: {result['spam_status'].get('error')}")
-                    print("="*50)
+                # Start fetching the next chunk while this one is analyzed
+                listed, chunk = chunk, await loop.run_in_executor(gmail_pool, next, chunks, None)
+                pending_fetch = fetch(chunk) if chunk else None
+                
+                for (msg_id, _, _, _), task in zip(fetched, tasks):
+                    try:
+                        result = await task
+                    except Exception as error:
+                        logging.error(f"Error processing email {msg_id}: {error}")
+                        self.failed_ids.append(msg_id)
+                        continue
+                    self.report(result)
+                    if self.labels_due():
+                        await loop.run_in_executor(gmail_pool, self.flush_labels)
+                self.note_listed(listed)
+                self.save_checkpoint()
             
-            # Print statistics
-            stats = self.categorizer.get_category_stats(results)
-            print("\nCategory Statistics:")
-            for category, count in stats.items():
-                if count > 0:
-                    print(f"{category}: {count}")
-                    
-            return results
+            return await loop.run_in_executor(gmail_pool, self.finish_run)
             
         except Exception as error:
             logging.error(f"Error processing emails: {error}")
-            raise 
\ No newline at end of file
+            raise
+        finally:
+            gmail_pool.shutdown(wait=False, cancel_futures=True)
+            llm_pool.shutdown(wait=False, cancel_futures=True)
+
+def open_imap(args):
+    """Open the IMAP source selected on the command line."""
+    if args.imap_connections > 1:
+        return ImapPool(connect_from_env, connections=args.imap_connections,
+                        folder=args.imap_folder, min_interval=args.imap_throttle)
+    return ImapMailbox(connect_from_env(), args.imap_folder)
+
+def main():
+    """Process the most recent inbox emails."""
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Summarize, categorize and act on Gmail inbox emails.')
+    parser.add_argument('--max-emails', type=int, default=None,
+                        help='Maximum number of emails to process (defaults to MAX_EMAILS or 5)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only process mail added since the last run (uses history.json)')
+    parser.add_argument('--concurrent', action='store_true',
+                        help='Pipeline Gmail and OpenAI calls across worker threads')
+    parser.add_argument('--gmail-workers', type=int, default=4,
+                        help='Maximum concurrent Gmail requests in --concurrent mode')
+    parser.add_argument('--llm-workers', type=int, default=8,
+                        help='Maximum concurrent OpenAI requests in --concurrent mode')
+    parser.add_argument('--fused', action='store_true',
+                        help='Summarize and categorize each email with a single OpenAI call')
+    parser.add_argument('--cache', nargs='?', const=CACHE_FILE, default=None, metavar='PATH',
+                        help=f'Cache LLM outputs in a SQLite database (default path: {CACHE_FILE})')
+    parser.add_argument('--cache-ttl', type=float, default=None,
+                        help='Ignore cached LLM outputs older than this many seconds')
+    parser.add_argument('--cache-max-entries', type=int, default=10000,
+                        help='Evict least recently used cache entries beyond this count')
+    parser.add_argument('--journal', nargs='?', const=JOURNAL_FILE, default=None, metavar='PATH',
+                        help=f'Record finished stages per email so a re-run resumes where it stopped (default path: {JOURNAL_FILE})')
+    parser.add_argument('--dedupe', nargs='?', const=DEDUPE_FILE, default=None, metavar='PATH',
+                        help=f'Categorize and answer near-duplicate emails once per cluster (default path: {DEDUPE_FILE})')
+    parser.add_argument('--dedupe-threshold', type=float, default=CLUSTER_THRESHOLD,
+                        help='Minimum SimHash similarity for an email to reuse its cluster\'s category')
+    parser.add_argument('--reply-threshold', type=float, default=REPLY_THRESHOLD,
+                        help='Minimum SimHash similarity for an email to reuse its cluster\'s reply')
+    parser.add_argument('--batch-labels', action='store_true',
+                        help='Queue label changes and apply them with batchModify')
+    parser.add_argument('--header-rules', action='store_true',
+                        help='Categorize obvious bulk mail from headers without calling OpenAI')
+    parser.add_argument('--local-model', default=None, metavar='PATH',
+                        help='Ask this trained local model (see local_model.py) before calling OpenAI')
+    parser.add_argument('--local-threshold', type=float, default=CONFIDENCE_THRESHOLD,
+                        help='Minimum local model confidence needed to skip OpenAI')
+    parser.add_argument('--label-log', nargs='?', const=LABEL_LOG_FILE, default=None, metavar='PATH',
+                        help=f'Log OpenAI categorizations as training data (default path: {LABEL_LOG_FILE})')
+    parser.add_argument('--threads', action='store_true',
+                        help='Analyze each Gmail thread once, using its newest unhandled message')
+    parser.add_argument('--batch-api', action='store_true',
+                        help='Summarize and categorize through the OpenAI Batch API (resumes via batch_state.json)')
+    parser.add_argument('--batch-poll-interval', type=float, default=60,
+                        help='Seconds between batch status checks in --batch-api mode')
+    parser.add_argument('--results', nargs='?', const=RESULTS_FILE, default=None, metavar='PATH',
+                        help=f'Stream results to a JSONL file, or SQLite for .db paths (default path: {RESULTS_FILE})')
+    parser.add_argument('--metrics-report', nargs='?', const=METRICS_REPORT_FILE, default=None, metavar='PATH',
+                        help=f'Write per-stage latency, token and quota metrics for each run as JSON '
+                             f'(default path: {METRICS_REPORT_FILE})')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running and process new mail as it arrives (implies --incremental)')
+    parser.add_argument('--topic', default=os.getenv('GMAIL_PUSH_TOPIC'),
+                        help='Pub/Sub topic for Gmail push notifications in --daemon mode (else poll)')
+    parser.add_argument('--listen', default='127.0.0.1:8080', metavar='HOST:PORT',
+                        help='Address serving push notifications and /metrics in --daemon mode')
+    parser.add_argument('--poll-min', type=float, default=MIN_POLL_INTERVAL,
+                        help='Shortest polling interval in seconds in --daemon mode')
+    parser.add_argument('--poll-max', type=float, default=MAX_POLL_INTERVAL,
+                        help='Longest polling interval in seconds in --daemon mode')
+    parser.add_argument('--imap', action='store_true',
+                        help='Read mail over IMAP using the IMAP_* environment variables (uses imap_state.json)')
+    parser.add_argument('--imap-folder', default='INBOX',
+                        help='IMAP folder to read in --imap mode')
+    parser.add_argument('--imap-connections', type=int, default=1,
+                        help='Parallel IMAP connections used to fetch in --imap mode (Gmail allows 15)')
+    parser.add_argument('--imap-throttle', type=float, default=0.0,
+                        help='Minimum seconds between FETCH commands on each parallel IMAP connection')
+    parser.add_argument('--mailboxes', nargs='?', const=MAILBOX_MANIFEST, default=None, metavar='PATH',
+                        help=f'Process every mailbox in a JSON manifest of per-mailbox tokens (default path: {MAILBOX_MANIFEST})')
+    parser.add_argument('--mailbox-workers', type=int, default=4,
+                        help='Worker processes used to process mailboxes in parallel in --mailboxes mode')
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    if args.mailboxes:
+        if args.imap or args.daemon or args.batch_api:
+            parser.error('--mailboxes cannot be combined with --imap, --daemon or --batch-api')
+        run_mailboxes(load_manifest(args.mailboxes), workers=args.mailbox_workers, options={
+            'max_emails': args.max_emails,
+            'cache': args.cache,
+            'cache_max_entries': args.cache_max_entries,
+            'cache_ttl': args.cache_ttl,
+            'journal': args.journal,
+            'results': args.results,
+            'local_model': args.local_model,
+            'label_log': args.label_log,
+            'dedupe': args.dedupe,
+            'dedupe_threshold': args.dedupe_threshold,
+            'reply_threshold': args.reply_threshold,
+            'metrics_report': args.metrics_report,
+            'processor': {
+                'incremental': args.incremental,
+                'concurrent': args.concurrent,
+                'gmail_workers': args.gmail_workers,
+                'llm_workers': args.llm_workers,
+                'fused': args.fused,
+                'batch_labels': args.batch_labels,
+                'header_rules': args.header_rules,
+                'confidence_threshold': args.local_threshold,
+                'threads': args.threads
+            }
+        })
+        return
+    cache = None
+    if args.cache:
+        cache = LLMCache(args.cache, max_entries=args.cache_max_entries, ttl=args.cache_ttl)
+    processor = EmailProcessor(
+        max_emails=args.max_emails,
+        incremental=args.incremental or args.daemon,
+        concurrent=args.concurrent,
+        gmail_workers=args.gmail_workers,
+        llm_workers=args.llm_workers,
+        fused=args.fused,
+        cache=cache,
+        batch_labels=args.batch_labels,
+        header_rules=args.header_rules,
+        local_model=NaiveBayesModel.load(args.local_model) if args.local_model else None,
+        confidence_threshold=args.local_threshold,
+        label_log=LabelLog(args.label_log) if args.label_log else None,
+        threads=args.threads,
+        sink=open_sink(args.results) if args.results else None,
+        metrics_report=args.metrics_report,
+        imap=open_imap(args) if args.imap else None,
+        dedupe=NearDuplicateIndex(args.dedupe, args.dedupe_threshold, args.reply_threshold) if args.dedupe else None,
+        journal=JobJournal(args.journal) if args.journal else None
+    )
+    try:
+        if args.batch_api:
+            BatchRunner(processor, poll_interval=args.batch_poll_interval).run()
+        elif args.daemon:
+            host, port = args.listen.rsplit(':', 1)
+            WatchDaemon(
+                processor,
+                topic=args.topic,
+                host=host,
+                port=int(port),
+                push_token=os.getenv('GMAIL_PUSH_TOKEN'),
+                min_interval=args.poll_min,
+                max_interval=args.poll_max,
+                idle_mailbox=ImapMailbox(connect_from_env(), args.imap_folder) if args.imap else None
+            ).run()
+        else:
+            processor.process_emails()
+    finally:
+        if processor.sink:
+            processor.sink.close()
+        if processor.imap:
+            processor.imap.close()
+        if processor.journal:
+            processor.journal.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+import copy
+import threading
+from collections import Counter
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METRIC_PREFIX = 'email_processor'
+
+# Default location of the per-run JSON report.
+METRICS_REPORT_FILE = 'metrics_report.json'
+
+class Metrics:
+    """Per-stage call counts, latency histograms, retries, tokens and Gmail quota units.
+
+    Every Gmail and OpenAI call goes through the rate limiter, which records
+    into the module-level `metrics` instance under the stage the caller named
+    (gmail_list, gmail_fetch, summarize, categorize, respond, send, flag, ...).
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._data = self._empty()
+
+    def _empty(self):
+        return {
+            'calls': Counter(),
+            'errors': Counter(),
+            'latency_sum': Counter(),
+            # stage -> count per bucket, with a final +Inf bucket
+            'latency_buckets': {},
+            'retries': Counter(),
+            'quota_units': Counter(),
+            'prompt_tokens': Counter(),
+            'completion_tokens': Counter()
+        }
+
+    def observe(self, stage, seconds, error=False):
+        """Record one call of a stage and how long it took, including waits and retries."""
+        with self._lock:
+            data = self._data
+            data['calls'][stage] += 1
+            if error:
+                data['errors'][stage] += 1
+            data['latency_sum'][stage] += seconds
+            counts = data['latency_buckets'].setdefault(stage, [0] * (len(self.buckets) + 1))
+            counts[next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))] += 1
+
+    def record_retry(self, stage, count=1):
+        with self._lock:
+            self._data['retries'][stage] += count
+
+    def record_quota(self, stage, units):
+        with self._lock:
+            self._data['quota_units'][stage] += units
+
+    def record_tokens(self, stage, usage):
+        """Record the prompt and completion tokens of an OpenAI response's usage."""
+        with self._lock:
+            self._data['prompt_tokens'][stage] += getattr(usage, 'prompt_tokens', 0) or 0
+            self._data['completion_tokens'][stage] += getattr(usage, 'completion_tokens', 0) or 0
+
+    def snapshot(self):
+        """Copy of the raw counters, to report on a single run with get_report(since=...)."""
+        with self._lock:
+            return copy.deepcopy(self._data)
+
+    def reset(self):
+        with self._lock:
+            self._data = self._empty()
+
+    def quantile(self, bucket_counts, q):
+        """Estimate a latency quantile by interpolating within histogram buckets."""
+        total = sum(bucket_counts)
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets + (self.buckets[-1],), bucket_counts):
+            if count and seen + count >= rank:
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return self.buckets[-1]
+
+    def get_report(self, since=None):
+        """Per-stage totals as a JSON-serializable dict, optionally only those after a snapshot."""
+        data = self.snapshot()
+        if since is not None:
+            for name, values in data.items():
+                if name == 'latency_buckets':
+                    for stage, counts in values.items():
+                        previous = since[name].get(stage, [0] * len(counts))
+                        values[stage] = [now - before for now, before in zip(counts, previous)]
+                else:
+                    values.subtract(since[name])
+
+        report = {}
+        for stage in sorted(data['calls']):
+            calls = data['calls'][stage]
+            if not calls:
+                continue
+            bucket_counts = data['latency_buckets'][stage]
+            report[stage] = {
+                'calls': calls,
+                'errors': data['errors'][stage],
+                'retries': data['retries'][stage],
+                'latency_mean_seconds': data['latency_sum'][stage] / calls,
+                'latency_p50_seconds': self.quantile(bucket_counts, 0.5),
+                'latency_p99_seconds': self.quantile(bucket_counts, 0.99),
+                'gmail_quota_units': data['quota_units'][stage],
+                'prompt_tokens': data['prompt_tokens'][stage],
+                'completion_tokens': data['completion_tokens'][stage]
+            }
+        return report
+
+    def to_prometheus(self):
+        """Render all counters in the Prometheus text exposition format."""
+        data = self.snapshot()
+        lines = []
+
+        def counter(name, help_text, values):
+            lines.append(f'# HELP {METRIC_PREFIX}_{name} {help_text}')
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name} counter')
+            for stage, value in sorted(values.items()):
+                lines.append(f'{METRIC_PREFIX}_{name}{{stage="{stage}"}} {value}')
+
+        counter('stage_calls_total', 'Gmail and OpenAI calls per stage.', data['calls'])
+        counter('stage_errors_total', 'Calls that failed after retries, per stage.', data['errors'])
+        counter('stage_retries_total', 'Retried calls per stage.', data['retries'])
+        counter('gmail_quota_units_total', 'Gmail quota units spent per stage.', data['quota_units'])
+        lines.append(f'# HELP {METRIC_PREFIX}_openai_tokens_total OpenAI tokens used per stage.')
+        lines.append(f'# TYPE {METRIC_PREFIX}_openai_tokens_total counter')
+        for kind in ('prompt', 'completion'):
+            for stage, value in sorted(data[f'{kind}_tokens'].items()):
+                lines.append(f'{METRIC_PREFIX}_openai_tokens_total{{stage="{stage}",kind="{kind}"}} {value}')
+
+        name = f'{METRIC_PREFIX}_stage_latency_seconds'
+        lines.append(f'# HELP {name} Latency of each call per stage, including rate limit waits and retries.')
+        lines.append(f'# TYPE {name} histogram')
+        for stage, counts in sorted(data['latency_buckets'].items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {data["latency_sum"][stage]}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
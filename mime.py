@@ -0,0 +1,128 @@
+import base64
+import codecs
+import re
+from html import unescape
+from html.parser import HTMLParser
+
+# Bytes of a body part decoded before the rest is dropped.
+MAX_PART_BYTES = 256 * 1024
+
+# Deepest MIME nesting that is walked; anything below is ignored.
+MAX_MIME_DEPTH = 10
+
+NO_TEXT_CONTENT = "No text content found in message"
+
+CHARSET_PATTERN = re.compile(r'charset\s*=\s*"?([^";\s]+)', re.IGNORECASE)
+
+def payload_fields(depth=4):
+    """Gmail partial-response mask for a payload with `depth` levels of nested parts.
+
+    Only MIME types, headers, filenames and inline body data are requested;
+    attachment ids and sizes are left out.
+    """
+    fields = 'partId,mimeType,filename,headers(name,value),body/data'
+    for _ in range(depth):
+        fields = f'partId,mimeType,filename,headers(name,value),body/data,parts({fields})'
+    return fields
+
+# Fields of a message resource needed to read, categorize and reply to it.
+MESSAGE_FIELDS = f'id,threadId,labelIds,snippet,internalDate,payload({payload_fields()})'
+THREAD_FIELDS = f'id,messages({MESSAGE_FIELDS})'
+
+class _TextExtractor(HTMLParser):
+    """Collects the visible text of an HTML document."""
+    SKIPPED_TAGS = ('script', 'style', 'head', 'title')
+    BLOCK_TAGS = ('p', 'div', 'br', 'tr', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'table', 'blockquote')
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self.skipping += 1
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS:
+            self.skipping = max(0, self.skipping - 1)
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.chunks.append(data)
+
+def html_to_text(html):
+    """Strip tags, scripts and styles from HTML, keeping paragraph breaks."""
+    extractor = _TextExtractor()
+    try:
+        extractor.feed(html)
+        extractor.close()
+        text = ''.join(extractor.chunks)
+    except Exception:
+        # Badly broken markup: fall back to dropping anything tag-like
+        text = unescape(re.sub(r'<[^>]*>', ' ', html))
+    lines = (re.sub(r'[ \t\xa0]+', ' ', line).strip() for line in text.splitlines())
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip()
+
+def _headers(part):
+    return {header['name'].lower(): header['value'] for header in part.get('headers', [])}
+
+def _charset(headers):
+    match = CHARSET_PATTERN.search(headers.get('content-type', ''))
+    if match:
+        try:
+            return codecs.lookup(match.group(1)).name
+        except LookupError:
+            pass
+    return 'utf-8'
+
+def decode_part_body(part, max_bytes=MAX_PART_BYTES):
+    """Decode a part's inline base64url body using its declared charset."""
+    data = part.get('body', {}).get('data')
+    if not data:
+        return None
+    # Gmail sometimes omits the base64 padding
+    raw = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))[:max_bytes]
+    return raw.decode(_charset(_headers(part)), errors='replace')
+
+def _is_attachment(part, headers):
+    return bool(part.get('filename')) or headers.get('content-disposition', '').lower().startswith('attachment')
+
+def find_text_parts(payload, max_depth=MAX_MIME_DEPTH):
+    """Return the first text/plain and text/html parts of a MIME tree, in document order."""
+    plain = html = None
+    stack = [(payload, 0)]
+    while stack and plain is None:
+        part, depth = stack.pop()
+        mime_type = part.get('mimeType', '').lower()
+        if mime_type.startswith('multipart/') or mime_type == 'message/rfc822':
+            if depth < max_depth:
+                stack.extend((child, depth + 1) for child in reversed(part.get('parts', [])))
+            continue
+        if _is_attachment(part, _headers(part)) or not part.get('body', {}).get('data'):
+            continue
+        # A single-part payload without a declared type is treated as plain text
+        if mime_type in ('text/plain', ''):
+            plain = part
+        elif mime_type == 'text/html' and html is None:
+            html = part
+    return plain, html
+
+def decode_payload(payload, max_bytes=MAX_PART_BYTES):
+    """Extract readable text from a Gmail message payload.
+
+    Walks nested multipart/alternative, multipart/mixed and forwarded
+    message parts, preferring text/plain and falling back to the visible
+    text of the HTML part. Attachments are skipped and each part is capped
+    at max_bytes.
+    """
+    plain, html = find_text_parts(payload)
+    if plain is not None:
+        return decode_part_body(plain, max_bytes)
+    if html is not None:
+        return html_to_text(decode_part_body(html, max_bytes))
+    return NO_TEXT_CONTENT
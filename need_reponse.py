@@ -4,10 +4,8 @@
 # python need_reponse.py
 
 import openai
-import imaplib
-import email
-from email.header import decode_header
 import os
+from imap_backend import ImapMailbox, connect_imap
 
 # Set your OpenAI API key here
 OPENAI_API_KEY = 'your-openai-api-key'
@@ -28,37 +26,22 @@ def should_respond_to_email(email_text):
 
 def connect_to_gmail(email_address, app_password):
     """Connect to Gmail using IMAP."""
-    imap_server = "imap.gmail.com"
-    imap = imaplib.IMAP4_SSL(imap_server)
-    imap.login(email_address, app_password)
-    return imap
+    return connect_imap(email_address, app_password)
 
 def read_emails(imap, folder="INBOX", max_emails=5):
-    """Read emails from specified folder."""
-    imap.select(folder)
-    _, message_numbers = imap.search(None, "ALL")
+    """Read the newest emails from the specified folder with a single FETCH, leaving them unread."""
+    mailbox = ImapMailbox(imap, folder, state_file=None)
+    uids = mailbox.latest_uids(max_results=max_emails)
+    fetched = mailbox.fetch(uids)
     
     emails = []
-    for num in message_numbers[0].split()[-max_emails:]:
-        _, msg_data = imap.fetch(num, "(RFC822)")
-        email_body = msg_data[0][1]
-        message = email.message_from_bytes(email_body)
-        
-        subject = decode_header(message["subject"])[0][0]
-        if isinstance(subject, bytes):
-            subject = subject.decode()
-            
-        body = ""
-        if message.is_multipart():
-            for part in message.walk():
-                if part.get_content_type() == "text/plain":
-                    body = part.get_payload(decode=True).decode()
-                    break
-        else:
-            body = message.get_payload(decode=True).decode()
-            
+    for uid in reversed(uids):
+        if uid not in fetched:
+            continue
+        message, body = fetched[uid]
+        headers = {header['name'].lower(): header['value'] for header in message['payload']['headers']}
         emails.append({
-            "subject": subject,
+            "subject": headers.get('subject', ''),
             "body": body
         })
     
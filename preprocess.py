@@ -0,0 +1,131 @@
+import re
+import threading
+from collections import defaultdict
+
+# Maximum prompt tokens of email text sent to each LLM stage.
+STAGE_TOKEN_BUDGETS = {
+    'summarize': 1000,
+    'categorize': 500,
+    'analyze': 1000,
+    'respond': 1500,
+}
+DEFAULT_TOKEN_BUDGET = 1000
+
+# Share of the budget kept from the start of the email when truncating.
+HEAD_FRACTION = 0.7
+
+# Lines that start quoted history in replies and forwards. Each is matched
+# against a line and the one after it, so $ must match at the end of a line.
+QUOTE_HEADER_PATTERNS = [
+    re.compile(r'^\s*On .{0,200}wrote:[ \t]*$', re.IGNORECASE | re.MULTILINE),
+    re.compile(r'^\s*-{2,}\s*Original Message\s*-{2,}', re.IGNORECASE),
+    re.compile(r'^\s*-{2,}\s*Forwarded message\s*-{2,}', re.IGNORECASE),
+    re.compile(r'^\s*From:.*$\n^\s*(Sent|Date):', re.IGNORECASE | re.MULTILINE),
+    re.compile(r'^_{10,}[ \t]*$', re.MULTILINE),
+]
+
+# Lines that start a signature block.
+SIGNATURE_PATTERNS = [
+    re.compile(r'^--\s*$'),
+    re.compile(r'^\s*Sent from my (iPhone|iPad|Android|mobile)', re.IGNORECASE),
+    re.compile(r'^\s*Get Outlook for ', re.IGNORECASE),
+]
+
+# Paragraphs containing these phrases are legal or marketing boilerplate.
+BOILERPLATE_PHRASES = [
+    'unsubscribe',
+    'confidentiality notice',
+    'this email and any attachments',
+    'this message and any attachments',
+    'intended recipient',
+    'privileged and confidential',
+    'manage your preferences',
+    'update your email preferences',
+    'you are receiving this email because',
+    'view this email in your browser',
+]
+
+URL_PATTERN = re.compile(r'https?://([^/\s<>"\']+)[^\s<>"\']*')
+
+def count_tokens(text):
+    """Approximate the token count of text (about 4 characters per token)."""
+    return (len(text) + 3) // 4
+
+def strip_quoted_history(text):
+    """Drop quoted replies and forwarded history below the new content."""
+    lines = text.split('\n')
+    for index, line in enumerate(lines):
+        candidate = '\n'.join(lines[index:index + 2])
+        if index > 0 and any(pattern.match(candidate) for pattern in QUOTE_HEADER_PATTERNS):
+            lines = lines[:index]
+            break
+    return '\n'.join(line for line in lines if not line.lstrip().startswith('>'))
+
+def strip_signature(text):
+    """Drop everything from the signature delimiter onwards."""
+    lines = text.split('\n')
+    for index, line in enumerate(lines):
+        if index > 0 and any(pattern.match(line) for pattern in SIGNATURE_PATTERNS):
+            return '\n'.join(lines[:index])
+    return text
+
+def strip_boilerplate(text):
+    """Drop paragraphs that are legal footers or newsletter boilerplate."""
+    paragraphs = re.split(r'\n\s*\n', text)
+    kept = [paragraph for paragraph in paragraphs
+            if not any(phrase in paragraph.lower() for phrase in BOILERPLATE_PHRASES)]
+    # Never strip an email down to nothing
+    return '\n\n'.join(kept) if kept else text
+
+def collapse_urls(text):
+    """Replace URLs, including tracking parameters, with their domain."""
+    return URL_PATTERN.sub(lambda match: f'[link: {match.group(1)}]', text)
+
+def collapse_whitespace(text):
+    """Collapse runs of spaces and blank lines."""
+    text = re.sub(r'[ \t\u00a0]+', ' ', text)
+    text = re.sub(r' *\n *', '\n', text)
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    return text.strip()
+
+def truncate_head_tail(text, max_tokens):
+    """Fit text into max_tokens, keeping its beginning and end."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    # Leave room for the omission marker, whose count is at most the whole text's
+    marker_chars = len(f"\n[... {count_tokens(text)} tokens omitted ...]\n")
+    max_chars = max(0, max_tokens * 4 - marker_chars)
+    head_chars = int(max_chars * HEAD_FRACTION)
+    tail_chars = max_chars - head_chars
+    omitted = count_tokens(text[head_chars:len(text) - tail_chars])
+    return f"{text[:head_chars]}\n[... {omitted} tokens omitted ...]\n{text[len(text) - tail_chars:]}"
+
+class PreprocessStats:
+    """Thread-safe tally of original and reduced token counts per stage."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {'emails': 0, 'original_tokens': 0, 'reduced_tokens': 0})
+
+    def record(self, stage, original_tokens, reduced_tokens):
+        with self._lock:
+            stage_stats = self._stats[stage]
+            stage_stats['emails'] += 1
+            stage_stats['original_tokens'] += original_tokens
+            stage_stats['reduced_tokens'] += reduced_tokens
+
+    def get_stats(self):
+        with self._lock:
+            return {stage: dict(stage_stats) for stage, stage_stats in self._stats.items()}
+
+stats = PreprocessStats()
+
+def preprocess_email(text, stage):
+    """Reduce an email body to the text worth sending to the given LLM stage."""
+    reduced = strip_quoted_history(text)
+    reduced = strip_signature(reduced)
+    reduced = collapse_urls(reduced)
+    reduced = strip_boilerplate(reduced)
+    reduced = collapse_whitespace(reduced)
+    reduced = truncate_head_tail(reduced, STAGE_TOKEN_BUDGETS.get(stage, DEFAULT_TOKEN_BUDGET))
+    stats.record(stage, count_tokens(text), count_tokens(reduced))
+    return reduced
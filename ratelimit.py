@@ -0,0 +1,315 @@
+import logging
+import math
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+from metrics import metrics
+from preprocess import count_tokens
+
+# Gmail per-user limit, in quota units per second.
+GMAIL_QUOTA_UNITS_PER_SECOND = 250
+
+# Quota units charged by Gmail for each API method.
+GMAIL_QUOTA_UNITS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.watch': 100,
+    'gmail.users.stop': 50,
+    'gmail.users.history.list': 2,
+    'gmail.users.labels.list': 1,
+    'gmail.users.labels.create': 5,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.modify': 5,
+    'gmail.users.messages.batchModify': 50,
+    'gmail.users.messages.send': 100,
+    'gmail.users.threads.get': 10,
+}
+DEFAULT_GMAIL_QUOTA_UNITS = 5
+
+# Default OpenAI limits; override with OPENAI_RPM / OPENAI_TPM.
+OPENAI_REQUESTS_PER_MINUTE = 3500
+OPENAI_TOKENS_PER_MINUTE = 90000
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+class TokenBucket:
+    """Thread-safe token bucket whose rate adapts to throttling.
+
+    The rate is halved when the API reports throttling (at most once per
+    cooldown period, so a burst of concurrent 429s counts once) and recovers
+    additively towards the configured rate on each success.
+    """
+    def __init__(self, name, rate, capacity=None, min_rate=None, cooldown=1.0):
+        self.name = name
+        self.configured_rate = rate
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.min_rate = min_rate or rate / 10
+        self.cooldown = cooldown
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.throttled = 0
+        self.throttled_at = None
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, amount=1):
+        """Take amount tokens, sleeping until they are available."""
+        with self._lock:
+            self._refill(time.monotonic())
+            # Reserve the tokens now so concurrent callers queue up fairly
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.waited += wait
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def adjust(self, amount):
+        """Correct a previous reservation once the real cost is known."""
+        with self._lock:
+            self.tokens -= amount
+
+    def on_throttled(self):
+        now = time.monotonic()
+        with self._lock:
+            self.throttled += 1
+            if self.throttled_at is None or now - self.throttled_at >= self.cooldown:
+                self.throttled_at = now
+                self.rate = max(self.min_rate, self.rate / 2)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.configured_rate, self.rate + self.configured_rate / 100)
+
+    def get_state(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return {
+                'rate': self.rate,
+                'configured_rate': self.configured_rate,
+                'available': self.tokens,
+                'throttled': self.throttled,
+                'waited_seconds': self.waited
+            }
+
+class SharedTokenBucket(TokenBucket):
+    """TokenBucket whose state lives in shared memory.
+
+    Worker processes that inherit the bucket (e.g. through a process pool
+    initializer) all draw from, and throttle, the same budget.
+    """
+    _fields = ('tokens', 'updated_at', 'rate', 'throttled', 'throttled_at', 'waited')
+
+    def __init__(self, name, rate, capacity=None, min_rate=None, cooldown=1.0, context=None):
+        context = context or multiprocessing.get_context()
+        self._state = context.Array('d', len(self._fields), lock=False)
+        super().__init__(name, rate, capacity=capacity, min_rate=min_rate, cooldown=cooldown)
+        self._lock = context.Lock()
+
+    def _field(index, convert=float):
+        # None is stored as NaN
+        def get(self):
+            value = self._state[index]
+            return None if math.isnan(value) else convert(value)
+
+        def set(self, value):
+            self._state[index] = math.nan if value is None else value
+        return property(get, set)
+
+    tokens = _field(0)
+    updated_at = _field(1)
+    rate = _field(2)
+    throttled = _field(3, int)
+    throttled_at = _field(4)
+    waited = _field(5)
+    del _field
+
+class RateLimiter:
+    """Single gateway for Gmail and OpenAI calls.
+
+    Gmail requests are charged their quota units against a per-user bucket;
+    OpenAI calls are charged one request and their estimated tokens. Calls
+    that fail with 429 or 5xx (or Gmail's 403 rate limit reasons) are retried
+    with jittered exponential backoff, honouring Retry-After when present.
+    Calls that are not idempotent (sends, creates) are only retried when
+    rate limited, since after a 5xx, timeout or dropped connection they may
+    already have taken effect. Each call is recorded in the metrics under
+    the stage named by the caller.
+    """
+    def __init__(self, gmail_units_per_second=GMAIL_QUOTA_UNITS_PER_SECOND,
+                 openai_rpm=OPENAI_REQUESTS_PER_MINUTE, openai_tpm=OPENAI_TOKENS_PER_MINUTE,
+                 max_retries=6, base_delay=1.0, max_delay=60.0):
+        self.buckets = {
+            'gmail': TokenBucket('gmail', gmail_units_per_second),
+            'openai_requests': TokenBucket('openai_requests', openai_rpm / 60),
+            'openai_tokens': TokenBucket('openai_tokens', openai_tpm / 60, capacity=openai_tpm / 6),
+        }
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """Build a limiter using limits from the environment, if set."""
+        return cls(
+            gmail_units_per_second=float(os.getenv('GMAIL_QUOTA_PER_SECOND', GMAIL_QUOTA_UNITS_PER_SECOND)),
+            openai_rpm=float(os.getenv('OPENAI_RPM', OPENAI_REQUESTS_PER_MINUTE)),
+            openai_tpm=float(os.getenv('OPENAI_TPM', OPENAI_TOKENS_PER_MINUTE))
+        )
+
+    def execute(self, request, units=None, stage='gmail', idempotent=True, **kwargs):
+        """Execute a Gmail API request (or batch) within the quota.
+
+        Pass idempotent=False for requests that must not run twice, such
+        as messages.send.
+        """
+        if units is None:
+            units = GMAIL_QUOTA_UNITS.get(getattr(request, 'methodId', None), DEFAULT_GMAIL_QUOTA_UNITS)
+        
+        def call():
+            # Gmail charges quota for every attempt, including ones that get retried
+            metrics.record_quota(stage, units)
+            return request.execute(**kwargs)
+        return self._call(['gmail'], [units], call, stage, idempotent)
+
+    def call_openai(self, create, estimated_tokens, stage='openai', idempotent=True, **kwargs):
+        """Call an OpenAI endpoint within the request and token limits."""
+        response = self._call(
+            ['openai_requests', 'openai_tokens'], [1, estimated_tokens], lambda: create(**kwargs), stage, idempotent)
+        usage = getattr(response, 'usage', None)
+        if usage is not None:
+            self.buckets['openai_tokens'].adjust(usage.total_tokens - estimated_tokens)
+            metrics.record_tokens(stage, usage)
+        return response
+
+    def _call(self, bucket_names, amounts, call, stage, idempotent=True):
+        # A rate-limited request was rejected before it ran, so even a send can be repeated
+        should_retry = is_retryable if idempotent else is_rate_limited
+        attempt = 0
+        started = time.monotonic()
+        while True:
+            for name, amount in zip(bucket_names, amounts):
+                self.buckets[name].acquire(amount)
+            try:
+                result = call()
+            except Exception as error:
+                if attempt >= self.max_retries or not should_retry(error):
+                    metrics.observe(stage, time.monotonic() - started, error=True)
+                    raise
+                if is_rate_limited(error):
+                    for name in bucket_names:
+                        self.buckets[name].on_throttled()
+                delay = self.backoff_delay(attempt, retry_after(error))
+                attempt += 1
+                self.record_retries(stage)
+                logging.warning(f"Retrying {bucket_names[0]} call in {delay:.1f}s "
+                                f"(attempt {attempt}/{self.max_retries}): {error}")
+                time.sleep(delay)
+                continue
+            for name in bucket_names:
+                self.buckets[name].on_success()
+            metrics.observe(stage, time.monotonic() - started)
+            return result
+
+    def record_retries(self, stage, count=1):
+        """Count retries made on any thread, in the limiter and in the stage metrics."""
+        with self._lock:
+            self.retries += count
+        metrics.record_retry(stage, count)
+
+    def backoff_delay(self, attempt, retry_after_seconds=None):
+        """Full-jitter exponential backoff, or the server's Retry-After."""
+        if retry_after_seconds is not None:
+            return min(self.max_delay, retry_after_seconds)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def share_openai(self, context=None):
+        """Move the OpenAI buckets into shared memory and return them.
+
+        Pass the returned buckets to use_openai_buckets in worker processes
+        so every worker counts against one global OpenAI budget.
+        """
+        for name in ('openai_requests', 'openai_tokens'):
+            bucket = self.buckets[name]
+            self.buckets[name] = SharedTokenBucket(name, bucket.configured_rate, capacity=bucket.capacity,
+                                                   context=context)
+        return {name: self.buckets[name] for name in ('openai_requests', 'openai_tokens')}
+
+    def use_openai_buckets(self, buckets):
+        """Charge OpenAI calls to buckets shared with other processes."""
+        self.buckets.update(buckets)
+
+    def get_state(self):
+        """Current rate, backlog and throttle counts for every bucket."""
+        state = {name: bucket.get_state() for name, bucket in self.buckets.items()}
+        with self._lock:
+            state['retries'] = self.retries
+        return state
+
+def error_status(error):
+    """HTTP status of a Gmail or OpenAI error, if it has one."""
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'resp', None), 'status', None)
+    return int(status) if status is not None else None
+
+def is_rate_limited(error):
+    status = error_status(error)
+    if status == 429:
+        return True
+    return status == 403 and any(reason in str(getattr(error, 'content', b''))
+                                 for reason in RATE_LIMIT_REASONS)
+
+def is_retryable(error):
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    # Checked without importing openai, which is slow to load; if it isn't loaded the error isn't its own
+    openai = sys.modules.get('openai')
+    if openai is not None and isinstance(error, openai.APIConnectionError):
+        return True
+    return error_status(error) in RETRY_STATUSES or is_rate_limited(error)
+
+def retry_after(error):
+    """Seconds to wait from a Retry-After header, if the error carries one."""
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if headers is None:
+        headers = getattr(error, 'resp', None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+def estimate_tokens(messages, max_tokens=None):
+    """Rough token estimate for a chat request (about 4 characters per token)."""
+    prompt_tokens = sum(count_tokens(message['content']) for message in messages)
+    return prompt_tokens + (max_tokens or 256)
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+def get_limiter():
+    """Return the process-wide rate limiter shared by every API call."""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter.from_env()
+        return _limiter
+
+def set_limiter(limiter):
+    """Replace the process-wide rate limiter, e.g. to lift the real quotas in benchmarks."""
+    global _limiter
+    with _limiter_lock:
+        _limiter = limiter
@@ -4,84 +4,436 @@
 # python read_gmail.py
 
 import os.path
-import base64
 import json
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.errors import HttpError
+from mime import MESSAGE_FIELDS, THREAD_FIELDS, decode_payload
+from preprocess import strip_quoted_history, strip_signature, truncate_head_tail
+from ratelimit import GMAIL_QUOTA_UNITS, get_limiter, is_rate_limited, is_retryable, retry_after
 
 # If modifying these SCOPES, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 
-def authenticate_gmail():
+# The Gmail batch endpoint accepts at most 100 sub-requests per call.
+BATCH_SIZE = 100
+
+# Number of messages requested per messages().list page (Gmail allows up to 500).
+PAGE_SIZE = 100
+
+# Earlier messages, and tokens of each, included as context in thread mode.
+THREAD_CONTEXT_MESSAGES = 3
+THREAD_CONTEXT_TOKENS = 200
+
+# Stores the last seen mailbox historyId for incremental syncs.
+HISTORY_FILE = 'history.json'
+
+def authenticate_gmail(token_file='token.json', credentials_file='credentials.json'):
     """Shows basic usage of the Gmail API.
     Lists the user's Gmail labels.
+    
+    Pass another token file (and OAuth client file) to authenticate a
+    different mailbox. The returned service is safe to share between
+    threads (see GmailServiceFactory). Credentials are loaded, and the
+    Google client libraries imported, on its first request.
     """
-    creds = None
-    # The file token.json stores the user's access and refresh tokens, and is
-    # created automatically when the authorization flow completes for the first
-    # time.
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        # Save the credentials for the next run
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
-
-    service = build('gmail', 'v1', credentials=creds)
-    return service
-
-def get_messages(service, user_id='me'):
-    """Get a list of Messages from the user's mailbox."""
+    return ThreadLocalService(factory=GmailServiceFactory(token_file=token_file, credentials_file=credentials_file))
+
+# Parsed discovery documents, keyed by (api, version) and shared by every service built in this process.
+_discovery_documents = {}
+_discovery_lock = threading.Lock()
+
+def discovery_document(api='gmail', version='v1'):
+    """Return the parsed discovery document bundled with googleapiclient, loading it once."""
+    from googleapiclient.discovery_cache import get_static_doc
+    
+    with _discovery_lock:
+        if (api, version) not in _discovery_documents:
+            document = get_static_doc(api, version)
+            if document is None:
+                raise ValueError(f"No bundled discovery document for {api} {version}")
+            _discovery_documents[(api, version)] = json.loads(document)
+        return _discovery_documents[(api, version)]
+
+class GmailServiceFactory:
+    """Builds Gmail services that share credentials but not transports.
+    
+    Services are built from the cached bundled discovery document, so no
+    discovery request is made and building one is cheap. Each gets its own
+    keep-alive httplib2 transport, since httplib2 connections are not
+    thread-safe. Without credentials, they are loaded from token_file on
+    first use (see gmail_auth.load_credentials).
+    """
+    def __init__(self, credentials=None, token_file='token.json', credentials_file='credentials.json', timeout=None):
+        self._credentials = credentials
+        self.token_file = token_file
+        self.credentials_file = credentials_file
+        self.timeout = timeout
+        self._lock = threading.Lock()
+
+    @property
+    def credentials(self):
+        with self._lock:
+            if self._credentials is None:
+                from gmail_auth import load_credentials
+                self._credentials = load_credentials(self.token_file, self.credentials_file, SCOPES)
+            return self._credentials
+
+    def new_http(self):
+        """Return a new authorized transport using the shared credentials."""
+        import httplib2
+        import google_auth_httplib2
+        
+        return google_auth_httplib2.AuthorizedHttp(self.credentials, http=httplib2.Http(timeout=self.timeout))
+
+    def build(self):
+        """Return a new Gmail service with its own transport."""
+        from googleapiclient.discovery import build_from_document
+        
+        return build_from_document(discovery_document(), http=self.new_http())
+
+def new_http(service):
+    """Return a separate authorized transport for requests made on another thread.
+    
+    httplib2 connections are not thread-safe, so background requests must not
+    share the service's own transport. Returns None (use the service's default
+    transport) when the service has no credentials attached.
+    """
+    if isinstance(service, ThreadLocalService) and service.factory:
+        return service.factory.new_http()
+    credentials = getattr(getattr(service, '_http', None), 'credentials', None)
+    if credentials is None:
+        return None
+    import httplib2
+    import google_auth_httplib2
+    
+    return google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+
+class ThreadLocalService:
+    """Gmail service proxy that gives every thread its own transport.
+    
+    Each thread lazily gets its own service: built by the factory if one is
+    given, otherwise copied from the wrapped service's discovery document,
+    so concurrent requests never share an httplib2 connection.
+    """
+    def __init__(self, service=None, factory=None):
+        self._service = service
+        self.factory = factory
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            service = self._local.service = self._clone()
+        return getattr(service, name)
+
+    def _clone(self):
+        if self.factory:
+            return self.factory.build()
+        http = new_http(self._service)
+        if http is None:
+            return self._service
+        from googleapiclient.discovery import build_from_document
+        
+        return build_from_document(self._service._rootDesc, http=http)
+
+def get_messages(service, user_id='me', page_size=PAGE_SIZE, max_results=None):
+    """Lazily yield Messages from the user's inbox, one page at a time.
+    
+    The next page is requested in the background while the caller works
+    through the current one, and paging stops once max_results messages
+    have been yielded.
+    """
+    http = new_http(service)
+    
+    def fetch_page(page_token, remaining):
+        return get_limiter().execute(service.users().messages().list(
+            userId=user_id,
+            labelIds=['INBOX'],
+            maxResults=page_size if remaining is None else min(page_size, remaining),
+            pageToken=page_token
+        ), http=http, stage='gmail_list')
+    
+    remaining = max_results
+    executor = ThreadPoolExecutor(max_workers=1)
     try:
-        results = service.users().messages().list(userId=user_id, labelIds=['INBOX']).execute()
-        messages = results.get('messages', [])
-        return messages
+        next_page = executor.submit(fetch_page, None, remaining)
+        while next_page is not None and remaining != 0:
+            results = next_page.result()
+            messages = results.get('messages', [])
+            if remaining is not None:
+                messages = messages[:remaining]
+                remaining -= len(messages)
+            
+            # Prefetch the following page before handing this one to the caller
+            page_token = results.get('nextPageToken')
+            next_page = None
+            if page_token and remaining != 0:
+                next_page = executor.submit(fetch_page, page_token, remaining)
+            
+            yield from messages
     except Exception as error:
         print(f'An error occurred: {error}')
-        return []
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def _load_checkpoint(checkpoint_file):
+    if not os.path.exists(checkpoint_file):
+        return {}
+    try:
+        with open(checkpoint_file) as checkpoint:
+            return json.load(checkpoint)
+    except (OSError, ValueError) as error:
+        print(f'Ignoring unreadable history checkpoint: {error}')
+        return {}
+
+def load_history_id(checkpoint_file=HISTORY_FILE):
+    """Return the stored historyId checkpoint, or None if there is none."""
+    return _load_checkpoint(checkpoint_file).get('historyId')
 
-def read_message(service, user_id, msg_id):
+def load_retry_ids(checkpoint_file=HISTORY_FILE):
+    """Ids of messages an earlier incremental run listed but could not finish."""
+    return _load_checkpoint(checkpoint_file).get('retry', [])
+
+def save_history_id(history_id, checkpoint_file=HISTORY_FILE, retry_ids=()):
+    """Persist the historyId checkpoint, and the ids to retry, for the next incremental sync."""
+    with open(checkpoint_file, 'w') as checkpoint:
+        json.dump({'historyId': str(history_id), 'retry': list(retry_ids)}, checkpoint)
+
+def _list_history(service, user_id, start_history_id):
+    """Yield history records added to the INBOX since start_history_id."""
+    page_token = None
+    while True:
+        response = get_limiter().execute(service.users().history().list(
+            userId=user_id,
+            startHistoryId=start_history_id,
+            labelId='INBOX',
+            historyTypes=['messageAdded'],
+            pageToken=page_token
+        ), stage='gmail_list')
+        for record in response.get('history', []):
+            yield record
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            yield {'id': response['historyId']}
+            return
+
+def sync_messages(service, user_id='me', checkpoint_file=HISTORY_FILE):
+    """Yield only the inbox messages added since the last sync.
+    
+    Nothing is checkpointed as messages are yielded: each one carries, under
+    'checkpoint', the historyId that is safe to save (with save_history_id)
+    once it and every message before it are done, so a message that is
+    listed but never finished is listed again next time. Only when there is
+    nothing new is the checkpoint advanced here. Without a checkpoint, or
+    when Gmail reports it as expired, this falls back to a full inbox list
+    whose messages carry the current historyId.
+    """
+    start_history_id = load_history_id(checkpoint_file)
+    yielded = False
+    
+    if start_history_id is not None:
+        records = _list_history(service, user_id, start_history_id)
+        try:
+            first = next(records)
+        except HttpError as error:
+            if error.resp.status != 404:
+                raise
+            print('History checkpoint expired, falling back to a full sync')
+        else:
+            seen = set()
+            history_id = start_history_id
+            for record in itertools.chain([first], records):
+                added = []
+                for entry in record.get('messagesAdded', []):
+                    message = entry['message']
+                    if message['id'] in seen or 'INBOX' not in message.get('labelIds', []):
+                        continue
+                    seen.add(message['id'])
+                    added.append(message)
+                for index, message in enumerate(added):
+                    # Moving past a record is only safe once its last message is done
+                    message['checkpoint'] = record['id'] if index == len(added) - 1 else history_id
+                    yielded = True
+                    yield message
+                history_id = record['id']
+            if not yielded:
+                save_history_id(history_id, checkpoint_file, load_retry_ids(checkpoint_file))
+            return
+    
+    # Full sync: later runs only need the mail that arrives after this point
+    profile = get_limiter().execute(service.users().getProfile(userId=user_id), stage='gmail_list')
+    for message in get_messages(service, user_id):
+        message['checkpoint'] = profile['historyId']
+        yielded = True
+        yield message
+    if not yielded:
+        save_history_id(profile['historyId'], checkpoint_file, load_retry_ids(checkpoint_file))
+
+def _decode_message(message):
+    """Extract the readable text body from a message resource."""
+    return decode_payload(message['payload'])
+
+def read_message(service, user_id, msg_id, fields=MESSAGE_FIELDS):
     """Read an individual message."""
     try:
-        message = service.users().messages().get(userId=user_id, id=msg_id).execute()
-        
-        # Get the message parts
-        payload = message['payload']
-        parts = payload.get('parts', [])
-        
-        # If the message is simple (no parts)
-        if 'body' in payload and payload['body'].get('data'):
-            return base64.urlsafe_b64decode(payload['body']['data'].encode('ASCII')).decode('utf-8')
-            
-        # If the message has parts (multipart)
-        for part in parts:
-            if part['mimeType'] == 'text/plain':
-                if 'data' in part['body']:
-                    return base64.urlsafe_b64decode(part['body']['data'].encode('ASCII')).decode('utf-8')
-                
-        return "No text content found in message"
+        message = get_limiter().execute(service.users().messages().get(
+            userId=user_id, id=msg_id, fields=fields), stage='gmail_fetch')
+        return _decode_message(message)
         
     except Exception as error:
         print(f'An error occurred: {error}')
         return None
 
+def _batch_get(service, ids, make_request, transform=None, units_per_request=None):
+    """Fetch many resources through the Gmail batch endpoint.
+    
+    make_request(id) builds the request for each id. Returns a dict mapping
+    each id to transform(resource). Resources that could not be fetched or
+    transformed map to None, so one bad message does not fail the rest of
+    the batch. Sub-requests that were rate limited are retried in a
+    follow-up batch after a backoff delay.
+    """
+    limiter = get_limiter()
+    ids = list(ids)
+    results = {}
+    if units_per_request is None:
+        units_per_request = GMAIL_QUOTA_UNITS['gmail.users.messages.get']
+    
+    for start in range(0, len(ids), BATCH_SIZE):
+        pending = ids[start:start + BATCH_SIZE]
+        attempt = 0
+        
+        while pending:
+            throttled = []
+            
+            def handle_response(request_id, response, exception):
+                if exception is not None:
+                    if is_retryable(exception) and attempt < limiter.max_retries:
+                        throttled.append((request_id, exception))
+                        return
+                    print(f'An error occurred reading message {request_id}: {exception}')
+                    results[request_id] = None
+                    return
+                try:
+                    results[request_id] = transform(response) if transform else response
+                except Exception as error:
+                    print(f'An error occurred decoding message {request_id}: {error}')
+                    results[request_id] = None
+            
+            batch = service.new_batch_http_request(callback=handle_response)
+            for resource_id in pending:
+                batch.add(make_request(resource_id), request_id=resource_id)
+            try:
+                limiter.execute(batch, units=units_per_request * len(pending), stage='gmail_fetch')
+            except Exception as error:
+                print(f'An error occurred executing batch: {error}')
+                for resource_id in pending:
+                    results.setdefault(resource_id, None)
+                break
+            
+            pending = [resource_id for resource_id, _ in throttled]
+            if pending:
+                errors = [exception for _, exception in throttled]
+                if any(is_rate_limited(exception) for exception in errors):
+                    limiter.buckets['gmail'].on_throttled()
+                delay = limiter.backoff_delay(attempt, max(
+                    (retry_after(exception) or 0 for exception in errors), default=0) or None)
+                attempt += 1
+                limiter.record_retries('gmail_fetch', len(pending))
+                time.sleep(delay)
+    
+    return results
+
+def read_messages(service, msg_ids, user_id='me', fields=MESSAGE_FIELDS):
+    """Read many messages using the Gmail batch endpoint.
+    
+    Only the fields in the partial-response mask are transferred (pass
+    fields=None for the full resource). Returns a dict mapping each message
+    id to its decoded body, or None if the message could not be fetched or
+    decoded.
+    """
+    return _batch_get(
+        service, msg_ids,
+        lambda msg_id: service.users().messages().get(userId=user_id, id=msg_id, fields=fields),
+        transform=_decode_message
+    )
+
+def read_metadata(service, msg_ids, user_id='me', headers=None):
+    """Fetch only the labels, snippet and selected headers of many messages.
+    
+    Returns a dict mapping each message id to its metadata-format resource,
+    or None if the message could not be fetched.
+    """
+    return _batch_get(
+        service, msg_ids,
+        lambda msg_id: service.users().messages().get(
+            userId=user_id, id=msg_id, format='metadata', metadataHeaders=headers)
+    )
+
+def read_threads(service, thread_ids, user_id='me', fields=THREAD_FIELDS):
+    """Fetch many threads, with all their messages, using the Gmail batch endpoint.
+    
+    Only the fields in the partial-response mask are transferred. Returns a
+    dict mapping each thread id to its thread resource, or None if the
+    thread could not be fetched.
+    """
+    return _batch_get(
+        service, thread_ids,
+        lambda thread_id: service.users().threads().get(userId=user_id, id=thread_id, fields=fields),
+        units_per_request=GMAIL_QUOTA_UNITS['gmail.users.threads.get']
+    )
+
+def newest_unhandled_message(thread):
+    """Return the newest message of a thread if it still awaits handling.
+    
+    A thread whose newest message is one we sent, or that is no longer in
+    the inbox, has nothing left to handle.
+    """
+    messages = sorted(thread.get('messages', []), key=lambda message: int(message.get('internalDate', 0)))
+    if not messages:
+        return None
+    newest = messages[-1]
+    labels = newest.get('labelIds', [])
+    if 'SENT' in labels or 'INBOX' not in labels:
+        return None
+    return newest
+
+def _new_content(body):
+    """A message body without its quoted history and signature."""
+    return strip_signature(strip_quoted_history(body)).strip()
+
+def thread_context(thread, newest, max_earlier=THREAD_CONTEXT_MESSAGES,
+                   tokens_per_message=THREAD_CONTEXT_TOKENS):
+    """Build the text to analyze for a thread: the newest message, then trimmed earlier ones.
+    
+    Quoted history and signatures are stripped from every message before
+    they are joined, since preprocessing the joined text would otherwise
+    cut it at the newest message's quote header or signature and drop the
+    earlier messages.
+    """
+    body = _decode_message(newest)
+    earlier = [message for message in thread.get('messages', []) if message['id'] != newest['id']]
+    earlier.sort(key=lambda message: int(message.get('internalDate', 0)), reverse=True)
+    if not earlier:
+        return body
+    
+    context = [_new_content(body), '', f'Earlier in this thread ({len(earlier)} messages, newest first):']
+    for message in earlier[:max_earlier]:
+        headers = {header['name']: header['value'] for header in message['payload'].get('headers', [])}
+        context.append(f"--- From: {headers.get('From', 'unknown')}")
+        context.append(truncate_head_tail(_new_content(_decode_message(message)), tokens_per_message))
+    return '\n'.join(context)
+
 def main():
     """Main function to read emails from Gmail."""
     service = authenticate_gmail()
-    messages = get_messages(service)
+    messages = get_messages(service, max_results=PAGE_SIZE)
+    bodies = read_messages(service, [message['id'] for message in messages])
 
-    for message in messages:
-        msg_id = message['id']
-        msg_str = read_message(service, 'me', msg_id)
+    for msg_id, msg_str in bodies.items():
         print(f'Message ID: {msg_id}\nMessage: {msg_str}\n')
 
 if __name__ == '__main__':
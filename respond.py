@@ -1,20 +1,14 @@
-from openai import OpenAI
 import base64
 from email.mime.text import MIMEText
 import logging
+from preprocess import preprocess_email
+from ratelimit import estimate_tokens, get_limiter
 
-class EmailResponder:
-    def __init__(self, openai_client, gmail_service):
-        self.client = openai_client
-        self.gmail_service = gmail_service
-        
-    def generate_response(self, email_content, email_summary=None):
-        """Generate an appropriate response using OpenAI."""
-        try:
-            context = f"""Original Email: {email_content}
-            Summary: {email_summary if email_summary else 'Not provided'}"""
-            
-            prompt = """Generate a professional and helpful email response. The response should:
+MODEL = "gpt-3.5-turbo"
+TEMPERATURE = 0.7
+
+RESPOND_SYSTEM_PROMPT = "You are a professional email assistant. Generate helpful, clear, and appropriate responses."
+RESPOND_PROMPT = """Generate a professional and helpful email response. The response should:
             1. Be concise but friendly
             2. Address the main points/questions
             3. Use appropriate tone based on the original email
@@ -23,30 +17,86 @@ class EmailResponder:
             
             Context:
             {context}"""
-            
-            response = self.client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are a professional email assistant. Generate helpful, clear, and appropriate responses."},
-                    {"role": "user", "content": prompt.format(context=context)}
-                ],
-                temperature=0.7
+
+class EmailResponder:
+    def __init__(self, openai_client, gmail_service, cache=None, dedupe=None):
+        self.client = openai_client
+        self.gmail_service = gmail_service
+        self.cache = cache
+        # Optional near-duplicate index whose clusters share a reply template
+        self.dedupe = dedupe
+        
+    def generate_response(self, email_content, email_summary=None):
+        """Generate an appropriate response using OpenAI."""
+        context = f"""Original Email: {preprocess_email(email_content, 'respond')}
+            Summary: {email_summary if email_summary else 'Not provided'}"""
+        
+        if self.cache:
+            cache_key = self.cache.make_key(
+                context, MODEL, RESPOND_SYSTEM_PROMPT + RESPOND_PROMPT, TEMPERATURE)
+            cached = self.cache.get('respond', cache_key)
+            if cached is not None:
+                return cached
+        
+        if self.dedupe:
+            reply = self.dedupe.lookup_reply(email_content)
+            if reply is not None:
+                return reply
+        
+        try:
+            messages = [
+                {"role": "system", "content": RESPOND_SYSTEM_PROMPT},
+                {"role": "user", "content": RESPOND_PROMPT.format(context=context)}
+            ]
+            response = get_limiter().call_openai(
+                self.client.chat.completions.create,
+                estimate_tokens(messages),
+                model=MODEL,
+                messages=messages,
+                temperature=TEMPERATURE,
+                stage='respond'
             )
             
-            return response.choices[0].message.content.strip()
+            response_text = response.choices[0].message.content.strip()
+            if self.cache:
+                self.cache.set('respond', cache_key, response_text)
+            if self.dedupe:
+                self.dedupe.remember_reply(email_content, response_text)
+            return response_text
             
         except Exception as error:
             logging.error(f"Error generating response: {error}")
             return None
 
-    def send_response(self, original_message_id, response_text):
-        """Send the response email using Gmail API."""
+    def find_sent(self, message_id_header):
+        """Return the id of an already sent message with this Message-ID header, or None."""
+        try:
+            response = get_limiter().execute(self.gmail_service.users().messages().list(
+                userId='me',
+                q=f'in:sent rfc822msgid:{message_id_header}',
+                maxResults=1
+            ), stage='send')
+        except Exception as error:
+            logging.error(f"Error looking up sent reply {message_id_header}: {error}")
+            raise
+        messages = response.get('messages', [])
+        return messages[0]['id'] if messages else None
+
+    def send_response(self, original_message_id, response_text, original_message=None, message_id_header=None):
+        """Send the response email using Gmail API.
+        
+        Pass the original message resource, if already fetched, to skip
+        fetching it again for its thread ID and headers, and a Message-ID
+        header to make the reply findable with find_sent.
+        """
         try:
             # Get the original message to extract thread ID and subject
-            original_message = self.gmail_service.users().messages().get(
-                userId='me', 
-                id=original_message_id
-            ).execute()
+            if original_message is None:
+                original_message = get_limiter().execute(self.gmail_service.users().messages().get(
+                    userId='me', 
+                    id=original_message_id,
+                    fields='threadId,payload/headers'
+                ), stage='send')
             
             # Create message
             message = MIMEText(response_text)
@@ -62,18 +112,20 @@ class EmailResponder:
             
             message['to'] = to_address
             message['subject'] = original_subject
+            if message_id_header:
+                message['Message-ID'] = message_id_header
             
             # Encode the message
             raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
             
             # Send the message
-            sent_message = self.gmail_service.users().messages().send(
+            sent_message = get_limiter().execute(self.gmail_service.users().messages().send(
                 userId='me',
                 body={
                     'raw': raw_message,
                     'threadId': thread_id
                 }
-            ).execute()
+            ), stage='send', idempotent=False)
             
             return {
                 'success': True,
@@ -125,6 +177,7 @@ def main():
     """Test function to demonstrate response generation and sending."""
     import os
     from dotenv import load_dotenv
+    from openai import OpenAI
     from read_gmail import authenticate_gmail
     
     # Load environment variables
@@ -0,0 +1,79 @@
+import re
+import threading
+from collections import Counter
+
+# Headers requested in metadata-only fetches for the rules below.
+METADATA_HEADERS = [
+    'From', 'Subject', 'List-Unsubscribe', 'List-Id', 'Precedence',
+    'Auto-Submitted', 'X-Autoreply', 'X-Autorespond'
+]
+
+# Gmail category labels that never need a reply.
+BULK_LABELS = ('CATEGORY_PROMOTIONS', 'CATEGORY_UPDATES')
+
+NOREPLY_PATTERN = re.compile(
+    r'(no[-_.]?reply|do[-_.]?not[-_.]?reply|mailer-daemon|postmaster|notifications?@|bounces?[@+])',
+    re.IGNORECASE)
+
+def _list_unsubscribe(headers, label_ids):
+    return 'list-unsubscribe' in headers or 'list-id' in headers
+
+def _bulk_precedence(headers, label_ids):
+    return headers.get('precedence', '').strip().lower() in ('bulk', 'list', 'junk')
+
+def _noreply_sender(headers, label_ids):
+    return bool(NOREPLY_PATTERN.search(headers.get('from', '')))
+
+def _gmail_category(headers, label_ids):
+    return any(label in label_ids for label in BULK_LABELS)
+
+def _auto_submitted(headers, label_ids):
+    auto_submitted = headers.get('auto-submitted', 'no').strip().lower()
+    return auto_submitted != 'no' or 'x-autoreply' in headers or 'x-autorespond' in headers
+
+# Rules are checked in order; the first match decides the explanation.
+RULES = [
+    ('auto_submitted', _auto_submitted, 'Automatically generated message'),
+    ('list_unsubscribe', _list_unsubscribe, 'Mailing list or newsletter (List-Unsubscribe header)'),
+    ('bulk_precedence', _bulk_precedence, 'Bulk mail (Precedence header)'),
+    ('noreply_sender', _noreply_sender, 'Sent from a no-reply address'),
+    ('gmail_category', _gmail_category, 'Gmail filed it under Promotions or Updates'),
+]
+
+class HeaderRules:
+    """Categorizes obvious NO_RESPONSE mail from headers alone, without an LLM call."""
+    def __init__(self, rules=RULES):
+        self.rules = rules
+        self.hits = Counter()
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def classify(self, message):
+        """Return category info for a metadata-format message, or None if no rule matches."""
+        headers = {header['name'].lower(): header['value']
+                   for header in message.get('payload', {}).get('headers', [])}
+        label_ids = message.get('labelIds', [])
+
+        for name, matches, explanation in self.rules:
+            if matches(headers, label_ids):
+                with self._lock:
+                    self.hits[name] += 1
+                return {
+                    'category': 'NO_RESPONSE',
+                    'explanation': explanation,
+                    'original_content': message.get('snippet', ''),
+                    'rule': name
+                }
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def get_rule_stats(self):
+        """Return rule hit and miss counts."""
+        with self._lock:
+            return {
+                'hits': sum(self.hits.values()),
+                'misses': self.misses,
+                'by_rule': dict(self.hits)
+            }
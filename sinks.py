@@ -0,0 +1,76 @@
+import json
+import sqlite3
+import threading
+
+# Default location for streamed results.
+RESULTS_FILE = 'results.jsonl'
+
+class JsonlSink:
+    """Appends each result to a JSONL file as soon as it is finished."""
+    def __init__(self, path=RESULTS_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def write(self, result):
+        with self._lock:
+            self._file.write(json.dumps(result) + '\n')
+            # Flush every line so a crash loses at most the result being written
+            self._file.flush()
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+class SqliteSink:
+    """Stores results in a SQLite table keyed by message id.
+
+    Writes are committed every commit_every results and on flush(), so a
+    crash loses at most one uncommitted group.
+    """
+    def __init__(self, path, commit_every=100):
+        self.path = path
+        self.commit_every = commit_every
+        self._uncommitted = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._lock, self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    id TEXT PRIMARY KEY,
+                    category TEXT NOT NULL,
+                    processed_at TEXT NOT NULL,
+                    result TEXT NOT NULL
+                )
+            """)
+
+    def write(self, result):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (id, category, processed_at, result) VALUES (?, ?, ?, ?)",
+                (result['id'], result['category'], result['processed_at'], json.dumps(result)))
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_every:
+                self._conn.commit()
+                self._uncommitted = 0
+
+    def flush(self):
+        with self._lock:
+            self._conn.commit()
+            self._uncommitted = 0
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._conn.close()
+
+def open_sink(path):
+    """Open a result sink, using SQLite for .db/.sqlite paths and JSONL otherwise."""
+    if path.endswith(('.db', '.sqlite', '.sqlite3')):
+        return SqliteSink(path)
+    return JsonlSink(path)
@@ -1,24 +1,57 @@
 import os
-from openai import OpenAI
-from read_gmail import authenticate_gmail, get_messages, read_message
+from preprocess import preprocess_email
+from ratelimit import estimate_tokens, get_limiter
+from read_gmail import authenticate_gmail, get_messages, read_messages
 
-def summarize_text(text, client):
+MODEL = "gpt-3.5-turbo"
+SUMMARIZE_SYSTEM_PROMPT = "You are a helpful assistant that summarizes emails concisely."
+SUMMARIZE_PROMPT = "Please summarize this email in 2-3 sentences:\n\n{text}"
+MAX_TOKENS = 150
+
+def summarize_request(text):
+    """Chat completion parameters for summarizing already preprocessed text."""
+    return {
+        'model': MODEL,
+        'messages': [
+            {"role": "system", "content": SUMMARIZE_SYSTEM_PROMPT},
+            {"role": "user", "content": SUMMARIZE_PROMPT.format(text=text)}
+        ],
+        'max_tokens': MAX_TOKENS
+    }
+
+def summary_cache_key(cache, text):
+    """LLM cache key for summarizing already preprocessed text."""
+    return cache.make_key(text, MODEL, SUMMARIZE_SYSTEM_PROMPT + SUMMARIZE_PROMPT)
+
+def summarize_text(text, client, cache=None):
     """Summarize the given text using OpenAI API."""
+    text = preprocess_email(text, 'summarize')
+    
+    if cache:
+        cache_key = summary_cache_key(cache, text)
+        cached = cache.get('summarize', cache_key)
+        if cached is not None:
+            return cached
+    
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that summarizes emails concisely."},
-                {"role": "user", "content": f"Please summarize this email in 2-3 sentences:\n\n{text}"}
-            ],
-            max_tokens=150
+        request = summarize_request(text)
+        response = get_limiter().call_openai(
+            client.chat.completions.create,
+            estimate_tokens(request['messages'], max_tokens=MAX_TOKENS),
+            **request,
+            stage='summarize'
         )
-        return response.choices[0].message.content
+        summary = response.choices[0].message.content
+        if cache:
+            cache.set('summarize', cache_key, summary)
+        return summary
     except Exception as error:
         print(f"Error in summarization: {error}")
         return None
 
 def main():
+    from openai import OpenAI
+    
     # Initialize OpenAI client
     api_key = os.getenv('OPENAI_API_KEY')
     if not api_key:
@@ -29,13 +62,14 @@ def main():
     service = authenticate_gmail()
     
     # Get recent messages (limit to 5 for testing)
-    messages = get_messages(service)[:5]
+    messages = list(get_messages(service, max_results=5))
     
     print("Processing emails...\n")
     
+    bodies = read_messages(service, [message['id'] for message in messages])
+    
     for message in messages:
-        msg_id = message['id']
-        email_content = read_message(service, 'me', msg_id)
+        email_content = bodies.get(message['id'])
         
         if email_content:
             print("=" * 50)
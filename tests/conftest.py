@@ -0,0 +1,13 @@
+import pytest
+import ratelimit
+from ratelimit import RateLimiter, set_limiter
+
+@pytest.fixture(autouse=True)
+def limiter():
+    """A process-wide rate limiter with no real quotas or backoff sleeps."""
+    previous = ratelimit._limiter
+    fast = RateLimiter(gmail_units_per_second=10 ** 9, openai_rpm=10 ** 9, openai_tpm=10 ** 12,
+                       max_retries=3, base_delay=0.0, max_delay=0.0)
+    set_limiter(fast)
+    yield fast
+    set_limiter(previous)
@@ -0,0 +1,323 @@
+import base64
+import email
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from types import SimpleNamespace
+import httplib2
+import httpx
+import openai
+from googleapiclient.errors import HttpError
+from preprocess import count_tokens
+
+# Seconds the fakes ask callers to wait in the Retry-After header of a throttled call.
+RETRY_AFTER = 0.01
+
+def http_error(status, content=b'', headers=None):
+    """An HttpError like the ones googleapiclient raises."""
+    return HttpError(httplib2.Response(dict(headers or {}, status=status)), content)
+
+def rate_limit_error(status=429):
+    return http_error(status, b'{"error": {"errors": [{"reason": "rateLimitExceeded"}]}}')
+
+def encode_body(text):
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+def make_message(msg_id, body, thread_id=None, sender='alice@example.com', subject='Hello',
+                 labels=('INBOX',), internal_date=0):
+    """A single-part text/plain message resource."""
+    return {
+        'id': msg_id,
+        'threadId': thread_id or msg_id,
+        'labelIds': list(labels),
+        'internalDate': str(internal_date),
+        'snippet': body[:100],
+        'payload': {
+            'mimeType': 'text/plain',
+            'headers': [{'name': 'From', 'value': sender}, {'name': 'Subject', 'value': subject}],
+            'body': {'data': encode_body(body)}
+        }
+    }
+
+class Failures:
+    """Seeded latency, throttling and server error injection shared by the fakes.
+
+    latency is (mean, jitter) in seconds; a call is throttled with
+    probability throttle_rate and fails with a server error with
+    probability error_rate.
+    """
+    def __init__(self, latency=(0.0, 0.0), error_rate=0.0, throttle_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sleep(self):
+        mean, jitter = self.latency
+        if mean:
+            with self._lock:
+                delay = max(0.0, self._random.uniform(mean - jitter, mean + jitter))
+            time.sleep(delay)
+
+    def roll(self):
+        """Return 'throttle', 'error' or None for the next call."""
+        if not self.throttle_rate and not self.error_rate:
+            return None
+        with self._lock:
+            roll = self._random.random()
+        if roll < self.throttle_rate:
+            return 'throttle'
+        if roll < self.throttle_rate + self.error_rate:
+            return 'error'
+        return None
+
+class FakeRequest:
+    """A Gmail API request answered by FakeGmail."""
+    def __init__(self, service, method_id, respond, params):
+        self.service = service
+        self.methodId = method_id
+        self.respond = respond
+        self.params = params
+
+    def execute(self, http=None, num_retries=0):
+        self.service.failures.sleep()
+        return self.run()
+
+    def run(self):
+        """Answer the request without the round trip, as a batch does for its sub-requests."""
+        self.service.record(self.methodId, self.params)
+        self.service.raise_injected(self.methodId)
+        response = self.respond()
+        self.service.raise_lost(self.methodId)
+        return response
+
+class FakeBatch:
+    """Gmail batch request: one round trip, sub-requests succeed or fail on their own."""
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        self.service.failures.sleep()
+        with self.service.lock:
+            self.service.calls['batch'] += 1
+            self.service.batch_sizes.append(len(self.requests))
+        for request_id, request in self.requests:
+            try:
+                response = request.run()
+            except HttpError as error:
+                self.callback(request_id, None, error)
+            else:
+                self.callback(request_id, response, None)
+
+class FakeGmail:
+    """In-memory stand-in for the discovery-built Gmail service.
+
+    Every executed request is counted in `calls` by method id and logged
+    with its parameters in `requests`. fail(method_id, *errors) makes the
+    next calls of that method raise the given errors, one per call;
+    lose_responses does the same after the call has taken effect, like a
+    connection dropped before the response arrived. The inbox is listed
+    in the order the messages are given; latency, error_rate,
+    throttle_rate and seed add random latency and failures (see Failures).
+    """
+    def __init__(self, messages=(), latency=(0.0, 0.0), error_rate=0.0, throttle_rate=0.0, seed=0):
+        self.messages = {message['id']: message for message in messages}
+        self.inbox = [msg_id for msg_id, message in self.messages.items() if 'INBOX' in message['labelIds']]
+        self.threads = defaultdict(list)
+        for message in sorted(self.messages.values(), key=lambda message: int(message['internalDate'])):
+            self.threads[message['threadId']].append(message)
+        self.labels = []
+        self.sent = []
+        # Pages of history records returned by history.list, in order
+        self.history_pages = []
+        self.history_id = 100
+        # history.list answers 404 for older start ids, as Gmail does for expired ones
+        self.oldest_history_id = 0
+        self.calls = Counter()
+        self.requests = []
+        self.batch_sizes = []
+        self.failures = Failures(latency, error_rate, throttle_rate, seed)
+        self.lock = threading.Lock()
+        self._failures = defaultdict(list)
+        self._lost = defaultdict(list)
+
+    def record(self, method_id, params):
+        with self.lock:
+            self.calls[method_id] += 1
+            self.requests.append((method_id, params))
+
+    def fail(self, method_id, *errors):
+        self._failures[method_id].extend(errors)
+
+    def lose_responses(self, method_id, *errors):
+        self._lost[method_id].extend(errors)
+
+    def raise_injected(self, method_id):
+        if self._failures[method_id]:
+            raise self._failures[method_id].pop(0)
+        outcome = self.failures.roll()
+        if outcome == 'throttle':
+            raise http_error(429, b'{"error": {"errors": [{"reason": "rateLimitExceeded"}]}}',
+                             {'retry-after': str(RETRY_AFTER)})
+        if outcome == 'error':
+            raise http_error(503, b'{"error": "backendError"}')
+
+    def raise_lost(self, method_id):
+        if self._lost[method_id]:
+            raise self._lost[method_id].pop(0)
+
+    def _request(self, method_id, respond, **params):
+        return FakeRequest(self, method_id, respond, params)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def users(self):
+        return SimpleNamespace(
+            messages=lambda: SimpleNamespace(
+                list=self._list_messages, get=self._get_message, modify=self._modify,
+                batchModify=self._batch_modify, send=self._send),
+            labels=lambda: SimpleNamespace(list=self._list_labels, create=self._create_label),
+            threads=lambda: SimpleNamespace(get=self._get_thread),
+            history=lambda: SimpleNamespace(list=self._list_history),
+            getProfile=lambda userId: self._request(
+                'gmail.users.getProfile', lambda: {'historyId': str(self.history_id)}, userId=userId),
+            watch=lambda userId, body: self._request(
+                'gmail.users.watch', lambda: {'historyId': str(self.history_id)}, body=body),
+            stop=lambda userId: self._request('gmail.users.stop', dict)
+        )
+
+    def _not_found(self, resource_id):
+        return http_error(404, f'{resource_id} not found'.encode())
+
+    def _list_messages(self, userId, labelIds=None, maxResults=100, pageToken=None, q=None):
+        def respond():
+            if q is not None:
+                # Only the sent-reply lookup by Message-ID is supported
+                wanted = q.split('rfc822msgid:', 1)[1]
+                return {'messages': [{'id': sent['id']} for sent in self.sent
+                                     if sent['message_id_header'] == wanted][:maxResults]}
+            start = int(pageToken or 0)
+            response = {'messages': [{'id': msg_id, 'threadId': self.messages[msg_id]['threadId']}
+                                     for msg_id in self.inbox[start:start + maxResults]]}
+            if start + maxResults < len(self.inbox):
+                response['nextPageToken'] = str(start + maxResults)
+            return response
+        return self._request('gmail.users.messages.list', respond, labelIds=labelIds, q=q,
+                             maxResults=maxResults, pageToken=pageToken)
+
+    def _get_message(self, userId, id, fields=None, format=None, metadataHeaders=None):
+        def respond():
+            if id not in self.messages:
+                raise self._not_found(id)
+            message = self.messages[id]
+            if format == 'metadata':
+                wanted = {header.lower() for header in metadataHeaders or []}
+                headers = [header for header in message['payload']['headers']
+                           if not wanted or header['name'].lower() in wanted]
+                return dict(message, payload={'mimeType': message['payload']['mimeType'], 'headers': headers})
+            return message
+        return self._request('gmail.users.messages.get', respond, id=id, fields=fields, format=format)
+
+    def _get_thread(self, userId, id, fields=None):
+        def respond():
+            if id not in self.threads:
+                raise self._not_found(id)
+            return {'id': id, 'messages': self.threads[id]}
+        return self._request('gmail.users.threads.get', respond, id=id, fields=fields)
+
+    def _modify(self, userId, id, body):
+        return self._request('gmail.users.messages.modify', dict, id=id, body=body)
+
+    def _batch_modify(self, userId, body):
+        return self._request('gmail.users.messages.batchModify', dict, body=body)
+
+    def _send(self, userId, body):
+        def respond():
+            raw = base64.urlsafe_b64decode(body['raw'])
+            with self.lock:
+                sent = {'id': f'sent{len(self.sent) + 1}', 'threadId': body.get('threadId'),
+                        'message_id_header': email.message_from_bytes(raw)['Message-ID']}
+                self.sent.append(sent)
+            return {'id': sent['id'], 'threadId': sent['threadId']}
+        return self._request('gmail.users.messages.send', respond, body=body)
+
+    def _list_labels(self, userId):
+        return self._request('gmail.users.labels.list', lambda: {'labels': list(self.labels)})
+
+    def _create_label(self, userId, body):
+        def respond():
+            with self.lock:
+                label = dict(body, id=f'Label_{len(self.labels) + 1}')
+                self.labels.append(label)
+            return label
+        return self._request('gmail.users.labels.create', respond, body=body)
+
+    def _list_history(self, userId, startHistoryId=None, labelId=None, historyTypes=None, pageToken=None):
+        def respond():
+            if int(startHistoryId) < self.oldest_history_id:
+                raise self._not_found(startHistoryId)
+            index = int(pageToken or 0)
+            response = {'historyId': str(self.history_id)}
+            if index < len(self.history_pages):
+                response['history'] = self.history_pages[index]
+                if index + 1 < len(self.history_pages):
+                    response['nextPageToken'] = str(index + 1)
+            return response
+        return self._request('gmail.users.history.list', respond, startHistoryId=startHistoryId,
+                             pageToken=pageToken)
+
+class FakeOpenAI:
+    """Chat completions stand-in that answers every call with `reply`.
+
+    reply may also be a callable taking the create() keyword arguments
+    and returning the content. fail(*errors) makes the next calls raise
+    the given errors, one per call; latency, error_rate, throttle_rate
+    and seed add random latency and failures (see Failures), counted by
+    status code in `errors`.
+    """
+    def __init__(self, reply='Thanks, done.', latency=(0.0, 0.0), error_rate=0.0, throttle_rate=0.0, seed=0):
+        self.reply = reply
+        self.calls = 0
+        self.errors = Counter()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+        self.failures = Failures(latency, error_rate, throttle_rate, seed)
+        self._lock = threading.Lock()
+        self._failures = []
+
+    def fail(self, *errors):
+        self._failures.extend(errors)
+
+    def _error(self, error_class, status, message, headers=None):
+        request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+        response = httpx.Response(status, request=request, headers=headers or {})
+        with self._lock:
+            self.errors[status] += 1
+        return error_class(message, response=response, body=None)
+
+    def create(self, **kwargs):
+        self.failures.sleep()
+        with self._lock:
+            self.calls += 1
+            injected = self._failures.pop(0) if self._failures else None
+        if injected:
+            raise injected
+        outcome = self.failures.roll()
+        if outcome == 'throttle':
+            raise self._error(openai.RateLimitError, 429, 'Rate limit reached', {'retry-after': str(RETRY_AFTER)})
+        if outcome == 'error':
+            raise self._error(openai.InternalServerError, 500, 'The server had an error')
+        content = self.reply(**kwargs) if callable(self.reply) else self.reply
+        prompt_tokens = sum(count_tokens(message['content']) for message in kwargs.get('messages', ()))
+        completion_tokens = count_tokens(content)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                  total_tokens=prompt_tokens + completion_tokens))
@@ -0,0 +1,132 @@
+import re
+import socketserver
+import threading
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    """In-process IMAP4rev1 stand-in with just the commands ImapMailbox uses.
+
+    Serves one folder from `messages` (a list of (uid, raw bytes)) over
+    plain TCP on localhost. Each UID FETCH is logged in `fetches` as its
+    (message set, items) and sets \\Seen unless it uses BODY.PEEK. Set
+    `drop_fetches` or `throttle_fetches` to make that many of the next
+    fetches drop the connection or answer NO [THROTTLED].
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, uidvalidity=42, gmail_extensions=False):
+        super().__init__(('127.0.0.1', 0), _ImapHandler)
+        self.uidvalidity = uidvalidity
+        self.gmail_extensions = gmail_extensions
+        self.messages = []
+        self.seen = set()
+        self.fetches = []
+        self.logins = 0
+        self.drop_fetches = 0
+        self.throttle_fetches = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True).start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def add(self, raw):
+        with self.lock:
+            uid = self.messages[-1][0] + 1 if self.messages else 1
+            self.messages.append((uid, raw))
+            return uid
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def parse_set(message_set, max_uid):
+    uids = set()
+    for part in message_set.split(','):
+        start, _, end = part.partition(':')
+        start = max_uid if start == '*' else int(start)
+        end = start if not end else max_uid if end == '*' else int(end)
+        uids.update(range(min(start, end), max(start, end) + 1))
+    return uids
+
+class _ImapHandler(socketserver.StreamRequestHandler):
+    def send(self, data):
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def handle(self):
+        server = self.server
+        self.send(b'* OK fake IMAP server ready\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, _, rest = line.decode().rstrip('\r\n').partition(' ')
+            command, _, args = rest.partition(' ')
+            command = command.upper()
+            if command == 'CAPABILITY':
+                capabilities = 'IMAP4rev1 IDLE' + (' X-GM-EXT-1' if server.gmail_extensions else '')
+                self.send(f'* CAPABILITY {capabilities}\r\n{tag} OK done\r\n'.encode())
+            elif command == 'LOGIN':
+                server.logins += 1
+                self.send(f'{tag} OK logged in\r\n'.encode())
+            elif command in ('SELECT', 'EXAMINE'):
+                self.send(f'* {len(server.messages)} EXISTS\r\n'
+                          f'* OK [UIDVALIDITY {server.uidvalidity}] UIDs valid\r\n'
+                          f'{tag} OK [READ-ONLY] done\r\n'.encode())
+            elif command == 'LOGOUT':
+                self.send(f'* BYE\r\n{tag} OK done\r\n'.encode())
+                return
+            elif command == 'UID':
+                if not self.uid_command(tag, args):
+                    return
+            else:
+                self.send(f'{tag} BAD unsupported\r\n'.encode())
+
+    def uid_command(self, tag, args):
+        """Answer UID SEARCH or UID FETCH; returns False if the connection was dropped."""
+        server = self.server
+        subcommand, _, args = args.partition(' ')
+        with server.lock:
+            messages = list(server.messages)
+        max_uid = messages[-1][0] if messages else 0
+        if subcommand.upper() == 'SEARCH':
+            wanted = parse_set(re.search(r'UID (\S+)', args).group(1), max_uid)
+            uids = ' '.join(str(uid) for uid, _ in messages if uid in wanted)
+            self.send(f'* SEARCH {uids}'.rstrip().encode() + f'\r\n{tag} OK done\r\n'.encode())
+            return True
+
+        message_set, _, items = args.partition(' ')
+        with server.lock:
+            server.fetches.append((message_set, items))
+            if server.drop_fetches:
+                server.drop_fetches -= 1
+                return False
+            if server.throttle_fetches:
+                server.throttle_fetches -= 1
+                self.send(f'{tag} NO [THROTTLED] slow down\r\n'.encode())
+                return True
+        fields = re.search(r'HEADER\.FIELDS \(([^)]*)\)', items)
+        limit = re.search(r'BODY(?:\.PEEK)?\[TEXT\]<0\.(\d+)>', items)
+        if not fields or not limit:
+            self.send(f'{tag} BAD unsupported fetch items\r\n'.encode())
+            return True
+        wanted = parse_set(message_set, max_uid)
+        fields, limit = fields.group(1).split(), int(limit.group(1))
+        for sequence, (uid, raw) in enumerate(messages, 1):
+            if uid not in wanted:
+                continue
+            if 'BODY.PEEK' not in items:
+                server.seen.add(uid)
+            header, _, text = raw.partition(b'\r\n\r\n')
+            lines = re.split(rb'\r\n(?![ \t])', header)
+            kept = b''.join(line + b'\r\n' for line in lines
+                            if line.split(b':', 1)[0].decode().upper() in fields) + b'\r\n'
+            text = text[:limit]
+            extensions = f'X-GM-MSGID {1000 + uid} X-GM-THRID {500 + uid} ' if server.gmail_extensions else ''
+            self.send(f'* {sequence} FETCH (UID {uid} RFC822.SIZE {len(raw)} {extensions}'
+                      f'BODY[HEADER.FIELDS ({" ".join(fields)})] {{{len(kept)}}}\r\n'.encode() + kept
+                      + f' BODY[TEXT]<0> {{{len(text)}}}\r\n'.encode() + text + b')\r\n')
+        self.send(f'{tag} OK done\r\n'.encode())
+        return True
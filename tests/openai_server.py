@@ -0,0 +1,141 @@
+import json
+import re
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    """In-process HTTP stand-in for the OpenAI endpoints the Batch API mode uses.
+
+    Serves files, batches and chat completions on localhost under /v1, so
+    the real client can be pointed at `base_url`. A batch completes on its
+    first retrieve: categorize requests are answered with `category` and
+    everything else with `reply`. Set `fail_batches` to make that many of
+    the next batches fail outright, or `expire_after` to make the next
+    batch expire once it has answered that many requests. Every batch's
+    input lines are kept in `batch_inputs`.
+    """
+    daemon_threads = True
+
+    def __init__(self, reply='Thanks, done.', category='AUTO_REPLY'):
+        super().__init__(('127.0.0.1', 0), _OpenAIHandler)
+        self.reply = reply
+        self.category = category
+        self.files = {}
+        self.batches = {}
+        self.batch_inputs = []
+        self.fail_batches = 0
+        self.expire_after = None
+        self.lock = threading.RLock()
+        threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True).start()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/v1'
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def add_file(self, content, purpose, filename='file.jsonl'):
+        with self.lock:
+            file_id = f'file-{len(self.files) + 1}'
+            self.files[file_id] = content
+        return {'id': file_id, 'object': 'file', 'bytes': len(content), 'created_at': int(time.time()),
+                'filename': filename, 'purpose': purpose, 'status': 'processed'}
+
+    def answer(self, request):
+        if request['custom_id'].endswith(':categorize'):
+            return f'{self.category}\nLooks routine'
+        return 'A short summary'
+
+    def finish_batch(self, batch):
+        """Answer a batch's requests and move it to a terminal status."""
+        lines = [json.loads(line) for line in self.files[batch['input_file_id']].decode().splitlines() if line]
+        self.batch_inputs.append([line['custom_id'] for line in lines])
+        if self.fail_batches:
+            self.fail_batches -= 1
+            batch.update(status='failed', errors={'object': 'list', 'data': [
+                {'code': 'invalid_request', 'message': 'Batch validation failed', 'line': None, 'param': None}]})
+            return
+        answered = lines if self.expire_after is None else lines[:self.expire_after]
+        output = [{'id': f'response-{n}', 'custom_id': line['custom_id'], 'error': None, 'response': {
+            'status_code': 200, 'request_id': f'request-{n}',
+            'body': chat_completion(self.answer(line))}} for n, line in enumerate(answered)]
+        errors = [{'id': f'response-{n}', 'custom_id': line['custom_id'], 'response': None,
+                   'error': {'code': 'batch_expired', 'message': 'The completion window expired.'}}
+                  for n, line in enumerate(lines[len(answered):], len(answered))]
+        batch['status'] = 'completed' if self.expire_after is None else 'expired'
+        self.expire_after = None
+        batch['request_counts'] = {'total': len(lines), 'completed': len(answered), 'failed': len(errors)}
+        for key, records in (('output_file_id', output), ('error_file_id', errors)):
+            if records:
+                content = ''.join(json.dumps(record) + '\n' for record in records).encode()
+                batch[key] = self.add_file(content, 'batch_output')['id']
+
+def chat_completion(content):
+    return {'id': 'chatcmpl-1', 'object': 'chat.completion', 'created': int(time.time()), 'model': 'gpt-3.5-turbo',
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'logprobs': None,
+                         'message': {'role': 'assistant', 'content': content}}]}
+
+class _OpenAIHandler(BaseHTTPRequestHandler):
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_POST(self):
+        server = self.server
+        body = self.read_body()
+        if self.path == '/v1/files':
+            form = BytesParser(policy=HTTP).parsebytes(
+                f'Content-Type: {self.headers["Content-Type"]}\r\n\r\n'.encode() + body)
+            parts = {part.get_param('name', header='content-disposition'): part for part in form.iter_parts()}
+            self.send_json(server.add_file(parts['file'].get_payload(decode=True),
+                                           parts['purpose'].get_payload(decode=True).decode(),
+                                           parts['file'].get_filename() or 'file.jsonl'))
+        elif self.path == '/v1/batches':
+            request = json.loads(body)
+            with server.lock:
+                batch_id = f'batch-{len(server.batches) + 1}'
+                server.batches[batch_id] = {
+                    'id': batch_id, 'object': 'batch', 'endpoint': request['endpoint'], 'errors': None,
+                    'input_file_id': request['input_file_id'], 'completion_window': request['completion_window'],
+                    'status': 'validating', 'output_file_id': None, 'error_file_id': None,
+                    'created_at': int(time.time()), 'request_counts': None}
+                self.send_json(server.batches[batch_id])
+        elif self.path == '/v1/chat/completions':
+            self.send_json(chat_completion(server.reply))
+        else:
+            self.send_json({'error': {'message': f'Unknown path {self.path}'}}, status=404)
+
+    def do_GET(self):
+        server = self.server
+        batch = re.fullmatch(r'/v1/batches/([\w-]+)', self.path)
+        content = re.fullmatch(r'/v1/files/([\w-]+)/content', self.path)
+        if batch and batch.group(1) in server.batches:
+            with server.lock:
+                batch = server.batches[batch.group(1)]
+                if batch['status'] == 'validating':
+                    server.finish_batch(batch)
+                self.send_json(batch)
+        elif content and content.group(1) in server.files:
+            data = server.files[content.group(1)]
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_json({'error': {'message': f'Unknown path {self.path}'}}, status=404)
+
+    def log_message(self, format, *args):
+        pass
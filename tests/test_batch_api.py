@@ -0,0 +1,123 @@
+import os
+import pytest
+from openai import OpenAI
+import batch_api
+from batch_api import BatchRunner
+from cache import LLMCache
+from main import EmailProcessor
+from read_gmail import load_history_id, load_retry_ids
+from tests.fakes import FakeGmail, make_message
+from tests.openai_server import FakeOpenAIServer
+
+@pytest.fixture
+def gmail():
+    return FakeGmail([make_message(f'm{i}', f'Could you confirm order {i} has shipped?') for i in range(3)])
+
+@pytest.fixture
+def server():
+    server = FakeOpenAIServer()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def openai_client(server, monkeypatch):
+    """The real OpenAI client, pointed at the stand-in server the way the README describes."""
+    monkeypatch.setenv('OPENAI_BASE_URL', server.base_url)
+    return OpenAI(api_key='test', max_retries=0)
+
+def make_runner(gmail, openai_client, tmp_path, history_file=None, **options):
+    processor = EmailProcessor(gmail_service=gmail, openai_client=openai_client, max_emails=3,
+                               label_file=None, history_file=history_file, **options)
+    return BatchRunner(processor, state_file=str(tmp_path / 'state.json'),
+                       emails_file=str(tmp_path / 'emails.jsonl'), requests_file=str(tmp_path / 'requests.jsonl'),
+                       applied_file=str(tmp_path / 'applied.txt'), outputs_file=str(tmp_path / 'outputs.jsonl'),
+                       poll_interval=0)
+
+def crash_on(runner, msg_id):
+    """Make the runner's processor die, as if killed, when it reaches msg_id."""
+    process_message = runner.processor.process_message
+
+    def crashing(current_id, *args, **kwargs):
+        if current_id == msg_id:
+            raise KeyboardInterrupt
+        return process_message(current_id, *args, **kwargs)
+    runner.processor.process_message = crashing
+
+def test_interrupted_apply_does_not_resend_replies(gmail, server, openai_client, tmp_path):
+    runner = make_runner(gmail, openai_client, tmp_path)
+    crash_on(runner, 'm2')
+    with pytest.raises(KeyboardInterrupt):
+        runner.run()
+    assert len(gmail.sent) == 2
+
+    counts = make_runner(gmail, openai_client, tmp_path).run()
+    assert [sent['threadId'] for sent in gmail.sent] == ['m0', 'm1', 'm2']
+    assert counts == {'AUTO_REPLY': 1}
+    # The resumed run reused the submitted batch and cleaned up after itself
+    assert len(server.batches) == 1
+    assert not os.path.exists(tmp_path / 'applied.txt')
+
+def test_queued_label_changes_are_reapplied_after_a_crash(gmail, server, openai_client, tmp_path):
+    server.category = 'HUMAN_NEEDED'
+    runner = make_runner(gmail, openai_client, tmp_path, batch_labels=True)
+    crash_on(runner, 'm2')
+    with pytest.raises(KeyboardInterrupt):
+        runner.run()
+    # Nothing was flushed, so nothing counts as applied
+    assert gmail.calls['gmail.users.messages.batchModify'] == 0
+
+    make_runner(gmail, openai_client, tmp_path, batch_labels=True).run()
+    bodies = [params['body'] for method, params in gmail.requests if method == 'gmail.users.messages.batchModify']
+    assert [body['ids'] for body in bodies] == [['m0', 'm1', 'm2']]
+
+def test_incremental_batch_run_checkpoints_once_applied(gmail, openai_client, tmp_path):
+    history_file = str(tmp_path / 'history.json')
+    runner = make_runner(gmail, openai_client, tmp_path, history_file=history_file, incremental=True)
+    crash_on(runner, 'm2')
+    with pytest.raises(KeyboardInterrupt):
+        runner.run()
+    # The collected emails are not checkpointed until the resumed run applies them
+    assert load_history_id(history_file) is None
+
+    make_runner(gmail, openai_client, tmp_path, history_file=history_file, incremental=True).run()
+    assert load_history_id(history_file) == '100'
+    assert load_retry_ids(history_file) == []
+
+def test_failed_batch_is_resubmitted(gmail, server, openai_client, tmp_path):
+    server.fail_batches = 1
+    counts = make_runner(gmail, openai_client, tmp_path).run()
+    assert counts == {'AUTO_REPLY': 3}
+    assert len(server.batch_inputs) == 2
+    assert server.batch_inputs[1] == server.batch_inputs[0]
+
+def test_only_the_requests_an_expired_batch_missed_are_resubmitted(gmail, server, openai_client, tmp_path):
+    server.expire_after = 3
+    counts = make_runner(gmail, openai_client, tmp_path).run()
+    assert counts == {'AUTO_REPLY': 3}
+    assert server.batch_inputs[1] == ['m1:categorize', 'm2:summarize', 'm2:categorize']
+    assert len(gmail.sent) == 3
+
+def test_emails_left_uncategorized_are_retried_by_the_next_run(gmail, server, openai_client, tmp_path):
+    history_file = str(tmp_path / 'history.json')
+    server.fail_batches = batch_api.MAX_BATCH_ATTEMPTS
+    counts = make_runner(gmail, openai_client, tmp_path, history_file=history_file, incremental=True).run()
+    # Nothing was acted on or reported as an ERROR
+    assert counts == {}
+    assert not gmail.sent
+    assert load_retry_ids(history_file) == ['m0', 'm1', 'm2']
+
+    counts = make_runner(gmail, openai_client, tmp_path, history_file=history_file, incremental=True).run()
+    assert counts == {'AUTO_REPLY': 3}
+    assert load_retry_ids(history_file) == []
+
+def test_batch_results_are_cached_like_online_ones(gmail, server, openai_client, tmp_path):
+    cache = LLMCache(str(tmp_path / 'cache.db'))
+    runner = make_runner(gmail, openai_client, tmp_path, cache=cache)
+    runner.run()
+    content = 'Could you confirm order 1 has shipped?'
+    # The online path finds both batch replies without asking the server again
+    server.reply = server.category = 'NOT FROM THE CACHE'
+    assert runner.processor.summarize_email(content) == 'A short summary'
+    assert runner.processor.categorizer.categorize_email(content)['category'] == 'AUTO_REPLY'
+    assert runner.processor.categorizer.llm_decisions == 3
+    cache.close()
@@ -0,0 +1,64 @@
+import sqlite3
+import time
+from cache import LLMCache
+
+def test_key_ignores_whitespace_but_not_prompt():
+    key = LLMCache.make_key('Hello   there\n', 'model', 'prompt', 0.7)
+    assert key == LLMCache.make_key('Hello there', 'model', 'prompt', 0.7)
+    assert key != LLMCache.make_key('Hello there', 'model', 'new prompt', 0.7)
+    assert key != LLMCache.make_key('Hello there', 'model', 'prompt', 0.0)
+
+def test_hit_and_miss_are_counted_per_stage(tmp_path):
+    cache = LLMCache(str(tmp_path / 'cache.db'))
+    assert cache.get('summarize', 'k') is None
+    cache.set('summarize', 'k', {'category': 'AUTO_REPLY'})
+    assert cache.get('summarize', 'k') == {'category': 'AUTO_REPLY'}
+    assert cache.get_stats() == {'summarize': {'hits': 1, 'misses': 1, 'hit_rate': 0.5}}
+    cache.close()
+
+def test_entries_survive_reopening(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache = LLMCache(path)
+    cache.set('respond', 'k', 'reply')
+    cache.close()
+    cache = LLMCache(path)
+    assert cache.get('respond', 'k') == 'reply'
+    cache.close()
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = LLMCache(str(tmp_path / 'cache.db'), max_entries=2)
+    cache.set('summarize', 'a', 1)
+    time.sleep(0.01)
+    cache.set('summarize', 'b', 2)
+    time.sleep(0.01)
+    # Reading a makes b the least recently used
+    assert cache.get('summarize', 'a') == 1
+    time.sleep(0.01)
+    cache.set('summarize', 'c', 3)
+    assert cache.get('summarize', 'b') is None
+    assert cache.get('summarize', 'a') == 1
+    assert cache.get('summarize', 'c') == 3
+    cache.close()
+
+def test_expired_entries_are_misses(tmp_path):
+    cache = LLMCache(str(tmp_path / 'cache.db'), ttl=60)
+    cache.set('summarize', 'k', 'value')
+    cache._conn.execute("UPDATE llm_cache SET created_at = ?", (time.time() - 120,))
+    assert cache.get('summarize', 'k') is None
+    cache.purge_expired()
+    assert cache._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0] == 0
+    cache.close()
+
+def test_locked_database_is_a_miss(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache = LLMCache(path, timeout=0.1)
+    cache.set('summarize', 'k', 'summary')
+    # Another process holds the write lock for longer than the busy timeout
+    other = sqlite3.connect(path)
+    other.execute('BEGIN EXCLUSIVE')
+    assert cache.get('summarize', 'k') is None
+    assert cache.get_stats()['summarize']['misses'] == 1
+    other.rollback()
+    assert cache.get('summarize', 'k') == 'summary'
+    other.close()
+    cache.close()
@@ -0,0 +1,54 @@
+import json
+import pytest
+from cache import LLMCache
+from categorize import EmailCategorizer
+from main import EmailProcessor
+from tests.fakes import FakeGmail, FakeOpenAI, make_message
+
+EMAIL = 'Weekly newsletter: ten tips for spring'
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = LLMCache(str(tmp_path / 'cache.db'))
+    yield cache
+    cache.close()
+
+def analysis_reply(**fields):
+    return json.dumps(dict({'summary': 'Spring gardening tips.', 'category': 'NO_RESPONSE',
+                            'explanation': 'A newsletter'}, **fields))
+
+def test_one_fused_call_gives_the_summary_and_the_category():
+    openai_client = FakeOpenAI(analysis_reply(category=' no_response '))
+    analysis = EmailCategorizer(openai_client).analyze_email(EMAIL)
+    assert openai_client.calls == 1
+    assert analysis == {'summary': 'Spring gardening tips.', 'category': 'NO_RESPONSE',
+                        'explanation': 'A newsletter', 'original_content': EMAIL}
+
+def test_fused_processor_builds_the_usual_result_from_one_call():
+    openai_client = FakeOpenAI(analysis_reply())
+    processor = EmailProcessor(gmail_service=FakeGmail([make_message('m1', EMAIL)]), openai_client=openai_client,
+                               label_file=None, history_file=None, fused=True)
+    result = processor.process_message('m1', EMAIL, None)
+    assert openai_client.calls == 1
+    assert (result['summary'], result['category'], result['category_explanation']) == (
+        'Spring gardening tips.', 'NO_RESPONSE', 'A newsletter')
+
+@pytest.mark.parametrize('reply', ['Category: NO_RESPONSE', analysis_reply(category='SPAM'), '{"summary": "cut off'])
+def test_malformed_or_unknown_fused_replies_fall_back_to_an_error(reply, cache):
+    openai_client = FakeOpenAI(reply)
+    categorizer = EmailCategorizer(openai_client, cache=cache)
+    analysis = categorizer.analyze_email(EMAIL)
+    assert analysis['category'] == 'ERROR'
+    assert analysis['summary'] is None
+    # Nothing was cached, so the next attempt asks again
+    categorizer.analyze_email(EMAIL)
+    assert openai_client.calls == 2
+
+def test_unparsed_category_is_not_cached(cache):
+    openai_client = FakeOpenAI('I think this one is probably a newsletter.')
+    categorizer = EmailCategorizer(openai_client, cache=cache)
+    assert categorizer.categorize_email(EMAIL)['category'] not in ('NO_RESPONSE', 'ERROR')
+    openai_client.reply = 'NO_RESPONSE\nA newsletter'
+    assert categorizer.categorize_email(EMAIL)['category'] == 'NO_RESPONSE'
+    assert categorizer.categorize_email(EMAIL)['category'] == 'NO_RESPONSE'
+    assert openai_client.calls == 2
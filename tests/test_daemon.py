@@ -0,0 +1,43 @@
+import threading
+import time
+from daemon import WatchDaemon
+from main import EmailProcessor
+from read_gmail import load_retry_ids
+from tests.fakes import FakeGmail, FakeOpenAI, make_message
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+def test_email_that_errored_during_an_outage_is_retried_without_new_mail(tmp_path, limiter):
+    history_file = str(tmp_path / 'history.json')
+    gmail = FakeGmail([make_message('m1', 'Weekly newsletter: ten tips for spring')])
+    openai_client = FakeOpenAI('NO_RESPONSE\nA newsletter')
+    # The summary and categorization calls of the first pass fail, retries included
+    openai_client.fail(*[ConnectionError('OpenAI is down')] * (2 * (limiter.max_retries + 1)))
+    processor = EmailProcessor(gmail_service=gmail, openai_client=openai_client, label_file=None,
+                               history_file=history_file, incremental=True)
+    daemon = WatchDaemon(processor, port=0, min_interval=0.01, max_interval=0.05)
+    thread = threading.Thread(target=daemon.run)
+    thread.start()
+    try:
+        wait_until(lambda: daemon.passes >= 2 and not daemon.retry_pending)
+    finally:
+        daemon.stop()
+        thread.join()
+    # The mailbox never changed, yet the second pass labelled m1
+    assert processor.category_counts == {'NO_RESPONSE': 1}
+    assert load_retry_ids(history_file) == []
+
+def test_passes_count_only_emails_handled_without_an_error(tmp_path, limiter):
+    gmail = FakeGmail([make_message(f'm{i}', 'Weekly newsletter: ten tips for spring') for i in range(2)])
+    openai_client = FakeOpenAI('NO_RESPONSE\nA newsletter')
+    openai_client.fail(*[ConnectionError('OpenAI is down')] * (2 * (limiter.max_retries + 1)))
+    processor = EmailProcessor(gmail_service=gmail, openai_client=openai_client, label_file=None,
+                               history_file=str(tmp_path / 'history.json'), incremental=True, max_emails=2)
+    daemon = WatchDaemon(processor, port=0)
+    # An ERROR must not look like a full pass, which would re-trigger straight away
+    assert daemon.run_pass() == 1
+    assert daemon.retry_pending
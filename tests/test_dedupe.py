@@ -0,0 +1,55 @@
+import pytest
+from dedupe import NearDuplicateIndex, mask_fields, similarity
+
+ORDER = ("Hello, your order #{order} placed on {date} has shipped. Track it at https://ship.example.com/t/{order}. "
+         "Total ${total}. Contact support@shop.com with questions. Thanks for shopping with us!")
+FIRST = ORDER.format(order=48213, date='2024-03-05', total='45.20')
+SECOND = ORDER.format(order=99120, date='2024-04-11', total='12.00')
+UNRELATED = ("Hi Bob, can we move tomorrow's board meeting to 3pm? I need to discuss the acquisition "
+             "terms with you before the call.")
+SHIPPED = {'category': 'AUTO_REPLY', 'explanation': 'Shipping notice'}
+
+@pytest.fixture
+def index(tmp_path):
+    index = NearDuplicateIndex(str(tmp_path / 'clusters.db'))
+    yield index
+    index.close()
+
+def test_fields_are_masked():
+    masked, fields = mask_fields('Order #123 for bob@example.com, see https://x.example.com/a')
+    assert masked == 'order <num> for <email> see <url>'
+    assert fields == ['#123', 'bob@example.com', 'https://x.example.com/a']
+
+def test_emails_differing_only_in_fields_share_a_category(index):
+    assert index.lookup_category(FIRST) is None
+    index.remember_category(FIRST, SHIPPED)
+    category_info = index.lookup_category(SECOND)
+    assert category_info['category'] == 'AUTO_REPLY'
+    assert 'Near-duplicate of cluster' in category_info['explanation']
+    assert index.lookup_category(UNRELATED) is None
+    assert index.get_stats() == {'clusters': 1, 'saved_calls': {'categorize': 1}, 'total_saved': 1}
+
+def test_thresholds_decide_reuse(index):
+    # One extra word: close enough to share the category, not the reply
+    reworded = FIRST.replace('Thanks for', 'Many thanks for')
+    assert index.threshold <= similarity(index.fingerprint(FIRST)[2], index.fingerprint(reworded)[2]) \
+        < index.reply_threshold
+    index.remember_category(FIRST, SHIPPED)
+    index.remember_reply(FIRST, 'Thanks! Order #48213 is on its way.')
+    assert index.lookup_category(reworded)['category'] == 'AUTO_REPLY'
+    assert index.lookup_reply(reworded) is None
+
+def test_reused_reply_gets_the_new_emails_fields(index):
+    index.remember_reply(FIRST, 'Thanks! Order #48213 (total $45.20) is on its way.')
+    assert index.lookup_reply(SECOND) == 'Thanks! Order #99120 (total $12.00) is on its way.'
+
+def test_reply_mentioning_differing_words_is_not_reused(index):
+    appointment = ("Hi {name}, your appointment on 2024-03-05 at 10:30 with Dr. Smith is confirmed. "
+                   "Reply to reschedule. See you soon at our clinic.")
+    index.remember_reply(appointment.format(name='Alice'), 'Hi Alice, see you on 2024-03-05 at 10:30.')
+    assert index.lookup_reply(appointment.format(name='Carol')) is None
+
+def test_short_emails_are_not_clustered(index):
+    index.remember_category('Thanks!', SHIPPED)
+    assert index.lookup_category('Thanks!') is None
+    assert index.get_stats()['clusters'] == 0
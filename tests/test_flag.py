@@ -0,0 +1,86 @@
+import json
+from flag import BATCH_MODIFY_LIMIT, IMPORTANT_LABEL, EmailFlagger
+from tests.fakes import FakeGmail, http_error
+
+def batch_bodies(gmail):
+    return [params['body'] for method, params in gmail.requests
+            if method == 'gmail.users.messages.batchModify']
+
+def test_identical_changes_share_one_call():
+    gmail = FakeGmail()
+    flagger = EmailFlagger(gmail, label_file=None)
+    results = [flagger.queue_spam(f'm{i}') for i in range(5)]
+    assert flagger.pending_count() == 5
+    assert flagger.flush() == 1
+    assert batch_bodies(gmail) == [{'ids': [f'm{i}' for i in range(5)], 'addLabelIds': ['SPAM'],
+                                    'removeLabelIds': ['INBOX', 'UNSPAM']}]
+    assert all(result['success'] for result in results)
+    assert flagger.pending_count() == 0
+
+def test_groups_by_delta_and_chunks_at_the_limit():
+    gmail = FakeGmail()
+    flagger = EmailFlagger(gmail, label_file=None)
+    for i in range(BATCH_MODIFY_LIMIT + 1):
+        flagger.queue_spam(f'spam{i}')
+    flagger.queue_flag_important('human')
+    assert flagger.flush() == 3
+    bodies = batch_bodies(gmail)
+    assert sorted(len(body['ids']) for body in bodies) == [1, 1, BATCH_MODIFY_LIMIT]
+    important = next(body for body in bodies if body['ids'] == ['human'])
+    assert important['addLabelIds'] == sorted(['IMPORTANT', 'Label_1', 'STARRED'])
+    assert important['removeLabelIds'] == ['UNIMPORTANT']
+
+def test_later_change_to_a_message_wins():
+    gmail = FakeGmail()
+    flagger = EmailFlagger(gmail, label_file=None)
+    flagger.queue_label_change('m1', add_labels=['A'], remove_labels=['B'])
+    flagger.queue_label_change('m1', add_labels=['B'])
+    flagger.flush()
+    assert batch_bodies(gmail) == [{'ids': ['m1'], 'addLabelIds': ['A', 'B'], 'removeLabelIds': []}]
+
+def test_failed_batch_marks_its_results_failed():
+    gmail = FakeGmail()
+    gmail.fail('gmail.users.messages.batchModify', http_error(400, b'Invalid request'))
+    flagger = EmailFlagger(gmail, label_file=None)
+    result = flagger.queue_spam('m1')
+    flagger.flush()
+    assert result['success'] is False
+    assert 'Invalid request' in result['error']
+
+def test_label_id_is_created_once_and_saved(tmp_path):
+    label_file = tmp_path / 'labels.json'
+    gmail = FakeGmail()
+    assert EmailFlagger(gmail, label_file=str(label_file)).important_label_id == 'Label_1'
+    assert json.loads(label_file.read_text()) == {IMPORTANT_LABEL: 'Label_1'}
+    # A later run reads the saved id without any label calls
+    gmail.calls.clear()
+    assert EmailFlagger(gmail, label_file=str(label_file)).important_label_id == 'Label_1'
+    assert not gmail.calls
+
+def test_deleted_label_is_looked_up_again(tmp_path):
+    label_file = tmp_path / 'labels.json'
+    label_file.write_text(json.dumps({IMPORTANT_LABEL: 'Label_gone'}))
+    gmail = FakeGmail()
+    gmail.fail('gmail.users.messages.modify', http_error(400, b'Invalid label: Label_gone'))
+    result = EmailFlagger(gmail, label_file=str(label_file)).flag_important_email('m1')
+    assert result['success']
+    assert json.loads(label_file.read_text()) == {IMPORTANT_LABEL: 'Label_1'}
+
+def test_nothing_is_queued_without_a_label_id():
+    gmail = FakeGmail()
+    gmail.fail('gmail.users.labels.list', http_error(400, b'Bad request'))
+    flagger = EmailFlagger(gmail, label_file=None)
+    result = flagger.queue_flag_important('m1')
+    assert result['success'] is False
+    assert flagger.pending_count() == 0
+
+def test_one_failed_group_does_not_lose_the_others():
+    gmail = FakeGmail()
+    flagger = EmailFlagger(gmail, label_file=None)
+    broken = flagger.queue_label_change('m1', add_labels=[None, 'STARRED'], result={'success': True})
+    spam = flagger.queue_spam('m2')
+    important = flagger.queue_flag_important('m3')
+    flagger.flush()
+    assert broken['success'] is False
+    assert spam['success'] and important['success']
+    assert [body['ids'] for body in batch_bodies(gmail)] == [['m2'], ['m3']]
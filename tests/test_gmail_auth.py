@@ -0,0 +1,66 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from google.oauth2.credentials import Credentials
+from gmail_auth import SharedCredentials
+
+THREADS = 16
+
+def expired_credentials():
+    return SharedCredentials(token='expired', refresh_token='refresh', client_id='id', client_secret='secret',
+                             token_uri='https://oauth2.example.com/token',
+                             expiry=datetime.utcnow() - timedelta(hours=1))
+
+def counting_refresh(monkeypatch):
+    """Replace the OAuth refresh with one that hands out numbered tokens."""
+    refreshes = []
+
+    def refresh(self, request):
+        refreshes.append(request)
+        time.sleep(0.05)
+        self.token = f'token{len(refreshes)}'
+        self.expiry = datetime.utcnow() + timedelta(hours=1)
+    monkeypatch.setattr(Credentials, 'refresh', refresh)
+    return refreshes
+
+def test_threads_share_a_single_refresh(monkeypatch):
+    refreshes = counting_refresh(monkeypatch)
+    creds = expired_credentials()
+    start = threading.Barrier(THREADS)
+    sent = []
+
+    def send():
+        headers = {}
+        start.wait()
+        creds.before_request(None, 'GET', 'https://gmail.googleapis.com/', headers)
+        sent.append(headers['authorization'])
+
+    # Fresh threads that have never sent a request all find the token expired at once
+    threads = [threading.Thread(target=send) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(refreshes) == 1
+    assert sent == ['Bearer token1'] * THREADS
+
+def test_stale_token_is_not_refreshed_twice(monkeypatch):
+    refreshes = counting_refresh(monkeypatch)
+    creds = expired_credentials()
+    creds.before_request(None, 'GET', 'https://gmail.googleapis.com/', {})
+    # This thread sent token1; another thread refreshed it before this one got its 401
+    creds._local.token = 'token0'
+    creds.refresh(None)
+    assert len(refreshes) == 1
+
+    # A 401 for the token this thread just sent does refresh it
+    creds.before_request(None, 'GET', 'https://gmail.googleapis.com/', {})
+    creds.refresh(None)
+    assert creds.token == 'token2'
+
+def test_refreshed_token_is_saved(monkeypatch, tmp_path):
+    counting_refresh(monkeypatch)
+    creds = expired_credentials()
+    creds.token_file = str(tmp_path / 'token.json')
+    creds.refresh(None)
+    assert '"token": "token1"' in (tmp_path / 'token.json').read_text()
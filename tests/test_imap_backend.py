@@ -0,0 +1,145 @@
+import time
+from types import SimpleNamespace
+import pytest
+import imap_backend
+from imap_backend import ImapMailbox, ImapPool, connect_imap, message_set
+from tests.imap_server import FakeImapServer
+
+def raw_email(n, body=None):
+    body = body or f'Could you confirm that order {n} has shipped?'
+    return (f'From: Customer {n} <c{n}@example.com>\r\nTo: me@example.com\r\n'
+            f'Subject: =?utf-8?q?Order_{n}_=E2=9C=93?=\r\nMessage-ID: <{n}@example.com>\r\n'
+            f'X-Mailer: ignored\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n{body}\r\n').encode()
+
+@pytest.fixture
+def server():
+    server = FakeImapServer()
+    for n in range(1, 8):
+        server.add(raw_email(n))
+    yield server
+    server.stop()
+
+@pytest.fixture
+def connect(server):
+    return lambda: connect_imap('me@example.com', 'secret', '127.0.0.1', server.port, use_ssl=False)
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record the pool's sleeps instead of waiting them out."""
+    sleeps = []
+    monkeypatch.setattr(imap_backend, 'time', SimpleNamespace(sleep=sleeps.append, monotonic=time.monotonic))
+    return sleeps
+
+def fetched_sets(server):
+    return [fetch[0] for fetch in server.fetches]
+
+def test_message_set_compresses_ranges():
+    assert message_set([12, 1, 2, 3, 5, 10, 11, 3]) == '1:3,5,10:12'
+
+def test_fetch_sends_one_command_per_batch_of_uid_ranges(server, connect):
+    mailbox = ImapMailbox(connect(), state_file=None, batch_size=3)
+    mailbox.select()
+    fetched = mailbox.fetch([1, 2, 3, 4, 5, 7])
+    assert sorted(fetched) == [1, 2, 3, 4, 5, 7]
+    assert fetched_sets(server) == ['1:3', '4:5,7']
+    message, body = fetched[7]
+    assert message['id'] == 'imap-42-7' and message['labelIds'] == ['INBOX']
+    assert body.strip() == 'Could you confirm that order 7 has shipped?'
+    mailbox.close()
+
+def test_fetch_peeks_at_headers_and_the_start_of_the_text(server, connect):
+    server.add(raw_email(8, body='x' * 5000))
+    mailbox = ImapMailbox(connect(), state_file=None, text_bytes=100)
+    mailbox.select()
+    message, body = mailbox.fetch([1, 8])[8]
+    items = server.fetches[0][1]
+    assert 'BODY.PEEK[HEADER.FIELDS (' in items and 'BODY.PEEK[TEXT]<0.100>' in items
+    # Nothing was marked as read and only the first 100 bytes of the text came back
+    assert not server.seen
+    assert body == 'x' * 100
+    headers = {header['name']: header['value'] for header in message['payload']['headers']}
+    assert headers['Subject'] == 'Order 8 ✓'
+    assert 'X-Mailer' not in headers
+    assert message['sizeEstimate'] > 5000
+    mailbox.close()
+
+def test_gmail_ids_are_used_when_the_server_has_them():
+    server = FakeImapServer(gmail_extensions=True)
+    server.add(raw_email(1))
+    try:
+        imap = connect_imap('me@example.com', 'secret', '127.0.0.1', server.port, use_ssl=False)
+        mailbox = ImapMailbox(imap, state_file=None)
+        mailbox.select()
+        message, _ = mailbox.fetch([1])[1]
+        assert 'X-GM-MSGID X-GM-THRID' in server.fetches[0][1]
+        assert (message['id'], message['threadId']) == (format(1001, 'x'), format(501, 'x'))
+        mailbox.close()
+    finally:
+        server.stop()
+
+def test_pool_spreads_batches_over_connections(server, connect, sleeps):
+    pool = ImapPool(connect, connections=2, state_file=None, batch_size=2)
+    pool.select()
+    fetched = pool.fetch(range(1, 8))
+    assert sorted(fetched) == list(range(1, 8))
+    assert sorted(fetched_sets(server)) == ['1:2', '3:4', '5:6', '7']
+    assert server.logins <= 3
+    pool.close()
+
+def test_pool_reconnects_and_retries_a_dropped_batch(server, connect, sleeps):
+    pool = ImapPool(connect, connections=1, state_file=None, batch_size=4)
+    pool.select()
+    server.drop_fetches = 1
+    fetched = pool.fetch(range(1, 8))
+    assert sorted(fetched) == list(range(1, 8))
+    # The dropped first batch was fetched again on a new connection
+    assert fetched_sets(server) == ['1:4', '1:4', '5:7']
+    assert server.logins == 3
+    assert 1 in sleeps
+    pool.close()
+
+def test_pool_doubles_its_interval_while_throttled(server, connect, sleeps):
+    pool = ImapPool(connect, connections=1, state_file=None, batch_size=4)
+    pool.select()
+    server.throttle_fetches = 2
+    fetched = pool.fetch_batch([1, 2, 3])
+    assert sorted(fetched) == [1, 2, 3]
+    mailbox = pool._available.get_nowait()
+    assert mailbox.interval == 2.0
+    assert sleeps == [0.0, pytest.approx(1.0, abs=0.1), pytest.approx(2.0, abs=0.1)]
+    pool.close()
+
+def test_pool_gives_up_on_errors_other_than_throttling(server, connect, sleeps, monkeypatch):
+    pool = ImapPool(connect, connections=1, state_file=None, batch_size=4)
+    pool.select()
+    monkeypatch.setattr(ImapMailbox, 'fetch_items', lambda self: '(UID FLAGS)')
+    with pytest.raises(imap_backend.imaplib.IMAP4.error, match='BAD|unsupported'):
+        pool.fetch_batch([1, 2])
+    assert len(server.fetches) == 1
+    pool.close()
+
+def test_sync_tracks_the_last_uid_between_runs(server, connect, tmp_path):
+    mailbox = ImapMailbox(connect(), state_file=str(tmp_path / 'imap_state.json'))
+    # The first sync takes the newest messages and starts tracking from there
+    assert list(mailbox.sync_uids(max_results=3)) == [7, 6, 5]
+    assert not mailbox.has_new_mail()
+    assert list(mailbox.sync_uids()) == []
+
+    for n in range(8, 11):
+        server.add(raw_email(n))
+    assert mailbox.has_new_mail()
+    uids = mailbox.sync_uids()
+    assert next(uids) == 8
+    uids.close()
+    # Only what was consumed counts as synced
+    assert mailbox.load_state() == {'uidvalidity': 42, 'last_uid': 8}
+    assert list(mailbox.sync_uids()) == [9, 10]
+    mailbox.close()
+
+def test_sync_starts_over_when_uidvalidity_changes(server, connect, tmp_path):
+    mailbox = ImapMailbox(connect(), state_file=str(tmp_path / 'imap_state.json'))
+    list(mailbox.sync_uids())
+    server.uidvalidity = 43
+    assert list(mailbox.sync_uids(max_results=2)) == [7, 6]
+    assert mailbox.load_state() == {'uidvalidity': 43, 'last_uid': 7}
+    mailbox.close()
@@ -0,0 +1,96 @@
+import pytest
+from journal import JobJournal, reply_message_id
+from main import EmailProcessor
+from tests.fakes import FakeGmail, FakeOpenAI, make_message
+
+AUTO_REPLY = {'category': 'AUTO_REPLY', 'explanation': 'Asks for a status update'}
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return str(tmp_path / 'journal.db')
+
+def make_processor(gmail, journal_path, openai_client=None):
+    return EmailProcessor(gmail_service=gmail, openai_client=openai_client or FakeOpenAI(),
+                          journal=JobJournal(journal_path), label_file=None, history_file=None)
+
+def test_reply_message_id_is_deterministic():
+    assert reply_message_id('m1') == reply_message_id('m1')
+    assert reply_message_id('m1') != reply_message_id('m2')
+    assert reply_message_id('m1').endswith('.autoreply@email-processor>')
+
+def test_stages_are_recorded_and_resumed(journal_path):
+    journal = JobJournal(journal_path)
+    journal.record_fetched(['m1', 'm2'])
+    journal.record_analysis('m1', 'summary', dict(AUTO_REPLY, confidence=0.9))
+    journal.record_response('m1', 'reply')
+    journal.record_sent('m1', 'sent1')
+    journal.record_result({'id': 'm1', 'category': 'AUTO_REPLY', 'auto_response': {'send_success': True}})
+    journal.close()
+
+    journal = JobJournal(journal_path)
+    assert journal.done_ids(['m1', 'm2']) == {'m1'}
+    assert journal.resume_analysis('m1') == ('summary', AUTO_REPLY)
+    assert journal.resume_analysis('m2') == (None, None)
+    assert journal.get('m1')['response_text'] == 'reply'
+    assert journal.get_stats() == {'skipped': 1, 'resumed': 1}
+    journal.close()
+
+def test_failed_label_change_is_not_done(journal_path):
+    journal = JobJournal(journal_path)
+    journal.record_result({'id': 'm1', 'category': 'NO_RESPONSE', 'spam_status': {'success': False}})
+    journal.record_result({'id': 'm2', 'category': 'NO_RESPONSE', 'spam_status': {'success': True}})
+    assert journal.done_ids(['m1', 'm2']) == {'m2'}
+    assert journal.get('m2')['labeled_at'] is not None
+    journal.close()
+
+def test_reply_is_not_sent_twice_after_a_crash(journal_path):
+    message = make_message('m1', 'Could you confirm my order shipped?')
+    gmail = FakeGmail([message])
+    openai_client = FakeOpenAI()
+    # The send reaches Gmail but the run dies before it hears back
+    gmail.lose_responses('gmail.users.messages.send', RuntimeError('process killed'))
+    first = make_processor(gmail, journal_path, openai_client)
+    result = first.process_message('m1', 'Could you confirm my order shipped?', dict(AUTO_REPLY), message)
+    assert not result['auto_response']['send_success']
+    assert len(gmail.sent) == 1
+    assert gmail.sent[0]['message_id_header'] == reply_message_id('m1')
+    first.journal.close()
+
+    second = make_processor(gmail, journal_path, openai_client)
+    result = second.process_message('m1', 'Could you confirm my order shipped?', dict(AUTO_REPLY), message)
+    details = result['auto_response']['send_details']
+    assert details['already_sent'] and details['message_id'] == 'sent1'
+    assert len(gmail.sent) == 1
+    # The stored reply text was reused rather than generated again
+    assert openai_client.calls == 1
+    second.journal.close()
+
+def test_confirmed_send_skips_the_mailbox_lookup(journal_path):
+    message = make_message('m1', 'Please confirm the meeting time.')
+    gmail = FakeGmail([message])
+    first = make_processor(gmail, journal_path)
+    first.process_message('m1', 'Please confirm the meeting time.', dict(AUTO_REPLY), message)
+    first.journal.close()
+
+    gmail.calls.clear()
+    second = make_processor(gmail, journal_path)
+    result = second.process_message('m1', 'Please confirm the meeting time.', dict(AUTO_REPLY), message)
+    assert result['auto_response']['send_details']['already_sent']
+    assert not gmail.calls
+    second.journal.close()
+
+def test_send_is_not_repeated_after_a_dropped_connection(journal_path):
+    message = make_message('m1', 'Could you confirm my order shipped?')
+    gmail = FakeGmail([message])
+    # Gmail accepted the send but the connection dropped before the response
+    gmail.lose_responses('gmail.users.messages.send', ConnectionError('connection reset'))
+    processor = make_processor(gmail, journal_path)
+    result = processor.process_message('m1', 'Could you confirm my order shipped?', dict(AUTO_REPLY), message)
+    assert not result['auto_response']['send_success']
+    assert len(gmail.sent) == 1
+
+    # The next run finds the reply in Sent instead of sending it again
+    result = processor.process_message('m1', 'Could you confirm my order shipped?', dict(AUTO_REPLY), message)
+    assert result['auto_response']['send_details']['already_sent']
+    assert len(gmail.sent) == 1
+    processor.journal.close()
@@ -0,0 +1,46 @@
+import pytest
+from categorize import CATEGORIES, EmailCategorizer
+from local_model import LabelLog, NaiveBayesModel, train
+
+EXAMPLES = {
+    'HUMAN_NEEDED': 'Can we talk about the contract renewal and my concerns with the pricing {n}?',
+    'AUTO_REPLY': 'Please confirm you received my order number {n} and when it ships.',
+    'NO_RESPONSE': 'Weekly newsletter {n}: our latest deals and product news, unsubscribe anytime.',
+}
+
+def write_log(path, per_category, categories=CATEGORIES):
+    log = LabelLog(str(path))
+    for category in categories:
+        for n in range(per_category):
+            log.append(EXAMPLES[category].format(n=n), category)
+    return str(path)
+
+def test_trains_once_every_category_has_enough_examples(tmp_path):
+    log_path = write_log(tmp_path / 'log.jsonl', 5)
+    model_path = str(tmp_path / 'model.bin')
+    report = train(log_path, model_path, min_per_category=5)
+    assert report['trained_on'] == 15
+    model = NaiveBayesModel.load(model_path)
+    assert sorted(model.classes) == sorted(CATEGORIES)
+    category, confidence = model.predict('Please confirm you received my order number 77.')
+    assert category == 'AUTO_REPLY' and confidence > 0.9
+
+def test_refuses_to_train_with_a_category_missing(tmp_path):
+    log_path = write_log(tmp_path / 'log.jsonl', 50, categories=['AUTO_REPLY'])
+    with pytest.raises(ValueError, match='HUMAN_NEEDED'):
+        train(log_path, str(tmp_path / 'model.bin'))
+
+def test_refuses_to_train_with_too_few_examples(tmp_path):
+    log_path = write_log(tmp_path / 'log.jsonl', 3)
+    with pytest.raises(ValueError, match='at least 5'):
+        train(log_path, str(tmp_path / 'model.bin'), min_per_category=5)
+
+def test_no_confidence_without_examples_of_every_category():
+    examples = [(EXAMPLES['AUTO_REPLY'].format(n=n), 'AUTO_REPLY') for n in range(10)]
+    model = NaiveBayesModel.fit(examples, classes=CATEGORIES)
+    assert model.predict(EXAMPLES['AUTO_REPLY'].format(n=3)) == ('AUTO_REPLY', 0.0)
+
+def test_categorizer_ignores_a_model_missing_categories():
+    examples = [(EXAMPLES['AUTO_REPLY'].format(n=n), 'AUTO_REPLY') for n in range(10)]
+    categorizer = EmailCategorizer(None, local_model=NaiveBayesModel.fit(examples))
+    assert categorizer.local_model is None
@@ -0,0 +1,62 @@
+import sqlite3
+from collections import Counter
+import pytest
+import main
+import mailboxes
+from local_model import NaiveBayesModel
+from mailboxes import load_manifest, mailbox_path, process_mailbox
+from metrics import metrics
+
+class RecordingProcessor:
+    """Stands in for EmailProcessor, keeping the arguments it was built with."""
+    built = []
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.run_metrics = metrics.snapshot()
+        RecordingProcessor.built.append(self)
+
+    def process_emails(self):
+        return Counter({'AUTO_REPLY': 1})
+
+@pytest.fixture
+def processors(monkeypatch):
+    RecordingProcessor.built = []
+    monkeypatch.setattr(main, 'EmailProcessor', RecordingProcessor)
+    monkeypatch.setattr(mailboxes, 'authenticate_gmail', lambda token, credentials: None)
+    return RecordingProcessor.built
+
+def test_mailbox_path_adds_the_name():
+    assert mailbox_path('data/journal.db', 'support') == 'data/journal_support.db'
+
+def test_manifest_rejects_duplicate_names(tmp_path):
+    path = tmp_path / 'mailboxes.json'
+    path.write_text('[{"name": "a", "token": "a.json"}, {"name": "a", "token": "b.json"}]')
+    with pytest.raises(ValueError, match='Duplicate'):
+        load_manifest(str(path))
+
+def test_options_reach_each_mailbox_with_their_own_paths(processors, tmp_path):
+    model_path = str(tmp_path / 'model.bin')
+    NaiveBayesModel.fit([('Please confirm my order', 'AUTO_REPLY')]).save(model_path)
+    options = {
+        'cache': str(tmp_path / 'cache.db'), 'cache_max_entries': 10, 'cache_ttl': None,
+        'local_model': model_path,
+        'label_log': str(tmp_path / 'labels.jsonl'),
+        'dedupe': str(tmp_path / 'dedupe.db'), 'dedupe_threshold': 0.9, 'reply_threshold': 0.95,
+        'metrics_report': str(tmp_path / 'metrics.json'),
+        'processor': {'confidence_threshold': 0.8}
+    }
+    result = process_mailbox({'name': 'support', 'token': 'support.json'}, options)
+    assert result['success'] and result['emails'] == 1
+
+    kwargs = processors[0].kwargs
+    assert kwargs['local_model'].classes == ['AUTO_REPLY']
+    assert kwargs['confidence_threshold'] == 0.8
+    assert kwargs['label_log'].path == str(tmp_path / 'labels_support.jsonl')
+    assert kwargs['metrics_report'] == str(tmp_path / 'metrics_support.json')
+    assert kwargs['dedupe'].threshold == 0.9
+    assert (tmp_path / 'dedupe_support.db').exists()
+    # The LLM cache is shared by every mailbox, and each worker closes its connection when done
+    assert (tmp_path / 'cache.db').exists()
+    with pytest.raises(sqlite3.ProgrammingError):
+        kwargs['cache']._conn.execute('SELECT 1')
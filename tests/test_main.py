@@ -0,0 +1,149 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+import pytest
+from journal import JobJournal
+from main import EmailProcessor
+from read_gmail import load_history_id, load_retry_ids
+from tests.fakes import FakeGmail, FakeOpenAI, make_message
+
+@pytest.fixture
+def history_file(tmp_path):
+    return str(tmp_path / 'history.json')
+
+def make_processor(gmail, openai_client, history_file, **options):
+    return EmailProcessor(gmail_service=gmail, openai_client=openai_client, label_file=None,
+                          history_file=history_file, incremental=True, **options)
+
+def outage(openai_client, limiter, calls):
+    """Fail the next calls, retries included."""
+    openai_client.fail(*[ConnectionError('OpenAI is down')] * (calls * (limiter.max_retries + 1)))
+
+@pytest.mark.parametrize('concurrent', [False, True])
+def test_email_that_errored_is_retried_by_the_next_incremental_run(history_file, limiter, concurrent):
+    gmail = FakeGmail([make_message('m1', 'Weekly newsletter: ten tips for spring')])
+    openai_client = FakeOpenAI('NO_RESPONSE\nA newsletter')
+    # Both the summary and the categorization call fail
+    outage(openai_client, limiter, calls=2)
+    processor = make_processor(gmail, openai_client, history_file, concurrent=concurrent)
+    assert processor.process_emails() == {'ERROR': 1}
+    # The checkpoint moved past m1 but m1 is kept for the next run
+    assert load_history_id(history_file) == '100'
+    assert load_retry_ids(history_file) == ['m1']
+
+    assert make_processor(gmail, openai_client, history_file).process_emails() == {'NO_RESPONSE': 1}
+    assert load_retry_ids(history_file) == []
+    # Nothing new arrived, so the run after that has nothing to do
+    assert make_processor(gmail, openai_client, history_file).process_emails() == {}
+
+def test_successful_emails_are_not_retried(history_file, limiter):
+    gmail = FakeGmail([make_message('m1', 'Weekly newsletter: ten tips for spring'),
+                       make_message('m2', 'Monthly digest of product updates')])
+    openai_client = FakeOpenAI('NO_RESPONSE\nA newsletter')
+    # Only the first email's summary and categorization calls fail
+    outage(openai_client, limiter, calls=2)
+    assert make_processor(gmail, openai_client, history_file).process_emails() == {'ERROR': 1, 'NO_RESPONSE': 1}
+    assert load_retry_ids(history_file) == ['m1']
+
+    gmail.calls.clear()
+    assert make_processor(gmail, openai_client, history_file).process_emails() == {'NO_RESPONSE': 1}
+    assert gmail.calls['gmail.users.messages.get'] == 1
+
+def test_checkpoint_waits_for_queued_label_changes(history_file):
+    gmail = FakeGmail([make_message('m1', 'Weekly newsletter: ten tips for spring')])
+    processor = make_processor(gmail, FakeOpenAI('NO_RESPONSE\nA newsletter'), history_file, batch_labels=True)
+    processor.start_run()
+    for chunk in processor.list_chunks():
+        for msg_id, email_content, category_info, message in processor.fetch_chunk(chunk):
+            processor.report(processor.process_message(msg_id, email_content, category_info, message))
+        processor.note_listed(chunk)
+        processor.save_checkpoint()
+    # The label change is still queued, so a crash now must list m1 again
+    assert load_history_id(history_file) is None
+    processor.finish_run()
+    assert load_history_id(history_file) == '100'
+
+def test_unfinished_journal_entries_are_requeued(history_file, tmp_path):
+    gmail = FakeGmail([make_message('m1', 'Weekly newsletter: ten tips for spring')])
+    openai_client = FakeOpenAI('NO_RESPONSE\nA newsletter')
+    journal = JobJournal(str(tmp_path / 'journal.db'))
+    # An earlier run fetched m1 and died before finishing it, after the checkpoint moved on
+    journal.record_fetched(['m1'])
+    with open(history_file, 'w') as checkpoint:
+        checkpoint.write('{"historyId": "100"}')
+    counts = make_processor(gmail, openai_client, history_file, journal=journal).process_emails()
+    assert counts == {'NO_RESPONSE': 1}
+    assert journal.unfinished_ids() == []
+    journal.close()
+
+class Probe:
+    """Wraps a function to hold each call for `delay` seconds and record the peak concurrency."""
+    def __init__(self, delay):
+        self.delay = delay
+        self.active = 0
+        self.peak = 0
+        self.finished = []
+        self.lock = threading.Lock()
+
+    def wrap(self, function):
+        def probed(*args, **kwargs):
+            with self.lock:
+                self.active += 1
+                self.peak = max(self.peak, self.active)
+            try:
+                time.sleep(self.delay(*args, **kwargs) if callable(self.delay) else self.delay)
+                return function(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    self.finished.append((args, kwargs))
+        return probed
+
+def newsletters(count):
+    return FakeGmail([make_message(f'm{i}', f'Weekly newsletter {i}: ten tips for spring') for i in range(count)])
+
+def make_concurrent(gmail, openai_client, **options):
+    return EmailProcessor(gmail_service=gmail, openai_client=openai_client, label_file=None, history_file=None,
+                          concurrent=True, **options)
+
+def test_summary_and_category_of_one_email_are_requested_side_by_side():
+    openai_client = FakeOpenAI('NO_RESPONSE\nA newsletter')
+    llm = Probe(0.1)
+    openai_client.chat.completions.create = llm.wrap(openai_client.create)
+    make_concurrent(newsletters(1), openai_client, llm_workers=2).process_emails()
+    assert llm.peak == 2
+
+def test_stages_stay_within_their_own_worker_limits():
+    openai_client = FakeOpenAI('NO_RESPONSE\nA newsletter')
+    llm = Probe(0.05)
+    openai_client.chat.completions.create = llm.wrap(openai_client.create)
+    processor = make_concurrent(newsletters(6), openai_client, llm_workers=3, gmail_workers=2, max_emails=6)
+    labels = Probe(0.2)
+    processor.apply_labels = labels.wrap(processor.apply_labels)
+    assert processor.process_emails() == {'NO_RESPONSE': 6}
+    assert llm.peak == 3
+    assert labels.peak == 2
+
+def test_results_are_reported_in_inbox_order_whatever_finishes_first():
+    openai_client = FakeOpenAI('NO_RESPONSE\nA newsletter')
+    # The first email's analysis is by far the slowest
+    llm = Probe(lambda **kwargs: 0.3 if 'newsletter 0' in str(kwargs['messages']) else 0.01)
+    openai_client.chat.completions.create = llm.wrap(openai_client.create)
+    processor = make_concurrent(newsletters(4), openai_client, llm_workers=8)
+    reported = []
+    report = processor.report
+    processor.report = lambda result: (reported.append(result['id']), report(result))
+    processor.process_emails()
+    finished = ['newsletter 0' in str(kwargs['messages']) for _, kwargs in llm.finished]
+    assert finished[-2:] == [True, True]
+    assert reported == ['m0', 'm1', 'm2', 'm3']
+
+def test_importing_main_leaves_the_api_clients_unloaded():
+    # A fresh interpreter, since this one has imported them already
+    code = ("import sys, main; "
+            "print(sorted(name for name in ('openai', 'googleapiclient.discovery') if name in sys.modules))")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True, check=True)
+    assert output.stdout.strip() == '[]'
@@ -0,0 +1,79 @@
+import urllib.request
+from types import SimpleNamespace
+import pytest
+from daemon import WatchDaemon
+from metrics import Metrics, metrics
+
+@pytest.fixture
+def recorded():
+    recorded = Metrics(buckets=(0.01, 0.1, 1.0))
+    for seconds in (0.01, 0.05, 0.05, 5.0):
+        recorded.observe('summarize', seconds)
+    recorded.observe('summarize', 0.2, error=True)
+    recorded.record_retry('summarize', 2)
+    recorded.record_quota('gmail_fetch', 15)
+    recorded.observe('gmail_fetch', 0.001)
+    recorded.record_tokens('summarize', SimpleNamespace(prompt_tokens=120, completion_tokens=30))
+    return recorded
+
+def test_latencies_land_in_the_first_bucket_they_fit(recorded):
+    # A latency equal to a bound counts in that bucket; anything above the last goes to +Inf
+    assert recorded.snapshot()['latency_buckets']['summarize'] == [1, 2, 1, 1]
+
+def test_quantiles_interpolate_within_a_bucket():
+    recorded = Metrics(buckets=(0.005, 0.01))
+    for _ in range(10):
+        recorded.observe('categorize', 0.007)
+    counts = recorded.snapshot()['latency_buckets']['categorize']
+    assert recorded.quantile(counts, 0.5) == pytest.approx(0.0075)
+    assert recorded.quantile(counts, 0.99) == pytest.approx(0.00995)
+    assert recorded.quantile([0, 0, 0], 0.5) == 0.0
+
+def test_report_covers_only_what_happened_since_a_snapshot(recorded):
+    before = recorded.snapshot()
+    recorded.observe('summarize', 0.05)
+    recorded.record_retry('summarize')
+    report = recorded.get_report(since=before)
+    assert list(report) == ['summarize']
+    assert (report['summarize']['calls'], report['summarize']['retries'], report['summarize']['errors']) == (1, 1, 0)
+    assert report['summarize']['latency_mean_seconds'] == pytest.approx(0.05)
+
+    totals = recorded.get_report()['summarize']
+    assert (totals['calls'], totals['errors'], totals['retries']) == (6, 1, 3)
+    assert (totals['prompt_tokens'], totals['completion_tokens']) == (120, 30)
+
+def test_prometheus_text_exposition(recorded):
+    lines = recorded.to_prometheus().splitlines()
+    assert '# TYPE email_processor_stage_calls_total counter' in lines
+    assert 'email_processor_stage_calls_total{stage="summarize"} 5' in lines
+    assert 'email_processor_stage_errors_total{stage="summarize"} 1' in lines
+    assert 'email_processor_stage_retries_total{stage="summarize"} 2' in lines
+    assert 'email_processor_gmail_quota_units_total{stage="gmail_fetch"} 15' in lines
+    assert 'email_processor_openai_tokens_total{stage="summarize",kind="prompt"} 120' in lines
+    assert 'email_processor_openai_tokens_total{stage="summarize",kind="completion"} 30' in lines
+    # Histogram buckets are cumulative and end with +Inf, which equals the count
+    histogram = [line for line in lines if line.startswith('email_processor_stage_latency_seconds')
+                 and 'stage="summarize"' in line]
+    assert histogram == [
+        'email_processor_stage_latency_seconds_bucket{stage="summarize",le="0.01"} 1',
+        'email_processor_stage_latency_seconds_bucket{stage="summarize",le="0.1"} 3',
+        'email_processor_stage_latency_seconds_bucket{stage="summarize",le="1.0"} 4',
+        'email_processor_stage_latency_seconds_bucket{stage="summarize",le="+Inf"} 5',
+        f'email_processor_stage_latency_seconds_sum{{stage="summarize"}} {0.01 + 0.05 + 0.05 + 5.0 + 0.2}',
+        'email_processor_stage_latency_seconds_count{stage="summarize"} 5',
+    ]
+    assert '# TYPE email_processor_stage_latency_seconds histogram' in lines
+
+def test_daemon_serves_the_metrics_endpoint():
+    metrics.observe('test_endpoint', 0.02)
+    daemon = WatchDaemon(SimpleNamespace(), port=0)
+    daemon.start_server()
+    try:
+        url = f'http://127.0.0.1:{daemon.server.server_port}/metrics'
+        with urllib.request.urlopen(url) as response:
+            assert response.headers['Content-Type'] == 'text/plain; version=0.0.4'
+            body = response.read().decode()
+    finally:
+        daemon.server.shutdown()
+        daemon.server.server_close()
+    assert 'email_processor_stage_calls_total{stage="test_endpoint"} 1' in body.splitlines()
@@ -0,0 +1,55 @@
+import base64
+from mime import NO_TEXT_CONTENT, decode_part_body, decode_payload, html_to_text
+from tests.fakes import encode_body
+
+def part(mime_type, text, **extra):
+    return dict({'mimeType': mime_type, 'body': {'data': encode_body(text)}}, **extra)
+
+def test_prefers_plain_text_in_alternative():
+    payload = {'mimeType': 'multipart/alternative', 'parts': [
+        part('text/plain', 'plain body'), part('text/html', '<p>html body</p>')]}
+    assert decode_payload(payload) == 'plain body'
+
+def test_falls_back_to_html_text():
+    payload = {'mimeType': 'multipart/alternative', 'parts': [
+        part('text/html', '<style>p {}</style><p>Hello&nbsp;<b>there</b></p><script>x()</script><p>Bye</p>')]}
+    assert decode_payload(payload) == 'Hello there\n\nBye'
+
+def test_walks_nested_multipart_and_skips_attachments():
+    payload = {'mimeType': 'multipart/mixed', 'parts': [
+        part('text/plain', 'attached notes', filename='notes.txt'),
+        {'mimeType': 'multipart/related', 'parts': [
+            {'mimeType': 'multipart/alternative', 'parts': [part('text/plain', 'nested body')]}]}]}
+    assert decode_payload(payload) == 'nested body'
+
+def test_disposition_attachment_is_skipped():
+    attachment = part('text/plain', 'log file', headers=[
+        {'name': 'Content-Disposition', 'value': 'attachment; filename="log.txt"'}])
+    payload = {'mimeType': 'multipart/mixed', 'parts': [attachment]}
+    assert decode_payload(payload) == NO_TEXT_CONTENT
+
+def test_reads_forwarded_message_parts():
+    payload = {'mimeType': 'multipart/mixed', 'parts': [
+        {'mimeType': 'message/rfc822', 'parts': [part('text/plain', 'forwarded body')]}]}
+    assert decode_payload(payload) == 'forwarded body'
+
+def test_untyped_single_part_is_plain_text():
+    assert decode_payload({'body': {'data': encode_body('just text')}}) == 'just text'
+
+def test_nesting_below_max_depth_is_ignored():
+    payload = part('text/plain', 'too deep')
+    for _ in range(12):
+        payload = {'mimeType': 'multipart/mixed', 'parts': [payload]}
+    assert decode_payload(payload) == NO_TEXT_CONTENT
+
+def test_declared_charset_and_missing_padding():
+    data = base64.urlsafe_b64encode('café'.encode('latin-1')).decode('ascii').rstrip('=')
+    latin = {'mimeType': 'text/plain', 'body': {'data': data},
+             'headers': [{'name': 'Content-Type', 'value': 'text/plain; charset="ISO-8859-1"'}]}
+    assert decode_part_body(latin) == 'café'
+
+def test_part_body_is_capped():
+    assert decode_part_body(part('text/plain', 'x' * 100), max_bytes=10) == 'x' * 10
+
+def test_broken_html_still_yields_text():
+    assert 'text' in html_to_text('<p>text<div')
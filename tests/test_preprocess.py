@@ -0,0 +1,54 @@
+import pytest
+from preprocess import (HEAD_FRACTION, STAGE_TOKEN_BUDGETS, count_tokens, preprocess_email, strip_quoted_history,
+                        truncate_head_tail)
+
+def test_text_within_the_budget_is_kept_whole():
+    text = 'x' * 400
+    assert count_tokens(text) == 100
+    assert truncate_head_tail(text, 100) == text
+
+@pytest.mark.parametrize('length', [401, 1000, 100000])
+def test_truncated_text_keeps_head_and_tail_within_the_budget(length):
+    text = ''.join(chr(ord('a') + n % 26) for n in range(length))
+    truncated = truncate_head_tail(text, 100)
+    assert count_tokens(truncated) <= 100
+    head, marker, tail = truncated.split('\n')
+    assert text.startswith(head) and text.endswith(tail)
+    assert len(head) == int((len(head) + len(tail)) * HEAD_FRACTION)
+    omitted = len(text) - len(head) - len(tail)
+    assert marker == f'[... {count_tokens(text[len(head):len(text) - len(tail)])} tokens omitted ...]'
+    assert omitted > 0
+
+def test_stage_budgets_apply_after_cleanup():
+    text = 'word ' * 4000
+    assert count_tokens(preprocess_email(text, 'categorize')) <= STAGE_TOKEN_BUDGETS['categorize']
+    assert count_tokens(preprocess_email(text, 'respond')) <= STAGE_TOKEN_BUDGETS['respond']
+
+@pytest.mark.parametrize('separator', ['\n\n', '\n'])
+def test_quoted_reply_is_stripped_below_the_new_text(separator):
+    text = (f'Yes, Thursday works.{separator}On Mon, 3 Jun 2024, Bob <bob@example.com> wrote:\n'
+            '> Can we meet on Thursday?\n> Bob')
+    assert strip_quoted_history(text).strip() == 'Yes, Thursday works.'
+
+@pytest.mark.parametrize('header', [
+    '-----Original Message-----\nFrom: Bob',
+    '---------- Forwarded message ---------\nFrom: Bob',
+    'From: Bob <bob@example.com>\nSent: Monday, 3 June 2024 09:00',
+    '________________________________\nFrom: Bob',
+])
+def test_outlook_and_forward_headers_start_quoted_history(header):
+    assert strip_quoted_history(f'Sounds good.\n{header}\nOld text') == 'Sounds good.'
+
+def test_interleaved_quote_lines_are_dropped_but_replies_kept():
+    text = '> What time?\nNoon.\n> Where?\nThe usual place.'
+    assert strip_quoted_history(text) == 'Noon.\nThe usual place.'
+
+def test_a_leading_quote_header_is_not_mistaken_for_history():
+    # Only a header below some new text starts the quoted part
+    text = 'On Monday the team wrote:\nthe release notes are attached.'
+    assert strip_quoted_history(text) == text
+
+def test_preprocessing_cleans_signatures_links_and_boilerplate():
+    text = ('Please   review the attached contract: https://example.com/track?id=123&utm=x\n\n'
+            'To unsubscribe click here.\n--\nAlice\nSales')
+    assert preprocess_email(text, 'summarize') == 'Please review the attached contract: [link: example.com]'
@@ -0,0 +1,149 @@
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from googleapiclient.errors import HttpError
+import ratelimit
+from metrics import metrics
+from ratelimit import RateLimiter, TokenBucket, is_rate_limited, is_retryable, retry_after
+from tests.fakes import FakeGmail, http_error, rate_limit_error
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Frozen monotonic clock; sleeps are recorded instead of taken."""
+    state = {'now': 1000.0, 'sleeps': []}
+    monkeypatch.setattr(ratelimit.time, 'monotonic', lambda: state['now'])
+    monkeypatch.setattr(ratelimit.time, 'sleep', state['sleeps'].append)
+    return state
+
+def test_bucket_waits_for_the_shortfall(clock):
+    bucket = TokenBucket('test', rate=10)
+    assert bucket.acquire(10) == 0.0
+    assert bucket.acquire(5) == pytest.approx(0.5)
+    # The reservation queues the next caller behind the first
+    assert bucket.acquire(5) == pytest.approx(1.0)
+    clock['now'] += 10
+    assert bucket.acquire(1) == 0.0
+    assert clock['sleeps'] == [pytest.approx(0.5), pytest.approx(1.0)]
+
+def test_refill_is_capped_at_capacity(clock):
+    bucket = TokenBucket('test', rate=10, capacity=20)
+    bucket.acquire(20)
+    clock['now'] += 60
+    assert bucket.get_state()['available'] == 20
+
+def test_throttling_halves_rate_once_per_cooldown(clock):
+    bucket = TokenBucket('test', rate=100, min_rate=30, cooldown=1.0)
+    bucket.on_throttled()
+    bucket.on_throttled()
+    assert bucket.rate == 50
+    clock['now'] += 1.0
+    bucket.on_throttled()
+    assert bucket.rate == 30
+    assert bucket.throttled == 3
+
+def test_rate_recovers_additively(clock):
+    bucket = TokenBucket('test', rate=100)
+    bucket.on_throttled()
+    for _ in range(10):
+        bucket.on_success()
+    assert bucket.rate == pytest.approx(60)
+    for _ in range(100):
+        bucket.on_success()
+    assert bucket.rate == 100
+
+def test_backoff_is_jittered_exponential_and_capped():
+    limiter = RateLimiter(base_delay=1.0, max_delay=5.0)
+    for attempt in range(6):
+        assert 0 <= limiter.backoff_delay(attempt) <= min(5.0, 2 ** attempt)
+    assert limiter.backoff_delay(0, retry_after_seconds=3) == 3
+    assert limiter.backoff_delay(0, retry_after_seconds=30) == 5.0
+
+def test_error_classification():
+    assert is_rate_limited(rate_limit_error(429))
+    assert is_rate_limited(rate_limit_error(403))
+    assert not is_rate_limited(http_error(403, b'{"error": {"errors": [{"reason": "forbidden"}]}}'))
+    assert is_retryable(http_error(503))
+    assert is_retryable(ConnectionError())
+    assert not is_retryable(http_error(400))
+    assert retry_after(http_error(429, headers={'retry-after': '7'})) == 7.0
+    assert retry_after(http_error(429)) is None
+
+def test_retries_until_success_and_charges_every_attempt(limiter):
+    gmail = FakeGmail()
+    gmail.fail('gmail.users.labels.list', rate_limit_error(), http_error(503))
+    before = metrics.snapshot()
+    response = limiter.execute(gmail.users().labels().list(userId='me'), stage='test_retry')
+    assert response == {'labels': []}
+    assert gmail.calls['gmail.users.labels.list'] == 3
+    assert limiter.retries == 2
+    assert limiter.buckets['gmail'].throttled == 1
+    report = metrics.get_report(since=before)['test_retry']
+    assert (report['calls'], report['retries'], report['gmail_quota_units']) == (1, 2, 3)
+
+def test_gives_up_after_max_retries(limiter):
+    gmail = FakeGmail()
+    gmail.fail('gmail.users.labels.list', *[http_error(500)] * (limiter.max_retries + 1))
+    with pytest.raises(HttpError):
+        limiter.execute(gmail.users().labels().list(userId='me'))
+    assert gmail.calls['gmail.users.labels.list'] == limiter.max_retries + 1
+
+def test_client_errors_are_not_retried(limiter):
+    gmail = FakeGmail()
+    with pytest.raises(HttpError):
+        limiter.execute(gmail.users().messages().get(userId='me', id='missing'))
+    assert gmail.calls['gmail.users.messages.get'] == 1
+    assert limiter.retries == 0
+
+def test_retries_from_many_threads_are_all_counted(limiter):
+    def flaky():
+        failures = [ConnectionError('reset')]
+
+        def create():
+            if failures:
+                raise failures.pop()
+            return 'ok'
+        return create
+
+    def calls(count):
+        for _ in range(count):
+            limiter.call_openai(flaky(), 0, stage='test_threads')
+
+    # Switch threads as often as possible so unlocked increments would be lost
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(calls, [200] * 8))
+    finally:
+        sys.setswitchinterval(interval)
+    assert limiter.retries == 1600
+    assert limiter.get_state()['retries'] == 1600
+
+def test_openai_tokens_are_corrected_to_actual_usage(clock):
+    class Usage:
+        prompt_tokens = 30
+        completion_tokens = 10
+        total_tokens = 40
+
+    class Response:
+        usage = Usage()
+
+    limiter = RateLimiter(openai_tpm=600)
+    bucket = limiter.buckets['openai_tokens']
+    before = bucket.get_state()['available']
+    limiter.call_openai(lambda **kwargs: Response(), 1000)
+    # Only the 40 tokens actually used stay charged
+    assert before - bucket.get_state()['available'] == pytest.approx(40)
+
+def test_non_idempotent_calls_are_only_retried_when_rate_limited(limiter):
+    gmail = FakeGmail()
+    gmail.fail('gmail.users.labels.create', rate_limit_error(429), rate_limit_error(403))
+    label = limiter.execute(gmail.users().labels().create(userId='me', body={'name': 'x'}), idempotent=False)
+    assert label['id'] == 'Label_1'
+    assert gmail.calls['gmail.users.labels.create'] == 3
+
+    for error in (http_error(503), ConnectionError(), TimeoutError()):
+        gmail.fail('gmail.users.labels.create', error)
+        with pytest.raises(type(error)):
+            limiter.execute(gmail.users().labels().create(userId='me', body={'name': 'y'}), idempotent=False)
+    assert gmail.calls['gmail.users.labels.create'] == 6
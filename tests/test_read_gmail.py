@@ -0,0 +1,178 @@
+import itertools
+import time
+import httplib2
+import pytest
+from google.oauth2.credentials import Credentials
+from googleapiclient import discovery_cache
+import read_gmail
+from preprocess import preprocess_email
+from read_gmail import (BATCH_SIZE, GmailServiceFactory, get_messages, load_history_id, load_retry_ids, read_messages, save_history_id,
+                        sync_messages, thread_context)
+from tests.fakes import FakeGmail, http_error, make_message, rate_limit_error
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    return str(tmp_path / 'history.json')
+
+def added(*msg_ids, labels=('INBOX',)):
+    return [{'message': {'id': msg_id, 'labelIds': list(labels)}} for msg_id in msg_ids]
+
+def list_requests(gmail):
+    return [(params['pageToken'], params['maxResults'])
+            for method, params in gmail.requests if method == 'gmail.users.messages.list']
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+def inbox(size):
+    return FakeGmail([make_message(f'm{i}', f'body {i}') for i in range(size)])
+
+def test_max_results_is_honoured_across_pages():
+    gmail = inbox(25)
+    messages = list(get_messages(gmail, page_size=10, max_results=15))
+    assert [message['id'] for message in messages] == [f'm{i}' for i in range(15)]
+    # The second page only asks for what is still needed, and there is no third
+    assert list_requests(gmail) == [(None, 10), ('10', 5)]
+
+def test_next_page_is_prefetched_while_the_current_one_is_consumed():
+    gmail = inbox(25)
+    messages = get_messages(gmail, page_size=10)
+    assert next(messages)['id'] == 'm0'
+    wait_until(lambda: len(list_requests(gmail)) == 2)
+    assert list_requests(gmail)[1] == ('10', 10)
+    assert [message['id'] for message in itertools.islice(messages, 9)][-1] == 'm9'
+    messages.close()
+
+def test_paging_stops_when_the_consumer_stops():
+    gmail = inbox(50)
+    messages = get_messages(gmail, page_size=10)
+    assert [message['id'] for message in itertools.islice(messages, 3)] == ['m0', 'm1', 'm2']
+    messages.close()
+    time.sleep(0.1)
+    # At most the prefetched second page was requested
+    assert [page_token for page_token, _ in list_requests(gmail)] in ([None], [None, '10'])
+
+def test_batches_are_chunked():
+    gmail = FakeGmail([make_message(f'm{i}', f'body {i}') for i in range(BATCH_SIZE + 5)])
+    bodies = read_messages(gmail, list(gmail.messages))
+    assert gmail.batch_sizes == [BATCH_SIZE, 5]
+    assert bodies['m7'] == 'body 7'
+    assert len(bodies) == BATCH_SIZE + 5
+
+def test_throttled_sub_requests_are_retried_in_a_follow_up_batch(limiter):
+    gmail = FakeGmail([make_message(f'm{i}', f'body {i}') for i in range(3)])
+    gmail.fail('gmail.users.messages.get', rate_limit_error(), http_error(503))
+    bodies = read_messages(gmail, ['m0', 'm1', 'm2'])
+    assert bodies == {'m0': 'body 0', 'm1': 'body 1', 'm2': 'body 2'}
+    assert gmail.batch_sizes == [3, 2]
+    assert limiter.retries == 2
+    assert limiter.buckets['gmail'].throttled == 1
+
+def test_failed_sub_requests_map_to_none():
+    gmail = FakeGmail([make_message('m0', 'body 0')])
+    bodies = read_messages(gmail, ['m0', 'missing'])
+    assert bodies == {'m0': 'body 0', 'missing': None}
+    assert gmail.batch_sizes == [2]
+
+def test_sub_requests_give_up_after_max_retries(limiter):
+    gmail = FakeGmail([make_message('m0', 'body 0')])
+    gmail.fail('gmail.users.messages.get', *[http_error(500)] * (limiter.max_retries + 1))
+    assert read_messages(gmail, ['m0']) == {'m0': None}
+    assert len(gmail.batch_sizes) == limiter.max_retries + 1
+
+def test_first_sync_lists_the_inbox_at_the_current_history_id(checkpoint):
+    gmail = FakeGmail([make_message('m1', 'one'), make_message('m2', 'two', labels=['SENT'])])
+    messages = list(sync_messages(gmail, checkpoint_file=checkpoint))
+    assert [(message['id'], message['checkpoint']) for message in messages] == [('m1', '100')]
+    # Saving is left to the caller, once the message is done
+    assert load_history_id(checkpoint) is None
+
+def test_empty_first_sync_checkpoints_right_away(checkpoint):
+    assert list(sync_messages(FakeGmail(), checkpoint_file=checkpoint)) == []
+    assert load_history_id(checkpoint) == '100'
+
+def test_incremental_sync_yields_only_new_inbox_messages(checkpoint):
+    save_history_id(100, checkpoint)
+    gmail = FakeGmail()
+    gmail.history_id = 103
+    gmail.history_pages = [
+        [{'id': '101', 'messagesAdded': added('m1')}],
+        [{'id': '102', 'messagesAdded': added('m2') + added('m1') + added('s1', labels=['SENT'])}],
+    ]
+    assert [message['id'] for message in sync_messages(gmail, checkpoint_file=checkpoint)] == ['m1', 'm2']
+    assert load_history_id(checkpoint) == '100'
+    assert gmail.calls['gmail.users.messages.list'] == 0
+
+def test_each_message_carries_the_checkpoint_safe_once_it_is_done(checkpoint):
+    save_history_id(100, checkpoint)
+    gmail = FakeGmail()
+    gmail.history_id = 103
+    gmail.history_pages = [[{'id': '101', 'messagesAdded': added('m1', 'm2')},
+                            {'id': '102', 'messagesAdded': added('m3')}]]
+    messages = list(sync_messages(gmail, checkpoint_file=checkpoint))
+    # m2 belongs to the same record as m1, so m1 alone does not move the checkpoint
+    assert [(message['id'], message['checkpoint']) for message in messages] == [
+        ('m1', '100'), ('m2', '101'), ('m3', '102')]
+
+def test_sync_without_new_mail_advances_and_keeps_the_retry_ids(checkpoint):
+    save_history_id(100, checkpoint, retry_ids=['m9'])
+    gmail = FakeGmail()
+    gmail.history_id = 103
+    gmail.history_pages = [[{'id': '102', 'messagesAdded': added('s1', labels=['SENT'])}]]
+    assert list(sync_messages(gmail, checkpoint_file=checkpoint)) == []
+    assert load_history_id(checkpoint) == '103'
+    assert load_retry_ids(checkpoint) == ['m9']
+
+def test_expired_checkpoint_falls_back_to_a_full_sync(checkpoint):
+    save_history_id(5, checkpoint)
+    gmail = FakeGmail([make_message('m1', 'one')])
+    gmail.oldest_history_id = 50
+    messages = list(sync_messages(gmail, checkpoint_file=checkpoint))
+    assert [(message['id'], message['checkpoint']) for message in messages] == [('m1', '100')]
+
+def test_unreadable_checkpoint_is_ignored(checkpoint):
+    with open(checkpoint, 'w') as checkpoint_file:
+        checkpoint_file.write('{not json')
+    assert load_history_id(checkpoint) is None
+
+def test_thread_context_survives_preprocessing_of_a_quoted_reply():
+    first = make_message('m1', 'Can you send the Q3 invoice for the Berlin office?', thread_id='t1',
+                         sender='bob@example.com', internal_date=1)
+    second = make_message('m2', 'Sure, which cost centre should it go to?', thread_id='t1',
+                          sender='me@example.com', labels=['SENT'], internal_date=2)
+    newest = make_message(
+        'm3',
+        'Cost centre 4410, thanks.\n--\nBob\n\nOn Tue, Me <me@example.com> wrote:\n'
+        '> Sure, which cost centre should it go to?\n>\n> On Mon, Bob wrote:\n> > Can you send the Q3 invoice?',
+        thread_id='t1', sender='bob@example.com', internal_date=3)
+    context = thread_context({'id': 't1', 'messages': [first, second, newest]}, newest)
+
+    text = preprocess_email(context, 'categorize')
+    assert text.startswith('Cost centre 4410, thanks.')
+    assert 'which cost centre should it go to?' in text
+    assert 'Q3 invoice for the Berlin office' in text
+    # Each earlier message appears once, from its own body rather than the quotes
+    assert text.count('which cost centre') == 1
+    assert 'wrote:' not in text
+
+def test_services_are_built_from_the_cached_discovery_document(monkeypatch):
+    monkeypatch.setattr(read_gmail, '_discovery_documents', {})
+    loads = []
+    get_static_doc = discovery_cache.get_static_doc
+    monkeypatch.setattr(discovery_cache, 'get_static_doc', lambda *args: loads.append(args) or get_static_doc(*args))
+
+    def no_network(*args, **kwargs):
+        raise AssertionError('building a service made a request')
+    monkeypatch.setattr(httplib2.Http, 'request', no_network)
+
+    factory = GmailServiceFactory(credentials=Credentials(token='token'))
+    services = [factory.build(), factory.build()]
+    # The bundled document was parsed once and each service got its own transport
+    assert loads == [('gmail', 'v1')]
+    assert services[0]._rootDesc is services[1]._rootDesc is read_gmail.discovery_document()
+    assert services[0]._http is not services[1]._http
+    request = services[1].users().messages().list(userId='me')
+    assert request.uri.startswith('https://gmail.googleapis.com/gmail/v1/users/me/messages')
@@ -0,0 +1,57 @@
+import pytest
+from main import EmailProcessor
+from rules import HeaderRules
+from tests.fakes import FakeGmail, FakeOpenAI, make_message
+
+def with_headers(message, **headers):
+    message['payload']['headers'] += [{'name': name.replace('_', '-'), 'value': value}
+                                      for name, value in headers.items()]
+    return message
+
+@pytest.mark.parametrize('headers, labels, rule', [
+    ({'Auto_Submitted': 'auto-replied'}, ['INBOX'], 'auto_submitted'),
+    ({'X_Autoreply': 'yes'}, ['INBOX'], 'auto_submitted'),
+    ({'List_Unsubscribe': '<mailto:leave@example.com>'}, ['INBOX'], 'list_unsubscribe'),
+    ({'List_Id': '<team.lists.example.com>'}, ['INBOX'], 'list_unsubscribe'),
+    ({'Precedence': ' Bulk '}, ['INBOX'], 'bulk_precedence'),
+    ({'From': 'GitHub <notifications@github.com>'}, ['INBOX'], 'noreply_sender'),
+    ({'From': 'Shop <do-not-reply@shop.example>'}, ['INBOX'], 'noreply_sender'),
+    ({}, ['INBOX', 'CATEGORY_PROMOTIONS'], 'gmail_category'),
+])
+def test_bulk_and_automated_mail_is_categorized_from_headers(headers, labels, rule):
+    message = with_headers(make_message('m1', 'Your weekly digest', labels=labels), **headers)
+    if 'From' in headers:
+        # Drop make_message's own sender so only the one under test is left
+        message['payload']['headers'].pop(0)
+    category_info = HeaderRules().classify(message)
+    assert category_info['category'] == 'NO_RESPONSE'
+    assert category_info['rule'] == rule
+    assert category_info['original_content'] == 'Your weekly digest'
+
+@pytest.mark.parametrize('headers', [{}, {'Auto_Submitted': 'no'}, {'Precedence': 'first-class'}])
+def test_personal_mail_is_left_to_the_llm(headers):
+    rules = HeaderRules()
+    message = with_headers(make_message('m1', 'Can we move our call to Friday?', sender='Bob <bob@example.com>',
+                                        labels=['INBOX', 'CATEGORY_PERSONAL']), **headers)
+    assert rules.classify(message) is None
+    assert rules.get_rule_stats() == {'hits': 0, 'misses': 1, 'by_rule': {}}
+
+def test_the_first_matching_rule_explains_the_category():
+    rules = HeaderRules()
+    message = with_headers(make_message('m1', 'Out of office'), Auto_Submitted='auto-replied', Precedence='bulk')
+    assert rules.classify(message)['rule'] == 'auto_submitted'
+    assert rules.get_rule_stats() == {'hits': 1, 'misses': 0, 'by_rule': {'auto_submitted': 1}}
+
+def test_matched_mail_skips_the_llm_and_the_body_download():
+    newsletter = with_headers(make_message('m1', 'Ten tips for spring'), List_Unsubscribe='<https://example.com/u>')
+    question = make_message('m2', 'Could you confirm my order has shipped?')
+    gmail = FakeGmail([newsletter, question])
+    openai_client = FakeOpenAI('HUMAN_NEEDED\nA customer question')
+    processor = EmailProcessor(gmail_service=gmail, openai_client=openai_client, label_file=None,
+                               history_file=None, header_rules=True)
+    assert processor.process_emails() == {'NO_RESPONSE': 1, 'HUMAN_NEEDED': 1}
+    # Only the unmatched email was downloaded in full and sent to OpenAI, once to summarize and once to categorize
+    full_fetches = [params['id'] for method, params in gmail.requests
+                    if method == 'gmail.users.messages.get' and params['format'] != 'metadata']
+    assert full_fetches == ['m2']
+    assert openai_client.calls == 2
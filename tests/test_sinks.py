@@ -0,0 +1,77 @@
+import json
+import sqlite3
+import pytest
+from main import EmailProcessor
+from sinks import JsonlSink, SqliteSink, open_sink
+from tests.fakes import FakeGmail, FakeOpenAI, make_message
+
+RESULT = {'id': 'm1', 'content': 'Could you confirm my order shipped?', 'summary': 'Asks about an order.',
+          'category': 'AUTO_REPLY', 'category_explanation': 'Status request',
+          'processed_at': '2024-06-03T09:00:00', 'auto_response': {'send_success': True, 'message_id': 'sent1'}}
+
+def sqlite_rows(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT id, category, processed_at, result FROM results ORDER BY id").fetchall()
+    finally:
+        conn.close()
+
+def test_jsonl_sink_round_trips_a_result(tmp_path):
+    path = str(tmp_path / 'results.jsonl')
+    sink = JsonlSink(path)
+    sink.write(RESULT)
+    # Each line is on disk as soon as it is written
+    with open(path) as results:
+        assert [json.loads(line) for line in results] == [RESULT]
+    sink.close()
+
+def test_jsonl_sink_appends_across_runs(tmp_path):
+    path = str(tmp_path / 'results.jsonl')
+    for msg_id in ('m1', 'm2'):
+        sink = JsonlSink(path)
+        sink.write(dict(RESULT, id=msg_id))
+        sink.close()
+    with open(path) as results:
+        assert [json.loads(line)['id'] for line in results] == ['m1', 'm2']
+
+def test_sqlite_sink_round_trips_a_result(tmp_path):
+    path = str(tmp_path / 'results.db')
+    sink = SqliteSink(path)
+    sink.write(RESULT)
+    sink.close()
+    [(msg_id, category, processed_at, result)] = sqlite_rows(path)
+    assert (msg_id, category, processed_at) == ('m1', 'AUTO_REPLY', '2024-06-03T09:00:00')
+    assert json.loads(result) == RESULT
+
+def test_sqlite_sink_commits_in_groups_and_keeps_one_row_per_message(tmp_path):
+    path = str(tmp_path / 'results.db')
+    sink = SqliteSink(path, commit_every=3)
+    sink.write(RESULT)
+    sink.write(dict(RESULT, category='HUMAN_NEEDED'))
+    assert sqlite_rows(path) == []
+    sink.write(dict(RESULT, id='m2'))
+    assert [row[:2] for row in sqlite_rows(path)] == [('m1', 'HUMAN_NEEDED'), ('m2', 'AUTO_REPLY')]
+    sink.write(dict(RESULT, id='m3'))
+    sink.flush()
+    assert len(sqlite_rows(path)) == 3
+    sink.close()
+
+@pytest.mark.parametrize('name, sink_class', [('results.db', SqliteSink), ('results.sqlite3', SqliteSink),
+                                              ('results.jsonl', JsonlSink)])
+def test_sink_type_follows_the_file_extension(tmp_path, name, sink_class):
+    sink = open_sink(str(tmp_path / name))
+    assert isinstance(sink, sink_class)
+    sink.close()
+
+def test_processor_streams_every_result_to_the_sink(tmp_path):
+    path = str(tmp_path / 'results.db')
+    gmail = FakeGmail([make_message(f'm{i}', 'Weekly newsletter: ten tips for spring') for i in range(3)])
+    sink = SqliteSink(path, commit_every=100)
+    processor = EmailProcessor(gmail_service=gmail, openai_client=FakeOpenAI('NO_RESPONSE\nA newsletter'),
+                               label_file=None, history_file=None, sink=sink)
+    processor.process_emails()
+    # The run flushes the sink at the end, without waiting for a full group
+    rows = sqlite_rows(path)
+    assert [(row[0], row[1]) for row in rows] == [('m0', 'NO_RESPONSE'), ('m1', 'NO_RESPONSE'), ('m2', 'NO_RESPONSE')]
+    assert json.loads(rows[0][3])['spam_status']['success']
+    sink.close()